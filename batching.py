@@ -0,0 +1,117 @@
+"""Микробатчинг: объединение одиночных запросов из разных потоков в один вызов.
+
+Вызывающий поток отдаёт элемент в submit() и блокируется до результата. Фоновый
+поток собирает элементы, пока не истечёт окно max_wait с момента прихода первого
+или не наберётся max_batch_size, и передаёт пачку в process_batch одним вызовом.
+"""
+import logging
+import threading
+import time
+from collections import Counter
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable, Generic, Optional, TypeVar
+
+T = TypeVar("T")
+R = TypeVar("R")
+
+logger = logging.getLogger('BATCH')
+
+
+class MicroBatcher(Generic[T, R]):
+    """Собирает элементы в пачки по времени (max_wait) или размеру (max_batch_size)."""
+
+    def __init__(
+        self,
+        process_batch: Callable[[list[T]], list[R]],
+        max_batch_size: int = 16,
+        max_wait: float = 0.005,
+        max_concurrent_batches: int = 4,
+        name: str = "batcher",
+    ):
+        if max_batch_size < 1:
+            raise ValueError("max_batch_size должен быть >= 1")
+        self.process_batch = process_batch
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.name = name
+        self.stats: Counter = Counter()
+        self._stats_lock = threading.Lock()
+        self._pending: list[tuple[T, Future]] = []
+        self._first_at = 0.0
+        self._cond = threading.Condition()
+        self._executor = ThreadPoolExecutor(max_workers=max_concurrent_batches, thread_name_prefix=name)
+        self._worker: Optional[threading.Thread] = None
+        self._closed = False
+
+    def _ensure_worker(self) -> None:
+        if self._worker is None:
+            self._worker = threading.Thread(target=self._run, name=f"{self.name}-collector", daemon=True)
+            self._worker.start()
+
+    def submit_future(self, item: T) -> Future:
+        """Ставит элемент в очередь и возвращает Future с результатом."""
+        future: Future = Future()
+        with self._cond:
+            if self._closed:
+                raise RuntimeError(f"{self.name} закрыт")
+            self._ensure_worker()
+            if not self._pending:
+                self._first_at = time.monotonic()
+            self._pending.append((item, future))
+            self._cond.notify()
+        return future
+
+    def submit(self, item: T, timeout: Optional[float] = None) -> R:
+        """Ставит элемент в очередь и ждёт результат."""
+        return self.submit_future(item).result(timeout=timeout)
+
+    def _take_batch(self) -> Optional[list[tuple[T, Future]]]:
+        with self._cond:
+            while True:
+                if self._closed and not self._pending:
+                    return None
+                if not self._pending:
+                    self._cond.wait()
+                    continue
+                remaining = self._first_at + self.max_wait - time.monotonic()
+                if len(self._pending) >= self.max_batch_size or remaining <= 0 or self._closed:
+                    batch = self._pending[:self.max_batch_size]
+                    self._pending = self._pending[self.max_batch_size:]
+                    if self._pending:
+                        self._first_at = time.monotonic()
+                    return batch
+                self._cond.wait(timeout=remaining)
+
+    def _run(self) -> None:
+        while True:
+            batch = self._take_batch()
+            if batch is None:
+                return
+            self._executor.submit(self._dispatch, batch)
+
+    def _dispatch(self, batch: list[tuple[T, Future]]) -> None:
+        items = [item for item, _ in batch]
+        with self._stats_lock:  # пачки обрабатываются в нескольких потоках
+            self.stats["batches"] += 1
+            self.stats["items"] += len(items)
+            self.stats["max_batch"] = max(self.stats["max_batch"], len(items))
+        try:
+            results = self.process_batch(items)
+            if len(results) != len(items):
+                raise ValueError(f"{self.name}: получено {len(results)} результатов на {len(items)} элементов")
+        except Exception as e:
+            logger.warning(f"{self.name}: ошибка обработки пачки из {len(items)}: {type(e).__name__}: {e}")
+            for _, future in batch:
+                future.set_exception(e)
+            return
+        for (_, future), result in zip(batch, results):
+            future.set_result(result)
+
+    def close(self) -> None:
+        """Обрабатывает оставшиеся элементы и останавливает фоновый поток."""
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        if self._worker is not None:
+            self._worker.join(timeout=5)
+        self._executor.shutdown(wait=True)
@@ -1,18 +1,33 @@
 """Полная версия бота для личных сообщений. С кнопками и FSM."""
+# startup импортируется первым: при STARTUP_PROFILE=1 он замеряет время всех последующих импортов
+from startup import log_startup_report, preload_in_background, profiler, run_startup_tests
+
+import asyncio
+import hashlib
 import json
 import os
+from typing import Optional
 
 import aiomax
 from aiomax import fsm
 from aiomax.buttons import KeyboardBuilder, CallbackButton, LinkButton
 
-from common import setup_logging, UserTracker
-from rag_bot_new import answer_question
+from common import answer_question, answer_in_session, setup_logging, new_correlation_id, UserTracker
+from dm_session import DialogSessions
+import profiling
+import warmup
+import webhook
+from hot_reload import Reloadable, default_watcher
 from settings import settings
-from tests import run_startup_tests
 
 main_logger, user_logger = setup_logging()
-tracker = UserTracker()
+tracker = UserTracker(
+    state_path=os.path.join(settings.stats.state_dir, "dm.json"),
+    precision=settings.stats.hll_precision,
+    persist_interval=settings.stats.persist_interval,
+    hours_window=settings.stats.hours_window,
+    days_window=settings.stats.days_window,
+)
 
 if not settings.bot.token:
     raise RuntimeError("MAX_VK_BOT_TOKEN not found in keys.env")
@@ -20,8 +35,27 @@ if not settings.bot.token:
 bot = aiomax.Bot(settings.bot.token, default_format="markdown")
 
 FAQ_PATH = os.path.join(os.path.dirname(__file__), "data", "faq.json")
-with open(FAQ_PATH, encoding="utf-8") as f:
-    FAQ_QUESTIONS = json.load(f)
+
+
+def load_faq() -> tuple[dict, str]:
+    """Загружает FAQ и его версию (хэш содержимого).
+
+    Без файла бот работает, но кнопки FAQ отвечают «Вопрос не найден».
+    """
+    try:
+        with open(FAQ_PATH, "rb") as f:
+            raw = f.read()
+    except FileNotFoundError:
+        main_logger.warning(f"FAQ файл не найден: {FAQ_PATH}")
+        return {}, "missing"
+    return json.loads(raw), hashlib.sha256(raw).hexdigest()[:12]
+
+
+# перечитывается при изменении data/faq.json (см. hot_reload.py)
+faq = Reloadable("faq", [FAQ_PATH], load_faq)
+
+# последний вопрос и найденные чанки — для уточняющих вопросов (см. dm_session.py)
+sessions = DialogSessions(ttl=settings.dm.session_ttl, memory_budget=settings.dm.session_memory_budget_kb << 10)
 
 
 def get_level_keyboard() -> KeyboardBuilder:
@@ -81,19 +115,23 @@ WELCOME_MESSAGE = """👋 **Привет! Я бот-помощник по пос
 async def handle_message(message: aiomax.Message, cursor: fsm.FSMCursor):
     """Обработка входящих сообщений в ЛС."""
     user_id = message.sender.user_id
+    new_correlation_id(user_id)
     current_state = cursor.get_state()
 
     if current_state is None:
-        if tracker.add_user(user_id):
+        if tracker.add_user(user_id, chat_type="dm"):
             main_logger.info(f"[НОВЫЙ] user_id={user_id} | {tracker.get_stats()}")
         user_logger.info(f"[{user_id}] Первое сообщение")
         cursor.change_state("greeted")
         await message.reply(WELCOME_MESSAGE, keyboard=get_level_keyboard())
         return
     
-    tracker.add_user(user_id)
+    tracker.add_user(user_id, level=(cursor.get_data() or {}).get("level"), chat_type="dm")
 
     if current_state == "greeted":
+        if settings.rag.cross_level_search:
+            await handle_free_question(message, cursor)
+            return
         user_logger.info(f"[{user_id}] Не выбрал уровень")
         await message.reply("👆 Сначала выбери уровень образования с помощью кнопок выше.", keyboard=get_level_keyboard())
         return
@@ -103,7 +141,8 @@ async def handle_message(message: aiomax.Message, cursor: fsm.FSMCursor):
 async def on_bot_start(payload: aiomax.BotStartPayload, cursor: fsm.FSMCursor):
     """Обработка команды /start."""
     user_id = payload.user.user_id
-    if tracker.add_user(user_id):
+    new_correlation_id(user_id)
+    if tracker.add_user(user_id, chat_type="dm"):
         main_logger.info(f"[НОВЫЙ] user_id={user_id} | {tracker.get_stats()}")
     user_logger.info(f"[{user_id}] /start")
     cursor.clear()
@@ -116,6 +155,7 @@ async def handle_callback(callback: aiomax.Callback, cursor: fsm.FSMCursor):
     """Обработка нажатий кнопок."""
     payload = callback.payload
     user_id = callback.user.user_id
+    new_correlation_id(user_id)
     user_logger.info(f"[{user_id}] Callback: {payload}")
 
     if payload.startswith("level:"):
@@ -135,10 +175,10 @@ async def handle_callback(callback: aiomax.Callback, cursor: fsm.FSMCursor):
     elif payload.startswith("faq:"):
         parts = payload.split(":")
         level, topic = parts[1], parts[2]
-        faq_data = FAQ_QUESTIONS.get(level, {}).get(topic)
+        faq_data = faq.get().get(level, {}).get(topic)
         if faq_data:
             await callback.answer("Загрузка...")
-            reply_text = answer_question(faq_data["question"], level=level)
+            reply_text = await asyncio.to_thread(answer_question, faq_data["question"], level=level)
             kb = KeyboardBuilder()
             kb.add(CallbackButton("❓ Другой вопрос", f"more:{level}"))
             if faq_data.get("source"):
@@ -162,6 +202,7 @@ async def handle_free_question(message: aiomax.Message, cursor: fsm.FSMCursor):
     """Обработка свободных вопросов."""
     text = (message.body.text or "").strip()
     user_id = message.sender.user_id
+    new_correlation_id(user_id)
 
     if not text:
         return
@@ -171,24 +212,85 @@ async def handle_free_question(message: aiomax.Message, cursor: fsm.FSMCursor):
         return
 
     data = cursor.get_data() or {}
-    level = data.get("level", "master")
-    user_logger.info(f"[{user_id}] Вопрос ({level}): {text[:100]}...")
+    # без выбранного уровня — поиск по всем уровням сразу (если включён), иначе магистратура
+    level = data.get("level") or (None if settings.rag.cross_level_search else "master")
+    user_logger.info(f"[{user_id}] Вопрос ({level or 'все уровни'}): {text[:100]}...")
+    keyboard = get_after_answer_keyboard(level) if level else get_level_keyboard()
+
+    loop = asyncio.get_running_loop()
+    sent: asyncio.Future = loop.create_future()
+
+    async def edit_with_late_answer(late_text: str, record: Optional[dict]) -> None:
+        """Заменяет выдержки, отправленные по бюджету времени, полным ответом LLM."""
+        reply = await sent
+        if record is not None and settings.dm.follow_up:
+            sessions.put(cursor, record)
+        try:
+            await reply.edit(late_text, keyboard=keyboard)
+            user_logger.info(f"[{user_id}] Поздний ответ: {len(late_text)} симв.")
+        except Exception as e:
+            main_logger.error(f"[ОШИБКА] Не удалось заменить ответ user_id={user_id} | {type(e).__name__}: {e}")
+
+    def on_late(late_text: str, record: Optional[dict]) -> None:
+        asyncio.run_coroutine_threadsafe(edit_with_late_answer(late_text, record), loop)
 
     try:
-        reply_text = answer_question(text, level=level)
+        late = on_late if settings.dm.late_answer_edit else None
+        if settings.dm.follow_up:
+            session = sessions.get(cursor, level)
+            reply_text, record = await asyncio.to_thread(answer_in_session, text, session, level, late)
+            if record is not None:
+                sessions.put(cursor, record)
+        else:
+            reply_text, _ = await asyncio.to_thread(answer_in_session, text, None, level, late)
         user_logger.info(f"[{user_id}] Ответ: {len(reply_text)} симв.")
-        await message.reply(reply_text, keyboard=get_after_answer_keyboard(level))
+        sent.set_result(await message.reply(reply_text, keyboard=keyboard))
     except Exception as e:
         main_logger.error(f"[ОШИБКА] user_id={user_id} | {type(e).__name__}: {e}")
         await message.reply("Произошла ошибка при обработке запроса. Попробуйте позже.")
+    finally:
+        if not sent.done():
+            sent.cancel()  # позднему ответу нечего редактировать
+
+
+@bot.on_command("profile")
+async def profile_command(ctx: aiomax.CommandContext):
+    """Профилирование по команде администратора (см. profiling.py)."""
+    if not profiling.is_admin(ctx.sender.user_id):
+        return
+    user_logger.info(f"[{ctx.sender.user_id}] /profile {ctx.args_raw}")
+    await ctx.reply(profiling.handle_command(ctx.args))
+
+
+@bot.on_ready()
+async def on_ready():
+    """Бот подключился к API и начинает получать обновления (polling или webhook)."""
+    log_startup_report()
+    profiling.start_from_settings()
 
 
 def main() -> None:
+    profiler.mark("main")
+    warmup.start_health_server()
+    warmup.start_warmup(preload_in_background())
+    faq.get()
+    default_watcher.start(settings.rag.reload_interval)
     run_startup_tests()
+    profiler.mark("startup_checks_done")
+    warmup.wait_until_ready()
+    profiler.mark("warmed_up")
     main_logger.info("=" * 50)
     main_logger.info("[ЗАПУСК] Бот для ЛС (с кнопками и FSM)")
     main_logger.info("=" * 50)
-    bot.run()
+    try:
+        if settings.webhook.enabled:
+            webhook.run_webhook(bot, settings.webhook)
+        else:
+            bot.run()
+    finally:
+        profiling.shutdown()
+        default_watcher.stop()
+        tracker.save()
 
 
 if __name__ == "__main__":
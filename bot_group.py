@@ -1,13 +1,29 @@
 """Лайт-версия бота для групповых чатов. Только упоминания, без кнопок."""
+# startup импортируется первым: при STARTUP_PROFILE=1 он замеряет время всех последующих импортов
+from startup import log_startup_report, preload_in_background, profiler, run_startup_tests
+
+import asyncio
+import dataclasses
+import os
+
 import aiomax
 
-from common import setup_logging, UserTracker
-from rag_bot_new import answer_question
+from chat_queue import Asker, ChatJob, ChatWorkQueues, format_collapsed_reply
+from common import answer_question, setup_logging, new_correlation_id, UserTracker
+import profiling
+import warmup
+import webhook
+from hot_reload import default_watcher
 from settings import settings
-from tests import run_startup_tests
 
 main_logger, user_logger = setup_logging()
-tracker = UserTracker()
+tracker = UserTracker(
+    state_path=os.path.join(settings.stats.state_dir, "group.json"),
+    precision=settings.stats.hll_precision,
+    persist_interval=settings.stats.persist_interval,
+    hours_window=settings.stats.hours_window,
+    days_window=settings.stats.days_window,
+)
 
 BOT_USERNAME = settings.bot.username
 LEVEL = "master"
@@ -33,6 +49,26 @@ WELCOME_MESSAGE = f"""👋 **Привет! Я бот-помощник по по
 """
 
 
+async def answer_in_thread(question: str) -> str:
+    return await asyncio.to_thread(answer_question, question, level=LEVEL)
+
+
+async def send_reply(job: ChatJob, text: str) -> None:
+    """Отвечает на сообщение первого спросившего, цитируя всех, чьи вопросы склеены."""
+    user_logger.info(f"[{job.askers[0].user_id}] Ответ: {len(text)} симв., спрашивавших: {len(job.askers)}")
+    await job.askers[0].message.reply(format_collapsed_reply(job, text))
+
+
+queues = ChatWorkQueues(
+    answer_in_thread,
+    send_reply,
+    max_queue=settings.group.max_queue_per_chat,
+    max_in_flight=settings.group.max_in_flight_per_chat,
+    debounce_seconds=settings.group.debounce_seconds,
+    collapse_similarity=settings.group.collapse_similarity,
+)
+
+
 @bot.on_message()
 async def handle_message(message: aiomax.Message):
     """Обработка сообщений с упоминанием бота."""
@@ -42,9 +78,10 @@ async def handle_message(message: aiomax.Message):
         return
     
     user_id = message.sender.user_id
+    new_correlation_id(user_id)
     
-    if tracker.add_user(user_id):
-        main_logger.info(f"[НОВЫЙ] user_id={user_id} | {tracker.get_stats()}")
+    if tracker.add_user(user_id, level=LEVEL, chat_type="group"):
+        main_logger.info(f"[НОВЫЙ] user_id={user_id} | {tracker.get_stats()} | {queues.get_stats()}")
     
     user_logger.info(f"[{user_id}] Сообщение: {text[:100]}...")
 
@@ -67,20 +104,22 @@ async def handle_message(message: aiomax.Message):
     
     user_logger.info(f"[{user_id}] Вопрос: {cleaned[:100]}...")
     
-    try:
-        reply_text = answer_question(cleaned, level=LEVEL)
-        user_logger.info(f"[{user_id}] Ответ: {len(reply_text)} симв.")
-        await message.reply(reply_text)
-    except Exception as e:
-        main_logger.error(f"[ОШИБКА] user_id={user_id} | {type(e).__name__}: {e}")
-        await message.reply("Произошла ошибка при обработке запроса. Попробуйте позже.")
+    chat_id = message.recipient.chat_id
+    name = message.sender.first_name or message.sender.name or str(user_id)
+    status = queues.submit(chat_id, Asker(user_id, name, cleaned, message))
+    if status != "queued":
+        user_logger.info(f"[{user_id}] Очередь чата {chat_id}: {status}")
+    if status == "rejected":
+        main_logger.warning(f"[ОЧЕРЕДЬ] chat_id={chat_id} переполнена | {queues.get_stats()}")
+        await message.reply("⏳ Сейчас в чате много вопросов. Пожалуйста, спросите чуть позже.")
 
 
 @bot.on_bot_start()
 async def on_bot_start(payload: aiomax.BotStartPayload):
     """Обработка команды /start."""
     user_id = payload.user.user_id
-    if tracker.add_user(user_id):
+    new_correlation_id(user_id)
+    if tracker.add_user(user_id, level=LEVEL, chat_type="dm"):
         main_logger.info(f"[НОВЫЙ] user_id={user_id} | {tracker.get_stats()}")
     user_logger.info(f"[{user_id}] /start")
     await payload.send(WELCOME_MESSAGE)
@@ -93,12 +132,44 @@ async def on_bot_add(chat: aiomax.Chat):
     await bot.send_message(chat_id=chat.chat_id, text=WELCOME_MESSAGE)
 
 
+@bot.on_command("profile")
+async def profile_command(ctx: aiomax.CommandContext):
+    """Профилирование по команде администратора (см. profiling.py)."""
+    if not profiling.is_admin(ctx.sender.user_id):
+        return
+    user_logger.info(f"[{ctx.sender.user_id}] /profile {ctx.args_raw}")
+    await ctx.reply(profiling.handle_command(ctx.args))
+
+
+@bot.on_ready()
+async def on_ready():
+    """Бот подключился к API и начинает получать обновления (polling или webhook)."""
+    log_startup_report()
+    profiling.start_from_settings()
+
+
 def main() -> None:
+    profiler.mark("main")
+    warmup.start_health_server()
+    # групповой бот отвечает только по одному уровню — его и прогреваем
+    warmup.start_warmup(preload_in_background(), dataclasses.replace(settings.warmup, levels=(LEVEL,)))
+    default_watcher.start(settings.rag.reload_interval)
     run_startup_tests()
+    profiler.mark("startup_checks_done")
+    warmup.wait_until_ready()
+    profiler.mark("warmed_up")
     main_logger.info("=" * 50)
     main_logger.info(f"[ЗАПУСК] Групповой бот | @{BOT_USERNAME} | level={LEVEL}")
     main_logger.info("=" * 50)
-    bot.run()
+    try:
+        if settings.webhook.enabled:
+            webhook.run_webhook(bot, settings.webhook)
+        else:
+            bot.run()
+    finally:
+        profiling.shutdown()
+        default_watcher.stop()
+        tracker.save()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,209 @@
+"""bulk_answer.py
+
+Пакетные ответы на вопросы из JSONL: перегенерация FAQ, проверки качества,
+разбор вопросов из логов [НЕТ ИНФО].
+
+Каждая строка входа — JSON-объект с вопросом в поле question (или text, title),
+необязательным level ("bachelor"/"master") и id (или request_id; по умолчанию —
+номер строки). Вопросы идут через тот же пайплайн, что и в боте
+(rag_bot_new.answer_in_session), в --concurrency потоков. Результаты дописываются
+в выходной JSONL по мере готовности — с временем и токенами на вопрос.
+
+Повторный запуск с тем же --output продолжает с места остановки: вопросы, для
+которых в выходе уже есть запись (кроме status=error: исключение, упавшая или
+не успевшая LLM, незагруженная база знаний), пропускаются, а
+недописанная последняя строка отбрасывается.
+
+Использование:
+    python bulk_answer.py questions.jsonl --output answers.jsonl [--concurrency 8] [--level master]
+    python bulk_answer.py requests.jsonl --output answers.jsonl --fake   # без API, через fake_openai
+"""
+
+import argparse
+import dataclasses
+import json
+import os
+import statistics
+import sys
+import time
+from collections import Counter
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Iterator, Optional, TextIO
+
+QUESTION_FIELDS = ("question", "text", "title")
+ID_FIELDS = ("id", "request_id")
+STATUSES = ("answered", "no_info", "fallback", "rejected", "error")
+
+
+def read_questions(path: str, default_level: Optional[str] = None) -> Iterator[dict]:
+    """Вопросы из JSONL: {"id", "question", "level"}; строки без вопроса пропускаются."""
+    with open(path, encoding="utf-8") as f:
+        for number, line in enumerate(f, 1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                item = json.loads(line)
+            except json.JSONDecodeError:
+                print(f"⚠️ Строка {number}: не JSON, пропускаю", file=sys.stderr)
+                continue
+            question = next((item[k] for k in QUESTION_FIELDS if isinstance(item.get(k), str) and item[k].strip()), None)
+            if question is None:
+                print(f"⚠️ Строка {number}: нет поля {'/'.join(QUESTION_FIELDS)}, пропускаю", file=sys.stderr)
+                continue
+            item_id = next((item[k] for k in ID_FIELDS if item.get(k) is not None), number)
+            yield {"id": str(item_id), "question": question.strip(), "level": item.get("level") or default_level}
+
+
+def load_done(path: str) -> set[str]:
+    """id уже обработанных вопросов из выходного файла; обрезает недописанную последнюю строку."""
+    if not os.path.exists(path):
+        return set()
+    done: set[str] = set()
+    good_size = 0
+    with open(path, "rb") as f:
+        for raw in f:
+            try:
+                record = json.loads(raw)
+            except (json.JSONDecodeError, UnicodeDecodeError):
+                break  # строка, оборванная при падении: дальше неё ничего не дописано
+            if not raw.endswith(b"\n"):
+                break
+            good_size += len(raw)
+            if record.get("status") != "error":
+                done.add(str(record["id"]))
+            else:
+                done.discard(str(record["id"]))
+    if good_size < os.path.getsize(path):
+        with open(path, "r+b") as f:
+            f.truncate(good_size)
+    return done
+
+
+def answer_item(item: dict) -> dict:
+    """Ответ на один вопрос через answer_in_session с временем и токенами генерации."""
+    import rag_bot_new
+    from resilience import track_usage
+
+    start = time.perf_counter()
+    with track_usage() as usage:
+        try:
+            answer, record = rag_bot_new.answer_in_session(item["question"], None, item["level"])
+            status, error = rag_bot_new.answer_status(answer, record), None
+        except Exception as e:
+            answer, status, error = None, "error", f"{type(e).__name__}: {e}"
+    result = {
+        **item,
+        "answer": answer,
+        "status": status,
+        "seconds": round(time.perf_counter() - start, 3),
+        "prompt_tokens": usage["prompt_tokens"],
+        "cached_prompt_tokens": usage["cached_prompt_tokens"],
+        "completion_tokens": usage["completion_tokens"],
+        "llm_calls": usage["calls"],
+    }
+    if error:
+        result["error"] = error
+    return result
+
+
+def write_result(out: TextIO, result: dict) -> None:
+    """Строка результата сразу уходит на диск, чтобы после падения её не пришлось пересчитывать."""
+    out.write(json.dumps(result, ensure_ascii=False) + "\n")
+    out.flush()
+    os.fsync(out.fileno())
+
+
+def run(items, output: str, concurrency: int = 4, progress_every: int = 50) -> dict:
+    """Отвечает на вопросы items, дописывая результаты в output. Возвращает сводку прогона."""
+    done = load_done(output)
+    statuses: Counter = Counter()
+    tokens: Counter = Counter()
+    latencies: list[float] = []
+    skipped = 0
+    started = time.perf_counter()
+
+    def collect(finished) -> None:
+        for future in finished:
+            result = future.result()
+            write_result(out, result)
+            statuses[result["status"]] += 1
+            tokens["prompt"] += result["prompt_tokens"]
+            tokens["cached"] += result["cached_prompt_tokens"]
+            tokens["completion"] += result["completion_tokens"]
+            latencies.append(result["seconds"])
+            if len(latencies) % progress_every == 0:
+                elapsed = time.perf_counter() - started
+                print(f"… {len(latencies)} вопросов, {len(latencies) / elapsed:.1f}/с", file=sys.stderr)
+
+    with open(output, "a", encoding="utf-8") as out, ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="bulk") as pool:
+        pending = set()
+        for item in items:
+            if item["id"] in done:
+                skipped += 1
+                continue
+            done.add(item["id"])  # повтор id во входе не отвечаем дважды
+            if len(pending) >= concurrency * 2:
+                # вход читается по мере обработки, а не целиком
+                finished, pending = wait(pending, return_when=FIRST_COMPLETED)
+                collect(finished)
+            pending.add(pool.submit(answer_item, item))
+        collect(wait(pending).done)
+
+    elapsed = time.perf_counter() - started
+    processed = len(latencies)
+    return {
+        "processed": processed,
+        "skipped": skipped,
+        "seconds": elapsed,
+        "per_second": processed / elapsed if elapsed else 0.0,
+        "p50": statistics.median(latencies) if latencies else 0.0,
+        "p95": sorted(latencies)[int(0.95 * (processed - 1))] if latencies else 0.0,
+        "statuses": dict(statuses),
+        "prompt_tokens": tokens["prompt"],
+        "cached_prompt_tokens": tokens["cached"],
+        "completion_tokens": tokens["completion"],
+    }
+
+
+def print_summary(summary: dict) -> None:
+    print(f"✅ Обработано {summary['processed']} вопросов за {summary['seconds']:.1f} с "
+          f"({summary['per_second']:.1f} вопросов/с), пропущено уже готовых: {summary['skipped']}")
+    if summary["processed"]:
+        print(f"   задержка p50 {summary['p50']:.2f} с, p95 {summary['p95']:.2f} с")
+        print(f"   токенов: промпт {summary['prompt_tokens']} (из кеша {summary['cached_prompt_tokens']}), ответ {summary['completion_tokens']}")
+        print("   статусы: " + ", ".join(f"{s} {summary['statuses'][s]}" for s in STATUSES if summary["statuses"].get(s)))
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Ответы на вопросы из JSONL через RAG-пайплайн бота")
+    parser.add_argument("input", help="JSONL с вопросами")
+    parser.add_argument("--output", "-o", required=True, help="JSONL с ответами (дописывается, повторный запуск продолжает)")
+    parser.add_argument("--concurrency", type=int, default=4, help="Вопросов одновременно")
+    parser.add_argument("--level", choices=["bachelor", "master"], default=None, help="Уровень для вопросов без поля level")
+    parser.add_argument("--fake", action="store_true", help="Отвечать через локальный fake_openai (без API, для проверки)")
+    parser.add_argument("--latency", type=float, default=0.05, help="Задержка ответа fake_openai (сек)")
+    args = parser.parse_args()
+
+    import rag_bot_new
+
+    # офлайн ждём полный ответ LLM: выдержки по бюджету нужны только в чате
+    rag_bot_new.settings = dataclasses.replace(
+        rag_bot_new.settings, rag=dataclasses.replace(rag_bot_new.settings.rag, answer_budget=0.0),
+    )
+    items = read_questions(args.input, args.level)
+    if not args.fake:
+        print_summary(run(items, args.output, args.concurrency))
+        return
+
+    from benchmarks import use_fake_llm, use_fake_retriever
+    from fake_openai import FakeOpenAIServer
+
+    with FakeOpenAIServer(latency=args.latency) as server:
+        use_fake_llm(server.base_url)
+        use_fake_retriever(server.base_url)
+        print_summary(run(items, args.output, args.concurrency))
+
+
+if __name__ == "__main__":
+    main()
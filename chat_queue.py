@@ -0,0 +1,203 @@
+"""Очереди вопросов по чатам для группового бота.
+
+У каждого чата своя ограниченная очередь и лимит одновременно обрабатываемых
+вопросов, поэтому один шумный чат не занимает весь бюджет LLM, а ответы в
+чате уходят в порядке вопросов. Повторные упоминания одного пользователя в
+окне debounce не создают новых ответов, а почти одинаковые вопросы разных
+пользователей получают один общий ответ со списком спрашивавших.
+"""
+import asyncio
+import logging
+import re
+import time
+from collections import deque
+from dataclasses import dataclass, field
+from typing import Awaitable, Callable, Optional
+
+logger = logging.getLogger('QUEUE')
+
+_WORD_RE = re.compile(r"\w+", re.UNICODE)
+
+
+def question_tokens(text: str) -> frozenset[str]:
+    """Множество основ слов вопроса (первые 6 символов) для сравнения похожести."""
+    return frozenset(w[:6] for w in _WORD_RE.findall(text.lower()))
+
+
+def similarity(a: frozenset[str], b: frozenset[str]) -> float:
+    """Коэффициент Жаккара двух множеств слов."""
+    if not a and not b:
+        return 1.0
+    return len(a & b) / len(a | b)
+
+
+@dataclass
+class Asker:
+    """Автор вопроса и его сообщение (на него отправляется ответ)."""
+    user_id: int
+    name: str
+    question: str
+    message: object = None
+
+
+@dataclass
+class ChatJob:
+    """Вопрос в очереди чата; к нему присоединяются авторы похожих вопросов."""
+    question: str
+    tokens: frozenset[str]
+    askers: list[Asker]
+    replied: bool = False
+    done: asyncio.Event = field(default_factory=asyncio.Event)
+    prev: Optional["ChatJob"] = None
+
+
+@dataclass
+class ChatState:
+    """Очередь одного чата."""
+    pending: deque = field(default_factory=deque)
+    active: list = field(default_factory=list)
+    last_job: Optional[ChatJob] = None
+    last_mention: dict = field(default_factory=dict)
+
+
+class ChatWorkQueues:
+    """Очереди по чатам с лимитом параллельности, debounce и склейкой похожих вопросов.
+
+    answer(question) вычисляет ответ, send(job, text) отправляет его в чат.
+    submit() возвращает одно из: "queued", "collapsed", "debounced", "replaced", "rejected".
+    """
+
+    def __init__(
+        self,
+        answer: Callable[[str], Awaitable[str]],
+        send: Callable[[ChatJob, str], Awaitable[None]],
+        max_queue: int = 5,
+        max_in_flight: int = 1,
+        debounce_seconds: float = 10.0,
+        collapse_similarity: float = 0.8,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self.answer = answer
+        self.send = send
+        self.max_queue = max_queue
+        self.max_in_flight = max_in_flight
+        self.debounce_seconds = debounce_seconds
+        self.collapse_similarity = collapse_similarity
+        self._clock = clock
+        self._chats: dict[int, ChatState] = {}
+        self._tasks: set[asyncio.Task] = set()
+        self._last_sweep = clock()
+
+    def _find_similar(self, state: ChatState, tokens: frozenset[str]) -> Optional[ChatJob]:
+        for job in [*state.active, *state.pending]:
+            if not job.replied and similarity(job.tokens, tokens) >= self.collapse_similarity:
+                return job
+        return None
+
+    def submit(self, chat_id: int, asker: Asker) -> str:
+        """Ставит вопрос в очередь чата."""
+        now = self._clock()
+        if now - self._last_sweep >= self.debounce_seconds:
+            self._last_sweep = now
+            for cid, s in list(self._chats.items()):
+                self._forget_idle(cid, s)
+        state = self._chats.setdefault(chat_id, ChatState())
+        tokens = question_tokens(asker.question)
+
+        # окно debounce отсчитывается от принятого вопроса: отклонённый из-за переполнения
+        # не мешает спросить снова, а отброшенные повторы не продлевают окно
+        last = state.last_mention.get(asker.user_id)
+        if last is not None and now - last < self.debounce_seconds:
+            # пока вопрос ещё не начал обрабатываться, новое упоминание заменяет его (исправление опечатки)
+            for job in state.pending:
+                if len(job.askers) == 1 and job.askers[0].user_id == asker.user_id:
+                    job.question, job.tokens, job.askers[0] = asker.question, tokens, asker
+                    state.last_mention[asker.user_id] = now
+                    return "replaced"
+            return "debounced"
+
+        job = self._find_similar(state, tokens)
+        if job is not None:
+            job.askers.append(asker)
+            state.last_mention[asker.user_id] = now
+            return "collapsed"
+
+        if len(state.pending) >= self.max_queue:
+            logger.warning(f"Очередь чата {chat_id} переполнена ({len(state.pending)}), вопрос отклонён")
+            return "rejected"
+
+        job = ChatJob(question=asker.question, tokens=tokens, askers=[asker], prev=state.last_job)
+        state.last_mention[asker.user_id] = now
+        state.last_job = job
+        state.pending.append(job)
+        self._pump(chat_id, state)
+        return "queued"
+
+    def _pump(self, chat_id: int, state: ChatState) -> None:
+        while state.pending and len(state.active) < self.max_in_flight:
+            job = state.pending.popleft()
+            state.active.append(job)
+            task = asyncio.create_task(self._run(chat_id, state, job))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _run(self, chat_id: int, state: ChatState, job: ChatJob) -> None:
+        try:
+            try:
+                text = await self.answer(job.question)
+            except Exception as e:
+                logger.error(f"Ошибка ответа в чате {chat_id}: {type(e).__name__}: {e}")
+                text = "Произошла ошибка при обработке запроса. Попробуйте позже."
+            # ответы уходят в порядке вопросов, даже если более поздний посчитан раньше
+            if job.prev is not None:
+                await job.prev.done.wait()
+            job.replied = True
+            try:
+                await self.send(job, text)
+            except Exception as e:
+                logger.error(f"Ошибка отправки в чат {chat_id}: {type(e).__name__}: {e}")
+        finally:
+            job.prev = None
+            job.done.set()
+            state.active.remove(job)
+            if state.last_job is job:
+                state.last_job = None
+            self._pump(chat_id, state)
+            self._forget_idle(chat_id, state)
+
+    def _forget_idle(self, chat_id: int, state: ChatState) -> None:
+        """Удаляет состояние пустого чата, когда окно debounce для всех его пользователей истекло."""
+        if state.pending or state.active:
+            return
+        now = self._clock()
+        state.last_mention = {u: t for u, t in state.last_mention.items() if now - t < self.debounce_seconds}
+        if not state.last_mention:
+            self._chats.pop(chat_id, None)
+
+    def depths(self) -> dict[int, int]:
+        """Глубина очереди по чатам: ожидающие + обрабатываемые вопросы."""
+        return {
+            chat_id: len(s.pending) + len(s.active)
+            for chat_id, s in self._chats.items()
+            if s.pending or s.active
+        }
+
+    def get_stats(self) -> str:
+        depths = self.depths()
+        if not depths:
+            return "Очереди: пусто"
+        top = sorted(depths.items(), key=lambda x: -x[1])[:5]
+        return f"Очереди: {sum(depths.values())} в {len(depths)} чатах | " + ", ".join(f"{c}: {d}" for c, d in top)
+
+    async def drain(self) -> None:
+        """Ждёт завершения всех запущенных ответов."""
+        while self._tasks:
+            await asyncio.gather(*list(self._tasks), return_exceptions=True)
+
+
+def format_collapsed_reply(job: ChatJob, text: str) -> str:
+    """Ответ на склеенные вопросы: цитирует всех спрашивавших."""
+    if len(job.askers) == 1:
+        return text
+    quotes = "\n".join(f"> **{a.name}**: {a.question}" for a in job.askers)
+    return f"{quotes}\n\n{text}"
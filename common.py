@@ -1,14 +1,148 @@
 """Общие компоненты для ботов."""
+import atexit
+import base64
+import contextvars
+import hashlib
+import json
 import logging
-from datetime import datetime
+import logging.handlers
+import math
+import os
+import queue
+import random
+import threading
+import time
+import uuid
+from datetime import datetime, timedelta
+from typing import Callable, Iterable, Optional
 
 
-def setup_logging() -> tuple[logging.Logger, logging.Logger]:
-    """Настраивает и возвращает (main_logger, user_logger)."""
-    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+LOG_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+
+_correlation_id: contextvars.ContextVar[str] = contextvars.ContextVar("correlation_id", default="-")
+_listener: Optional[logging.handlers.QueueListener] = None
+
+
+def new_correlation_id(prefix: object = "") -> str:
+    """Создаёт и устанавливает ID запроса для текущего контекста (задачи asyncio)."""
+    cid = f"{prefix}-{uuid.uuid4().hex[:8]}" if prefix != "" else uuid.uuid4().hex[:12]
+    _correlation_id.set(cid)
+    return cid
+
+
+def get_correlation_id() -> str:
+    return _correlation_id.get()
+
+
+class CorrelationFilter(logging.Filter):
+    """Добавляет в запись correlation_id текущего запроса."""
+    
+    def filter(self, record: logging.LogRecord) -> bool:
+        record.correlation_id = _correlation_id.get()
+        return True
+
+
+class SamplingFilter(logging.Filter):
+    """Сэмплирует INFO/DEBUG записи; WARNING и выше проходят всегда.
+
+    Решение принимается по correlation_id, поэтому запрос логируется либо целиком, либо никак.
+    """
+    
+    def __init__(self, rate: float):
+        super().__init__()
+        self.rate = max(0.0, min(1.0, rate))
+    
+    def filter(self, record: logging.LogRecord) -> bool:
+        if self.rate >= 1.0 or record.levelno >= logging.WARNING:
+            return True
+        cid = _correlation_id.get()
+        if cid == "-":
+            return random.random() < self.rate
+        bucket = int.from_bytes(hashlib.blake2b(cid.encode("utf-8"), digest_size=4).digest(), "big")
+        return bucket / 0xFFFFFFFF < self.rate
+
+
+class JsonFormatter(logging.Formatter):
+    """Структурированный вывод: одна JSON-строка на запись."""
+    
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": datetime.fromtimestamp(record.created).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+            "correlation_id": getattr(record, "correlation_id", "-"),
+        }
+        if record.exc_info:
+            entry["exc_info"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False)
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler, который при переполнении очереди отбрасывает запись, а не блокирует цикл."""
+    
+    def __init__(self, q: queue.Queue):
+        super().__init__(q)
+        self.dropped = 0
+    
+    def enqueue(self, record: logging.LogRecord) -> None:
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+def _stop_listener() -> None:
+    """Останавливает фоновый QueueListener, дописав оставшиеся записи."""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+atexit.register(_stop_listener)
+
+
+def setup_logging(
+    queued: Optional[bool] = None,
+    json_format: Optional[bool] = None,
+    user_sample_rate: Optional[float] = None,
+    stream=None,
+) -> tuple[logging.Logger, logging.Logger]:
+    """Настраивает и возвращает (main_logger, user_logger).
+
+    По умолчанию параметры берутся из settings.logging. В режиме queued записи
+    кладутся в очередь, а пишет их в поток фоновый QueueListener.
+    """
+    from settings import settings
+    global _listener
+    
+    cfg = settings.logging
+    queued = cfg.queued if queued is None else queued
+    json_format = cfg.json_format if json_format is None else json_format
+    user_sample_rate = cfg.user_sample_rate if user_sample_rate is None else user_sample_rate
+    
+    _stop_listener()
+    
+    target = logging.StreamHandler(stream)
+    target.setFormatter(JsonFormatter() if json_format else logging.Formatter(LOG_FORMAT))
+    if queued:
+        handler = DroppingQueueHandler(queue.Queue(cfg.queue_size))
+        # prepare() подставляет отформатированный текст в msg — оставляем только сообщение
+        handler.setFormatter(logging.Formatter('%(message)s'))
+        _listener = logging.handlers.QueueListener(handler.queue, target, respect_handler_level=True)
+        _listener.start()
+    else:
+        handler = target
+    handler.addFilter(CorrelationFilter())
+    logging.basicConfig(level=logging.INFO, handlers=[handler], force=True)
     
     main_logger = logging.getLogger('MAIN')
     user_logger = logging.getLogger('USER')
+    for f in [f for f in user_logger.filters if isinstance(f, SamplingFilter)]:
+        user_logger.removeFilter(f)
+    if user_sample_rate < 1.0:
+        user_logger.addFilter(SamplingFilter(user_sample_rate))
     
     logging.getLogger('aiomax').setLevel(logging.WARNING)
     logging.getLogger('aiohttp').setLevel(logging.WARNING)
@@ -16,25 +150,268 @@ def setup_logging() -> tuple[logging.Logger, logging.Logger]:
     return main_logger, user_logger
 
 
+def answer_question(question: str, level: Optional[str] = None, tenant: Optional[str] = None, year: Optional[int] = None) -> str:
+    """Ленивый прокси к rag_bot_new.answer_question.
+
+    rag_bot_new тянет langchain, faiss и numpy, поэтому импортируется при первом
+    вопросе или заранее в фоне (startup.preload_in_background), а не при старте бота.
+    """
+    from rag_bot_new import answer_question as rag_answer_question
+    return rag_answer_question(question, level=level, tenant=tenant, year=year)
+
+
+def answer_in_session(
+    question: str,
+    session: Optional[dict],
+    level: Optional[str] = None,
+    on_late: Optional[Callable[[str, Optional[dict]], None]] = None,
+) -> tuple[str, Optional[dict]]:
+    """Ленивый прокси к rag_bot_new.answer_in_session (ответ с учётом предыдущего вопроса)."""
+    from rag_bot_new import answer_in_session as rag_answer_in_session
+    return rag_answer_in_session(question, session, level=level, on_late=on_late)
+
+
+class HyperLogLog:
+    """Скетч HyperLogLog: оценка числа уникальных элементов в фиксированной памяти.
+
+    Занимает 2**precision байт независимо от числа добавленных элементов.
+    Стандартная ошибка ≈ 1.04 / sqrt(2**precision) (≈1.6% при precision=12).
+    """
+    
+    def __init__(self, precision: int = 12, registers: Optional[bytes] = None):
+        if not 4 <= precision <= 16:
+            raise ValueError(f"precision должен быть в диапазоне 4..16, получено: {precision}")
+        self.precision = precision
+        self.size = 1 << precision
+        if registers is not None and len(registers) != self.size:
+            raise ValueError(f"Ожидалось {self.size} регистров, получено: {len(registers)}")
+        self.registers = bytearray(registers) if registers is not None else bytearray(self.size)
+    
+    @staticmethod
+    def _hash(item) -> int:
+        # blake2b, а не hash(): значения должны совпадать между перезапусками
+        digest = hashlib.blake2b(str(item).encode("utf-8"), digest_size=8).digest()
+        return int.from_bytes(digest, "big")
+    
+    def add(self, item) -> bool:
+        """Добавляет элемент. Возвращает True, если скетч изменился (элемент, вероятно, новый)."""
+        h = self._hash(item)
+        rest_bits = 64 - self.precision
+        idx = h >> rest_bits
+        rest = h & ((1 << rest_bits) - 1)
+        rank = rest_bits - rest.bit_length() + 1
+        if rank > self.registers[idx]:
+            self.registers[idx] = rank
+            return True
+        return False
+    
+    def merge(self, other: "HyperLogLog") -> "HyperLogLog":
+        """Объединяет другой скетч в текущий (оценка объединения множеств)."""
+        if other.precision != self.precision:
+            raise ValueError("Нельзя объединить скетчи с разной точностью")
+        self.registers = bytearray(map(max, self.registers, other.registers))
+        return self
+    
+    def count(self) -> int:
+        """Оценка числа уникальных элементов."""
+        m = self.size
+        alpha = 0.7213 / (1 + 1.079 / m)
+        estimate = alpha * m * m / sum(2.0 ** -r for r in self.registers)
+        zeros = self.registers.count(0)
+        if estimate <= 2.5 * m and zeros:
+            estimate = m * math.log(m / zeros)
+        return int(round(estimate))
+    
+    def to_base64(self) -> str:
+        return base64.b64encode(bytes(self.registers)).decode("ascii")
+    
+    @classmethod
+    def from_base64(cls, data: str, precision: int) -> "HyperLogLog":
+        return cls(precision, base64.b64decode(data))
+
+
 class UserTracker:
-    """Трекер уникальных пользователей за сессию."""
+    """Трекер уникальных пользователей с фиксированным потреблением памяти.
+
+    Вместо множества user_id хранит HyperLogLog-скетчи: общий и по корзинам
+    (час / день) × (все / уровень / тип чата). Старые корзины удаляются, число
+    значений каждого измерения ограничено, поэтому память не зависит от числа
+    пользователей. Состояние периодически сохраняется на диск в фоновом
+    потоке (add_user вызывается из event loop) и восстанавливается при старте.
+    """
+    
+    HOUR_FORMAT = "%Y-%m-%dT%H"
+    DAY_FORMAT = "%Y-%m-%d"
+    
+    def __init__(
+        self,
+        state_path: Optional[str] = None,
+        precision: int = 12,
+        persist_interval: float = 60.0,
+        hours_window: int = 48,
+        days_window: int = 30,
+        max_dimension_values: int = 8,
+        clock: Callable[[], datetime] = datetime.now,
+    ):
+        self.state_path = state_path
+        self.precision = precision
+        self.persist_interval = persist_interval
+        self.hours_window = hours_window
+        self.days_window = days_window
+        self.max_dimension_values = max_dimension_values
+        self._clock = clock
+        self.start_time: datetime = clock()
+        self._total = HyperLogLog(precision)
+        self._buckets: dict[tuple[str, str, str], HyperLogLog] = {}
+        self._dimensions: set[str] = set()
+        self._lock = threading.Lock()
+        self._save_lock = threading.Lock()  # снимок и запись файла — одна за раз, add_user их не ждёт
+        self._last_persist = time.monotonic()
+        self._save_thread: Optional[threading.Thread] = None
+        if state_path:
+            self.load()
+    
+    def _dimension(self, kind: str, value: Optional[str]) -> Optional[str]:
+        """Имя измерения с ограничением числа различных значений."""
+        if not value:
+            return None
+        dim = f"{kind}:{value}"
+        if dim not in self._dimensions:
+            known = sum(1 for d in self._dimensions if d.startswith(f"{kind}:"))
+            if known >= self.max_dimension_values:
+                dim = f"{kind}:other"
+            self._dimensions.add(dim)
+        return dim
+    
+    def _bucket(self, granularity: str, period: str, dim: str) -> HyperLogLog:
+        key = (granularity, period, dim)
+        sketch = self._buckets.get(key)
+        if sketch is None:
+            sketch = self._buckets[key] = HyperLogLog(self.precision)
+        return sketch
     
-    def __init__(self):
-        self.active_users: set[int] = set()
-        self.start_time: datetime = datetime.now()
+    def _prune(self, now: datetime) -> None:
+        hour_cutoff = (now - timedelta(hours=self.hours_window - 1)).strftime(self.HOUR_FORMAT)
+        day_cutoff = (now - timedelta(days=self.days_window - 1)).strftime(self.DAY_FORMAT)
+        for key in list(self._buckets):
+            granularity, period, _ = key
+            cutoff = hour_cutoff if granularity == "hour" else day_cutoff
+            if period < cutoff:
+                del self._buckets[key]
     
-    def add_user(self, user_id: int) -> bool:
-        """Регистрирует пользователя. Возвращает True если новый."""
-        is_new = user_id not in self.active_users
-        self.active_users.add(user_id)
+    def add_user(self, user_id: int, level: Optional[str] = None, chat_type: Optional[str] = None) -> bool:
+        """Регистрирует пользователя. Возвращает True если (вероятно) новый."""
+        now = self._clock()
+        with self._lock:
+            is_new = self._total.add(user_id)
+            dims = ["all", self._dimension("level", level), self._dimension("chat", chat_type)]
+            hour, day = now.strftime(self.HOUR_FORMAT), now.strftime(self.DAY_FORMAT)
+            for dim in filter(None, dims):
+                self._bucket("hour", hour, dim).add(user_id)
+                self._bucket("day", day, dim).add(user_id)
+            self._prune(now)
+            due = bool(self.state_path) and time.monotonic() - self._last_persist >= self.persist_interval
+            if due:
+                self._last_persist = time.monotonic()
+        if due:
+            self._save_thread = threading.Thread(target=self._save_in_background, name="stats-save", daemon=True)
+            self._save_thread.start()
         return is_new
     
+    def _save_in_background(self) -> None:
+        try:
+            self.save()
+        except OSError as e:
+            logging.getLogger('MAIN').warning(f"Не удалось сохранить статистику {self.state_path}: {e}")
+    
+    def _window(self, granularity: str, periods: Iterable[str], dim: str) -> int:
+        merged = HyperLogLog(self.precision)
+        for period in periods:
+            sketch = self._buckets.get((granularity, period, dim))
+            if sketch is not None:
+                merged.merge(sketch)
+        return merged.count()
+    
+    def _hours(self, now: datetime, n: int) -> list[str]:
+        return [(now - timedelta(hours=i)).strftime(self.HOUR_FORMAT) for i in range(n)]
+    
+    def _days(self, now: datetime, n: int) -> list[str]:
+        return [(now - timedelta(days=i)).strftime(self.DAY_FORMAT) for i in range(n)]
+    
     @property
     def count(self) -> int:
-        return len(self.active_users)
+        return self._total.count()
+    
+    def snapshot(self) -> dict:
+        """Скользящие окна уникальных пользователей: час, сутки, неделя и разбивки за сутки."""
+        now = self._clock()
+        with self._lock:
+            last_24h = self._hours(now, 24)
+            dims = sorted(self._dimensions)
+            by_level = {d.split(":", 1)[1]: self._window("hour", last_24h, d) for d in dims if d.startswith("level:")}
+            by_chat = {d.split(":", 1)[1]: self._window("hour", last_24h, d) for d in dims if d.startswith("chat:")}
+            return {
+                "total": self._total.count(),
+                "last_hour": self._window("hour", self._hours(now, 1), "all"),
+                "last_24h": self._window("hour", last_24h, "all"),
+                "last_7d": self._window("day", self._days(now, 7), "all"),
+                "by_level_24h": by_level,
+                "by_chat_type_24h": by_chat,
+            }
     
     def get_stats(self) -> str:
-        uptime = datetime.now() - self.start_time
+        snap = self.snapshot()
+        uptime = self._clock() - self.start_time
         h, rem = divmod(int(uptime.total_seconds()), 3600)
         m, _ = divmod(rem, 60)
-        return f"Пользователей: {self.count} | Uptime: {h}ч {m}м"
+        return (
+            f"Пользователей: {snap['total']} | 1ч: {snap['last_hour']} | 24ч: {snap['last_24h']} | "
+            f"7д: {snap['last_7d']} | Uptime: {h}ч {m}м"
+        )
+    
+    def save(self) -> None:
+        """Атомарно сохраняет скетчи в state_path."""
+        if not self.state_path:
+            return
+        # снимок берётся под _save_lock: более поздний снимок не затрётся более ранним
+        with self._save_lock:
+            with self._lock:
+                state = {
+                    "version": 1,
+                    "precision": self.precision,
+                    "total": self._total.to_base64(),
+                    "buckets": {"|".join(key): sketch.to_base64() for key, sketch in self._buckets.items()},
+                }
+                self._last_persist = time.monotonic()
+            directory = os.path.dirname(self.state_path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            tmp_path = f"{self.state_path}.tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(state, f)
+            os.replace(tmp_path, self.state_path)
+    
+    def load(self) -> bool:
+        """Восстанавливает скетчи из state_path. Возвращает True при успехе."""
+        if not self.state_path or not os.path.exists(self.state_path):
+            return False
+        try:
+            with open(self.state_path, encoding="utf-8") as f:
+                state = json.load(f)
+            if state.get("precision") != self.precision:
+                logging.getLogger('MAIN').warning(f"Статистика {self.state_path} с другой точностью, пропускаю")
+                return False
+            total = HyperLogLog.from_base64(state["total"], self.precision)
+            buckets = {
+                tuple(key.split("|", 2)): HyperLogLog.from_base64(data, self.precision)
+                for key, data in state.get("buckets", {}).items()
+            }
+        except (OSError, ValueError, KeyError) as e:
+            logging.getLogger('MAIN').warning(f"Не удалось загрузить статистику {self.state_path}: {e}")
+            return False
+        with self._lock:
+            self._total = total
+            self._buckets = buckets
+            self._dimensions = {d for _, _, d in buckets if d != "all"}
+            self._prune(self._clock())
+        return True
@@ -0,0 +1,71 @@
+"""Поиск сразу по индексам всех уровней для вопросов без выбранного уровня.
+
+Запрос эмбеддится один раз, индексы бакалавриата и магистратуры ищутся
+параллельно по этому вектору, результаты сливаются по расстоянию. Каждый чанк
+помечается уровнем (metadata['level']), чтобы в промпте было видно, к какому
+уровню относится факт. Отдельный общий индекс faiss_index для этого не нужен.
+
+Расстояния разных индексов сравнимы, если они собраны одной моделью эмбеддингов
+и без PCA (у каждого индекса своя проекция).
+"""
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+
+from langchain_core.documents import Document
+
+LEVEL_NAMES = {"bachelor": "Бакалавриат", "master": "Магистратура"}
+
+_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="cross-level")
+
+
+def tag_level(doc: Document, level: str) -> Document:
+    """Копия чанка с уровнем в метаданных (документы docstore не меняем)."""
+    return Document(page_content=doc.page_content, metadata={**doc.metadata, "level": level}, id=doc.id)
+
+
+class CrossLevelStore:
+    """Набор FAISS-хранилищ по уровням с интерфейсом, который нужен retrieve_context."""
+
+    def __init__(self, stores: dict[str, object]):
+        if not stores:
+            raise ValueError("Нужен хотя бы один индекс")
+        self.stores = stores
+
+    def similarity_search_with_score(self, query: str, k: int = 4) -> list[tuple[Document, float]]:
+        """Лучшие k чанков всех уровней по расстоянию; эмбеддинг запроса — один на все индексы."""
+        embedding = next(iter(self.stores.values())).embeddings.embed_query(query)
+        futures = {
+            level: _executor.submit(store.similarity_search_with_score_by_vector, embedding, k)
+            for level, store in self.stores.items()
+        }
+        merged = [(tag_level(doc, level), score) for level, future in futures.items() for doc, score in future.result()]
+        merged.sort(key=lambda pair: pair[1])
+        return merged[:k]
+
+    def get_by_ids(self, ids: list[str]) -> list[Document]:
+        """Чанки по id из любого уровня (для записей сессии), в порядке ids."""
+        found: dict[str, Document] = {}
+        for level, store in self.stores.items():
+            for doc in store.get_by_ids(ids):
+                found.setdefault(doc.id, tag_level(doc, level))
+        return [found[i] for i in ids if i in found]
+
+
+class CrossLevelRetriever:
+    """Retriever поверх CrossLevelStore: invoke(query) → k лучших чанков всех уровней."""
+
+    def __init__(self, stores: dict[str, object], k: int = 7):
+        self.vectorstore = CrossLevelStore(stores)
+        self.k = k
+
+    def invoke(self, query: str) -> list[Document]:
+        return [doc for doc, _ in self.vectorstore.similarity_search_with_score(query, self.k)]
+
+
+def format_context(docs: list[Document]) -> tuple[str, Optional[str]]:
+    """Текст контекста для промпта и указание модели, если чанки помечены уровнем."""
+    if not any("level" in d.metadata for d in docs):
+        return "\n".join(d.page_content for d in docs), None
+    blocks = [f"[{LEVEL_NAMES.get(d.metadata.get('level'), d.metadata.get('level', '—'))}] {d.page_content}" for d in docs]
+    note = "- Фрагменты помечены уровнем обучения: указывай, к бакалавриату или магистратуре относится каждый факт"
+    return "\n".join(blocks), note
@@ -0,0 +1,154 @@
+"""Отсев почти одинаковых чанков при сборке индекса (MinHash + LSH).
+
+В правилах приёма много повторов: одни и те же сроки и списки документов для
+разных программ. Такие чанки занимают место в индексе и вытесняют из выдачи
+поиска другие факты. NearDuplicateFilter оставляет первый чанк из группы
+похожих, а метаданные остальных дописывает в него:
+
+- ключи, которых у оставленного чанка нет, добавляются как есть;
+- отличающиеся значения (например, другой раздел) собираются в metadata['also'][ключ];
+- metadata['duplicates'] — сколько чанков слито в этот.
+
+Похожесть — коэффициент Жаккара по символьным 5-граммам нормализованного текста,
+оцениваемый по MinHash-сигнатуре (NUM_PERM хэшей). Кандидаты ищутся через LSH
+(BANDS полос по ROWS хэшей), затем сигнатуры сравниваются с порогом
+settings.rag.dedup_threshold. Сливаются только чанки с одинаковой
+последовательностью чисел: сроки и суммы правил приёма отличаются одной-двумя
+цифрами, и такие чанки похожи по 5-граммам, но дубликатами не являются.
+Хэши детерминированы: одна и та же сборка даёт один и тот же индекс. Памяти
+нужно ~1 КБ на оставленный чанк (сигнатура, числа и ключи полос).
+
+Слияние теряет текст дубликата, поэтому отсев выключен по умолчанию
+(settings.rag.dedup_threshold = 0), а каждое слияние попадает в merged() —
+setup_rag печатает его и пишет в манифест для проверки.
+"""
+import re
+from typing import Optional
+
+import numpy as np
+
+SHINGLE = 5
+NUM_PERM = 32
+BANDS = 8
+ROWS = NUM_PERM // BANDS
+_WORD_RE = re.compile(r"\w+", re.UNICODE)
+_NUMBER_RE = re.compile(r"\d+")
+_MASK = np.uint64(0xFFFFFFFF)
+
+_rng = np.random.default_rng(20250601)
+_PERM_A = _rng.integers(1, 2 ** 61, NUM_PERM, dtype=np.uint64) | np.uint64(1)
+_PERM_B = _rng.integers(0, 2 ** 61, NUM_PERM, dtype=np.uint64)
+_POWERS = np.array([pow(1000003, i, 2 ** 64) for i in range(SHINGLE)], dtype=np.uint64)
+
+
+def normalize(text: str) -> str:
+    """Нижний регистр, только слова через один пробел: различия в пунктуации и переносах не важны."""
+    return " ".join(_WORD_RE.findall(text.lower()))
+
+
+def numbers(text: str) -> tuple[str, ...]:
+    """Числа текста по порядку: даты, суммы и баллы, которые не должны теряться при слиянии."""
+    return tuple(_NUMBER_RE.findall(text))
+
+
+def shingle_hashes(text: str) -> np.ndarray:
+    """64-битные хэши символьных SHINGLE-грамм нормализованного текста."""
+    codes = np.frombuffer(normalize(text).encode("utf-32-le"), dtype=np.uint32).astype(np.uint64)
+    if len(codes) < SHINGLE:
+        codes = np.pad(codes, (0, SHINGLE - len(codes)))
+    windows = np.lib.stride_tricks.sliding_window_view(codes, SHINGLE)
+    return np.unique(windows @ _POWERS)  # переполнение uint64 — это и есть хэш по модулю 2^64
+
+
+def minhash(text: str) -> np.ndarray:
+    """MinHash-сигнатура: NUM_PERM минимумов хэшей вида (a·x + b) >> 32."""
+    hashes = shingle_hashes(text)
+    with np.errstate(over="ignore"):
+        permuted = (np.outer(_PERM_A, hashes) + _PERM_B[:, None]) >> np.uint64(32)
+    return (permuted.min(axis=1) & _MASK).astype(np.uint32)
+
+
+def similarity(a: np.ndarray, b: np.ndarray) -> float:
+    """Оценка коэффициента Жаккара по двум сигнатурам."""
+    return float(np.mean(a == b))
+
+
+def merge_metadata(kept: dict, duplicate: dict) -> None:
+    """Дописывает метаданные дубликата в метаданные оставленного чанка (на месте)."""
+    for key, value in duplicate.items():
+        if key in ("also", "duplicates"):
+            continue
+        if key not in kept:
+            kept[key] = value
+        elif kept[key] != value:
+            values = kept.setdefault("also", {}).setdefault(key, [])
+            if value not in values:
+                values.append(value)
+    kept["duplicates"] = kept.get("duplicates", 0) + 1
+
+
+class NearDuplicateFilter:
+    """Потоковый фильтр: check() решает по каждому чанку, оставить его или слить с уже оставленным."""
+
+    def __init__(self, threshold: float = 0.85):
+        if not 0 < threshold <= 1:
+            raise ValueError("threshold должен быть в (0, 1]")
+        self.threshold = threshold
+        self.seen = 0
+        self.dropped = 0
+        self._signatures: list[np.ndarray] = []
+        self._numbers: list[tuple[str, ...]] = []
+        self._metadata: list[dict] = []
+        self._ids: list[Optional[str]] = []
+        self._merges: list[tuple[int, str, dict]] = []
+        self._buckets: dict[tuple[int, bytes], list[int]] = {}
+
+    def check(self, text: str, metadata: dict) -> Optional[int]:
+        """Номер оставленного чанка, похожего на этот (метаданные уже слиты), или None — чанк новый.
+
+        Новый чанк запоминается; его метаданные — тот же объект metadata, пока не вызван attach().
+        """
+        self.seen += 1
+        signature = minhash(text)
+        digits = numbers(text)
+        keys = [(band, signature[band * ROWS:(band + 1) * ROWS].tobytes()) for band in range(BANDS)]
+        candidates = {i for key in keys for i in self._buckets.get(key, ()) if self._numbers[i] == digits}
+        best = max(candidates, key=lambda i: similarity(signature, self._signatures[i]), default=None)
+        if best is not None and similarity(signature, self._signatures[best]) >= self.threshold:
+            self.dropped += 1
+            self._merges.append((best, text, {k: v for k, v in metadata.items() if k not in ("also", "duplicates")}))
+            merge_metadata(self._metadata[best], metadata)
+            return best
+        number = len(self._signatures)
+        self._signatures.append(signature)
+        self._numbers.append(digits)
+        self._metadata.append(metadata)
+        self._ids.append(None)
+        for key in keys:
+            self._buckets.setdefault(key, []).append(number)
+        return None
+
+    def attach(self, first: int, metadatas: list[dict], ids: Optional[list[str]] = None) -> None:
+        """Связывает оставленные чанки first, first+1, … с их метаданными и id в docstore.
+
+        После добавления в индекс метаданные живут в Document.metadata — слияние с
+        более поздними дубликатами должно менять именно их.
+        """
+        for offset, metadata in enumerate(metadatas):
+            self._metadata[first + offset] = metadata
+            if ids is not None:
+                self._ids[first + offset] = ids[offset]
+
+    def merged(self, preview: int = 80) -> list[dict]:
+        """Слитые чанки: id оставленного (или его номер до attach), начало текста и метаданные дубликата."""
+        return [
+            {"into": self._ids[kept] or kept, "text": text[:preview], "metadata": metadata}
+            for kept, text, metadata in self._merges
+        ]
+
+    @property
+    def kept(self) -> int:
+        return len(self._signatures)
+
+    def stats(self) -> dict:
+        return {"chunks_in": self.seen, "duplicates_dropped": self.dropped, "dedup_threshold": self.threshold}
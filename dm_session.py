@@ -0,0 +1,153 @@
+"""Контекст диалога в ЛС для уточняющих вопросов.
+
+После ответа в FSM data пользователя кладётся компактная запись: последний вопрос,
+id найденных чанков и начало ответа. Уточнение вроде «а для целевого?» отвечается
+по тем же чанкам без нового эмбеддинга и поиска; если в них нет слов уточнения,
+контекст дополняется поиском по вопросу вместе с уточнением (см. rag_bot_new).
+
+Записи живут session_ttl секунд, а их суммарный размер по всем пользователям
+ограничен бюджетом: при превышении удаляются давно не обновлявшиеся.
+"""
+import json
+import re
+import time
+from collections import OrderedDict
+from typing import Callable, Iterable, Optional
+
+SESSION_KEY = "session"
+MAX_QUESTION_CHARS = 300
+MAX_SUMMARY_CHARS = 300
+
+# начала реплик, которые продолжают предыдущий вопрос
+FOLLOW_UP_PREFIXES = ("а ", "и ", "а,", "ну а", "то есть", "тогда", "ещё", "еще", "также", "а если", "что насчёт", "что насчет", "как насчёт", "как насчет")
+FOLLOW_UP_MAX_WORDS = 3
+
+_WORD_RE = re.compile(r"\w+", re.UNICODE)
+_SENTENCE_END_RE = re.compile(r"(?<=[.!?])\s")
+# служебные слова не участвуют в проверке «есть ли слова уточнения в контексте»
+_STOP_WORDS = frozenset(
+    "для как что где когда сколько если или это этого этом нужно можно есть там тоже также тогда потом "
+    "какие какой какая какое какого каких каком какую который которые".split()
+)
+
+
+def is_follow_up(question: str) -> bool:
+    """Похожа ли реплика на уточнение предыдущего вопроса.
+
+    Уточнение начинается с FOLLOW_UP_PREFIXES («а для целевого?») или коротко и без своих
+    значимых слов («а это когда?», «сколько?»). Короткий самостоятельный вопрос
+    («Какие вступительные испытания?») уточнением не считается.
+    """
+    text = question.strip().lower()
+    if text.startswith(FOLLOW_UP_PREFIXES):
+        return True
+    return len(_WORD_RE.findall(text)) <= FOLLOW_UP_MAX_WORDS and not content_stems(text)
+
+
+def content_stems(text: str) -> set[str]:
+    """Основы значимых слов (первые 6 символов слов от 4 букв)."""
+    return {w[:6] for w in _WORD_RE.findall(text.lower()) if len(w) >= 4 and w not in _STOP_WORDS}
+
+
+def covers(question: str, texts: Iterable[str]) -> bool:
+    """Встречаются ли все значимые слова вопроса в текстах чанков."""
+    needed = content_stems(question)
+    if not needed:
+        return True
+    found = set()
+    for text in texts:
+        found |= needed & {w[:6] for w in _WORD_RE.findall(text.lower())}
+        if found == needed:
+            return True
+    return False
+
+
+def summarize(answer: str, limit: int = MAX_SUMMARY_CHARS) -> str:
+    """Начало ответа до limit символов по границе предложения."""
+    answer = " ".join(answer.split())
+    if len(answer) <= limit:
+        return answer
+    cut = answer[:limit]
+    ends = [m.start() for m in _SENTENCE_END_RE.finditer(cut)]
+    return cut[:ends[-1]] if ends else cut.rsplit(" ", 1)[0] + "…"
+
+
+def make_record(question: str, chunk_ids: list[str], answer: str, level: Optional[str], now: float) -> dict:
+    """Компактная запись сессии для FSM data."""
+    return {
+        "q": question[:MAX_QUESTION_CHARS],
+        "ids": list(chunk_ids),
+        "a": summarize(answer),
+        "level": level,
+        "ts": now,
+    }
+
+
+def record_size(record: dict) -> int:
+    return len(json.dumps(record, ensure_ascii=False).encode("utf-8"))
+
+
+class DialogSessions:
+    """Записи сессий в FSM data пользователей с TTL и общим бюджетом памяти.
+
+    Сами записи хранятся в FSM-хранилище бота (cursor.storage), здесь — только
+    их размеры в порядке обновления, чтобы вытеснять давние.
+    """
+
+    def __init__(self, ttl: float = 900.0, memory_budget: int = 4 << 20, clock: Callable[[], float] = time.time):
+        self.ttl = ttl
+        self.memory_budget = memory_budget
+        self._clock = clock
+        self._entries: OrderedDict[int, tuple[object, int, float]] = OrderedDict()  # user_id → (storage, размер, ts)
+        self._used = 0
+
+    def get(self, cursor, level: Optional[str]) -> Optional[dict]:
+        """Запись сессии пользователя, если она свежая и для того же уровня."""
+        data = cursor.get_data() or {}
+        record = data.get(SESSION_KEY)
+        if record is None:
+            self._forget(cursor.user_id)
+            return None
+        if self._clock() - record.get("ts", 0) > self.ttl or record.get("level") != level:
+            self.drop(cursor)
+            return None
+        return record
+
+    def put(self, cursor, record: dict) -> None:
+        """Сохраняет запись в FSM data и вытесняет давние записи сверх бюджета."""
+        data = dict(cursor.get_data() or {})
+        data[SESSION_KEY] = record
+        cursor.change_data(data)
+        self._forget(cursor.user_id)
+        size = record_size(record)
+        self._entries[cursor.user_id] = (cursor.storage, size, record["ts"])
+        self._used += size
+        self._sweep()
+
+    def drop(self, cursor) -> None:
+        data = cursor.get_data()
+        if data and SESSION_KEY in data:
+            cursor.change_data({k: v for k, v in data.items() if k != SESSION_KEY})
+        self._forget(cursor.user_id)
+
+    def _forget(self, user_id: int) -> None:
+        entry = self._entries.pop(user_id, None)
+        if entry is not None:
+            self._used -= entry[1]
+
+    def _sweep(self) -> None:
+        now = self._clock()
+        while self._entries:
+            user_id, (storage, _, ts) = next(iter(self._entries.items()))
+            if now - ts <= self.ttl and self._used <= self.memory_budget:
+                return
+            self._forget(user_id)
+            data = storage.get_data(user_id)
+            if data and data.get(SESSION_KEY, {}).get("ts") == ts:
+                storage.change_data(user_id, {k: v for k, v in data.items() if k != SESSION_KEY})
+
+    def memory_used(self) -> int:
+        return self._used
+
+    def __len__(self) -> int:
+        return len(self._entries)
@@ -0,0 +1,362 @@
+"""Извлечение текста из документов (PDF, Markdown, HTML) для setup_rag.py.
+
+Файлы разбираются в пуле процессов (setup_rag.py --jobs N); большой PDF делится
+на диапазоны страниц, которые разбираются параллельно и склеиваются в порядке
+страниц, поэтому --jobs ускоряет и корпус из одного документа. Каждая запись несёт
+метаданные file/page/section. Готовые чанки и их эмбеддинги кешируются в папке
+индекса по хэшу содержимого файла: неизменившиеся файлы при следующей сборке не
+разбираются и не эмбеддятся заново.
+
+Модуль не импортирует LangChain, чтобы рабочие процессы пула стартовали быстро.
+"""
+import glob
+import hashlib
+import json
+import logging
+import math
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, field
+from html.parser import HTMLParser
+from pathlib import Path
+from typing import Iterable, Iterator, Optional
+
+import numpy as np
+
+logger = logging.getLogger('INGEST')
+
+SUPPORTED_SUFFIXES = {".pdf": "pdf", ".md": "markdown", ".markdown": "markdown", ".html": "html", ".htm": "html"}
+CACHE_DIR = ".ingest-cache"
+# PDF длиннее этого режется на диапазоны страниц для разных процессов пула
+PDF_PAGES_PER_TASK = 16
+
+
+def iter_markdown_entries(lines: Iterable[str], default_source: str, max_section_chars: int = 1 << 20) -> Iterator[dict]:
+    """Потоково разбивает Markdown на записи вида {text, source, section}.
+
+    Заголовки #, ##, ### формируют иерархию; в метаданные кладём 'section' как путь "H1 > H2 > H3".
+    Текст каждой секции будет дополнен заголовочным путём в начале, чтобы сохранить контекст при разбиении.
+    Секция длиннее max_section_chars отдаётся несколькими записями с тем же путём.
+    """
+    heading_stack: list[tuple[int, str]] = []  # (level, title)
+    current_buf: list[str] = []
+    buffered = 0
+
+    def heading_path() -> str:
+        return " > ".join(title for _, title in heading_stack)
+
+    def flush_section() -> Optional[dict]:
+        section_text = "\n".join(current_buf).strip()
+        if not section_text:
+            return None
+        path = heading_path()
+        prefix = (path + "\n\n") if path else ""
+        entry = {"text": prefix + section_text, "source": default_source}
+        if path:
+            entry["section"] = path
+        return entry
+
+    for raw in lines:
+        line = raw.rstrip()
+        # Определяем заголовок: начиная с #
+        if line.lstrip().startswith("#"):
+            # Считаем уровень
+            stripped = line.lstrip()
+            i = 0
+            while i < len(stripped) and stripped[i] == '#':
+                i += 1
+            level = i  # 1..6
+            title = stripped[i:].strip(" #\t")
+            # Сбрасываем предыдущую секцию
+            if entry := flush_section():
+                yield entry
+            current_buf, buffered = [], 0
+            # Обновляем стек заголовков
+            while heading_stack and heading_stack[-1][0] >= level:
+                heading_stack.pop()
+            heading_stack.append((level, title))
+        else:
+            current_buf.append(line)
+            buffered += len(line) + 1
+            if buffered >= max_section_chars:
+                if entry := flush_section():
+                    yield entry
+                current_buf, buffered = [], 0
+
+    if entry := flush_section():
+        yield entry
+
+
+class _HTMLToMarkdown(HTMLParser):
+    """Сводит HTML к строкам Markdown: заголовки h1–h6 → #, блоки → отдельные строки."""
+
+    BLOCK_TAGS = {"p", "div", "li", "tr", "br", "section", "article", "table", "ul", "ol", "blockquote", "pre"}
+    SKIP_TAGS = {"script", "style", "head", "noscript", "template"}
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.lines: list[str] = []
+        self._buf: list[str] = []
+        self._skip = 0
+        self._heading = 0
+
+    def _flush(self) -> None:
+        text = " ".join("".join(self._buf).split())
+        self._buf = []
+        if text:
+            self.lines.append(("#" * self._heading + " " if self._heading else "") + text)
+
+    def handle_starttag(self, tag, attrs):
+        if tag in self.SKIP_TAGS:
+            self._skip += 1
+        elif len(tag) == 2 and tag[0] == "h" and tag[1] in "123456":
+            self._flush()
+            self._heading = int(tag[1])
+        elif tag in self.BLOCK_TAGS:
+            self._flush()
+
+    def handle_endtag(self, tag):
+        if tag in self.SKIP_TAGS:
+            self._skip = max(0, self._skip - 1)
+        elif len(tag) == 2 and tag[0] == "h" and tag[1] in "123456":
+            self._flush()
+            self._heading = 0
+        elif tag in self.BLOCK_TAGS:
+            self._flush()
+
+    def handle_data(self, data):
+        if not self._skip:
+            # «#» в начале обычного абзаца не должен стать заголовком
+            self._buf.append(data if self._buf or self._heading else data.lstrip().lstrip("#"))
+
+    def close(self):
+        super().close()
+        self._flush()
+
+
+def html_to_markdown_lines(html: str) -> list[str]:
+    parser = _HTMLToMarkdown()
+    parser.feed(html)
+    parser.close()
+    return parser.lines
+
+
+def _pdf_outline(reader) -> list[tuple[int, str]]:
+    """Закладки PDF: (номер страницы с 1, путь "Раздел > Подраздел"), по возрастанию страниц."""
+    marks: list[tuple[int, str]] = []
+
+    def walk(items, parents: list[str]) -> None:
+        title = None
+        for item in items:
+            if isinstance(item, list):
+                walk(item, parents + ([title] if title else []))
+                continue
+            title = str(item.title).strip()
+            try:
+                page = reader.get_destination_page_number(item)
+            except Exception:
+                continue
+            if page is not None and page >= 0:
+                marks.append((page + 1, " > ".join(parents + [title])))
+
+    try:
+        walk(reader.outline, [])
+    except Exception as e:
+        logger.debug(f"Не удалось прочитать закладки PDF: {type(e).__name__}: {e}")
+    return sorted(marks, key=lambda m: m[0])
+
+
+def _pdf_reader(path: Path):
+    try:
+        from pypdf import PdfReader
+    except ImportError as e:
+        raise RuntimeError("Для разбора PDF нужен пакет pypdf: pip install pypdf") from e
+    return PdfReader(str(path))
+
+
+def pdf_page_count(path: Path) -> int:
+    return len(_pdf_reader(path).pages)
+
+
+def extract_pdf(path: Path, default_source: str, pages: Optional[tuple[int, int]] = None) -> tuple[list[dict], int]:
+    """Записи по страницам PDF (metadata: page, section из закладок). Возвращает (записи, число страниц).
+
+    pages — диапазон (первая, последняя) с 1 включительно; по умолчанию весь файл.
+    """
+    reader = _pdf_reader(path)
+    outline = _pdf_outline(reader)
+    first, last = pages or (1, len(reader.pages))
+    last = min(last, len(reader.pages))
+    entries = []
+    for number in range(first, last + 1):
+        text = (reader.pages[number - 1].extract_text() or "").strip()
+        if not text:
+            continue
+        entry = {"text": text, "source": default_source, "metadata": {"page": number}}
+        section = next((title for start, title in reversed(outline) if start <= number), None)
+        if section:
+            entry["section"] = section
+        entries.append(entry)
+    return entries, max(0, last - first + 1)
+
+
+@dataclass
+class Extracted:
+    """Результат разбора одного файла (передаётся из рабочего процесса)."""
+    path: str
+    pages: int = 0
+    entries: list = field(default_factory=list)
+    seconds: float = 0.0
+    error: Optional[str] = None
+
+
+def extract_file(path: str, default_source: str, pages: Optional[tuple[int, int]] = None) -> Extracted:
+    """Разбирает файл по расширению (PDF — только страницы pages); ошибка разбора возвращается в поле error."""
+    started = time.perf_counter()
+    file = Path(path)
+    try:
+        kind = SUPPORTED_SUFFIXES.get(file.suffix.lower())
+        if kind == "pdf":
+            entries, pages = extract_pdf(file, default_source, pages)
+        elif kind == "markdown":
+            with open(file, encoding="utf-8") as f:
+                entries, pages = list(iter_markdown_entries(f, default_source)), 1
+        elif kind == "html":
+            lines = html_to_markdown_lines(file.read_text(encoding="utf-8", errors="replace"))
+            entries, pages = list(iter_markdown_entries(lines, default_source)), 1
+        else:
+            raise ValueError(f"Неподдерживаемый формат: {file.suffix}")
+    except Exception as e:
+        return Extracted(path, error=f"{type(e).__name__}: {e}", seconds=time.perf_counter() - started)
+    for entry in entries:
+        entry.setdefault("metadata", {})["file"] = file.name
+    return Extracted(path, pages, entries, time.perf_counter() - started)
+
+
+def _extract_job(job: tuple) -> Extracted:
+    return extract_file(*job)
+
+
+def _page_ranges(path: Path, jobs: int, pages_per_task: int) -> list[Optional[tuple[int, int]]]:
+    """Диапазоны страниц PDF для отдельных задач пула; [None] — файл разбирается целиком."""
+    if path.suffix.lower() != ".pdf":
+        return [None]
+    try:
+        total = pdf_page_count(path)
+    except Exception:
+        return [None]  # ошибку покажет разбор файла целиком
+    if total <= pages_per_task:
+        return [None]
+    step = max(pages_per_task, math.ceil(total / jobs))
+    return [(first, min(first + step - 1, total)) for first in range(1, total + 1, step)]
+
+
+def _merge_parts(parts: list[Extracted]) -> Extracted:
+    """Склеивает диапазоны страниц одного PDF в порядке страниц."""
+    if len(parts) == 1:
+        return parts[0]
+    error = next((part.error for part in parts if part.error), None)
+    return Extracted(
+        parts[0].path,
+        pages=sum(part.pages for part in parts) if error is None else 0,
+        entries=[entry for part in parts for entry in part.entries] if error is None else [],
+        seconds=sum(part.seconds for part in parts),
+        error=error,
+    )
+
+
+def extract_files(paths: list[Path], default_source: str, jobs: int = 1, pages_per_task: int = PDF_PAGES_PER_TASK) -> Iterator[Extracted]:
+    """Разбирает файлы в jobs процессах; результаты отдаются в порядке paths по мере готовности.
+
+    PDF длиннее pages_per_task страниц делится на диапазоны (не меньше pages_per_task страниц,
+    не больше jobs штук), результат по файлу — один Extracted со страницами по порядку.
+    """
+    if jobs <= 1:
+        yield from (extract_file(str(p), default_source) for p in paths)
+        return
+    work, owners = [], []
+    for index, path in enumerate(paths):
+        for pages in _page_ranges(Path(path), jobs, pages_per_task):
+            work.append((str(path), default_source, pages))
+            owners.append(index)
+    if len(work) <= 1:
+        yield from map(_extract_job, work)
+        return
+    with ProcessPoolExecutor(max_workers=min(jobs, len(work))) as pool:
+        parts: list[Extracted] = []
+        # pool.map отдаёт результаты в порядке work: части одного файла идут подряд
+        for position, part in enumerate(pool.map(_extract_job, work)):
+            parts.append(part)
+            if position + 1 == len(work) or owners[position + 1] != owners[position]:
+                yield _merge_parts(parts)
+                parts = []
+
+
+def discover_files(patterns: Iterable[str]) -> list[Path]:
+    """Поддерживаемые файлы по списку папок (рекурсивно), glob-шаблонов и путей."""
+    found: set[Path] = set()
+    for pattern in patterns:
+        path = Path(pattern)
+        if path.is_dir():
+            candidates = (p for p in path.rglob("*") if p.is_file())
+        else:
+            candidates = (Path(p) for p in glob.glob(str(pattern), recursive=True) if os.path.isfile(p))
+        found.update(p for p in candidates if p.suffix.lower() in SUPPORTED_SUFFIXES)
+    return sorted(found)
+
+
+def file_digest(path: Path) -> str:
+    """SHA-256 содержимого файла."""
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+class IngestCache:
+    """Кеш чанков и эмбеддингов по файлам: <ключ>.json (чанки) + <ключ>.npy (векторы).
+
+    Ключ — хэш содержимого файла, его имени и модели эмбеддингов, поэтому
+    изменившийся файл или другая модель просто не найдут старую запись.
+    """
+
+    def __init__(self, cache_dir: Path, model: str):
+        self.cache_dir = Path(cache_dir)
+        self.model = model
+
+    def key(self, path: Path) -> str:
+        return hashlib.sha256(f"{self.model}|{Path(path).name}|{file_digest(path)}".encode("utf-8")).hexdigest()[:32]
+
+    def has(self, key: str) -> bool:
+        return (self.cache_dir / f"{key}.json").exists() and (self.cache_dir / f"{key}.npy").exists()
+
+    def load(self, key: str) -> tuple[list[tuple[str, dict]], np.ndarray, int]:
+        """(чанки, векторы, число страниц)."""
+        with open(self.cache_dir / f"{key}.json", encoding="utf-8") as f:
+            data = json.load(f)
+        vectors = np.load(self.cache_dir / f"{key}.npy")
+        return [(text, meta) for text, meta in data["chunks"]], vectors, data["pages"]
+
+    def save(self, key: str, chunks: list[tuple[str, dict]], vectors: np.ndarray, pages: int) -> None:
+        """Пишет запись атомарно: сначала векторы, последним — json (по нему has())."""
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        tmp = self.cache_dir / f"{key}.tmp.npy"
+        np.save(tmp, np.asarray(vectors, dtype="float32"))
+        os.replace(tmp, self.cache_dir / f"{key}.npy")
+        tmp = self.cache_dir / f"{key}.json.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump({"pages": pages, "chunks": chunks}, f, ensure_ascii=False)
+        os.replace(tmp, self.cache_dir / f"{key}.json")
+
+    def prune(self, keep: set[str]) -> int:
+        """Удаляет записи файлов, которых больше нет среди источников. Возвращает число удалённых."""
+        if not self.cache_dir.exists():
+            return 0
+        removed = 0
+        for entry in self.cache_dir.iterdir():
+            if entry.name.split(".", 1)[0] not in keep:
+                entry.unlink(missing_ok=True)
+                removed += entry.suffix == ".json"
+        return removed
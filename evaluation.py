@@ -0,0 +1,272 @@
+"""evaluation.py
+
+Оценка качества и скорости поиска и ответов для разных конфигураций settings.rag.
+
+Вопросы — размеченный золотой набор data/golden.json и вопросы data/faq.json
+(без разметки: по ним считаются только задержка, токены и доля «нет информации»).
+Всё работает офлайн через fake_openai: тексты индексов переэмбеждены
+детерминированными эмбеддингами, поэтому метрики поиска воспроизводимы, а
+задержка отражает код пайплайна, а не сеть.
+
+Элемент золотого набора: {"question", "level", "sections" | "phrases"} — чанк
+релевантен, если его metadata['section'] начинается с одного из sections или
+текст содержит одну из phrases. "answerable": false — вопрос, ответа на который
+в правилах нет: по нему считается, как часто бот честно отвечает «нет информации».
+
+Конфигурация — имя и поля settings.rag, например:
+    python evaluation.py --config baseline --config "k5:retriever_k=5" \\
+        --config "adaptive:adaptive_retrieval=1,retriever_max_distance=1.8,retriever_score_gap=0.15"
+Отчёт пишется в JSON (--output). С --baseline прошлый отчёт сравнивается с
+текущим: если recall@k, hit@k или MRR упали (а доля «нет информации» выросла)
+больше чем на --max-drop, скрипт завершается с кодом 1.
+"""
+
+import argparse
+import dataclasses
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+from datetime import datetime
+from typing import Optional
+
+GOLDEN_PATH = os.path.join("data", "golden.json")
+FAQ_PATH = os.path.join("data", "faq.json")
+QUALITY_METRICS = ("recall_at_k", "hit_at_k", "mrr")
+
+
+def load_golden(path: str = GOLDEN_PATH) -> list[dict]:
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)
+
+
+def load_faq_questions(path: str = FAQ_PATH) -> list[dict]:
+    """Вопросы FAQ с уровнем ([], если файла нет)."""
+    if not os.path.exists(path):
+        return []
+    with open(path, encoding="utf-8") as f:
+        faq = json.load(f)
+    return [{"question": item["question"], "level": level} for level, items in faq.items() for item in items.values()]
+
+
+def parse_config(spec: str) -> tuple[str, dict]:
+    """"имя:поле=значение,поле=значение" → (имя, поля settings.rag с приведёнными типами)."""
+    from settings import settings
+
+    name, _, assignments = spec.partition(":")
+    fields = {f.name: f for f in dataclasses.fields(settings.rag)}
+    overrides = {}
+    for assignment in filter(None, assignments.split(",")):
+        key, _, raw = assignment.partition("=")
+        key = key.strip()
+        if key not in fields:
+            raise ValueError(f"Неизвестное поле settings.rag: {key}")
+        current = getattr(settings.rag, key)
+        if isinstance(current, bool):
+            overrides[key] = raw.strip().lower() in ("1", "true", "yes", "on")
+        elif isinstance(current, (int, float)):
+            overrides[key] = type(current)(raw)
+        else:
+            overrides[key] = raw.strip()
+    return name.strip(), overrides
+
+
+def is_relevant(doc, item: dict) -> bool:
+    """Раздел чанка (или слитого в него дубликата, см. dedup.py) или его текст совпадает с разметкой."""
+    sections = [doc.metadata.get("section"), *(doc.metadata.get("also") or {}).get("section", [])]
+    sections = [" ".join((section or "").split()) for section in sections]
+    if any(section.startswith(prefix) for section in sections for prefix in item.get("sections", [])):
+        return True
+    text = doc.page_content.lower()
+    return any(phrase.lower() in text for phrase in item.get("phrases", []))
+
+
+def rank_metrics(docs: list, item: dict, relevant_total: int) -> dict:
+    """hit, recall и reciprocal rank для найденных чанков."""
+    ranks = [i for i, doc in enumerate(docs, 1) if is_relevant(doc, item)]
+    return {
+        "first_relevant_rank": ranks[0] if ranks else None,
+        "hit": bool(ranks),
+        "recall": len(ranks) / relevant_total if relevant_total else 0.0,
+        "rr": 1 / ranks[0] if ranks else 0.0,
+    }
+
+
+def _percentile(values: list[float], p: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(p / 100 * (len(ordered) - 1))))] if ordered else 0.0
+
+
+def evaluate_config(name: str, overrides: dict, golden: list[dict], faq: list[dict], stores: dict) -> dict:
+    """Метрики одной конфигурации. stores — {путь индекса: FAISS} на эмбеддингах fake_openai."""
+    import rag_bot_new
+    from fake_openai import count_tokens
+    from resilience import track_usage
+
+    base = rag_bot_new.settings
+    cfg = dataclasses.replace(base.rag, **overrides)
+    rag_bot_new.settings = dataclasses.replace(base, rag=cfg)
+    k = cfg.retriever_max_k if cfg.adaptive_retrieval else cfg.retriever_k
+    retrievers = {
+        level: stores[path].as_retriever(search_kwargs={"k": cfg.retriever_k})
+        for level, path in (("bachelor", cfg.bachelor_index_dir), ("master", cfg.master_index_dir))
+    }
+    rag_bot_new.RAGEngine.get_retriever = classmethod(lambda cls, level=None, *a, **kw: retrievers[level or "master"])
+    rows = []
+    try:
+        for item in [*golden, *faq]:
+            level = item.get("level") or "master"
+            docs = rag_bot_new.search(retrievers[level], item["question"])
+            row = {"question": item["question"], "level": level, "chunks": len(docs)}
+            row["context_tokens"] = count_tokens("\n".join(d.page_content for d in docs)) if docs else 0
+            if "sections" in item or "phrases" in item:
+                relevant = sum(is_relevant(d, item) for d in stores[getattr(cfg, f"{level}_index_dir")].docstore._dict.values())
+                row.update(rank_metrics(docs, item, relevant))
+            start = time.perf_counter()
+            with track_usage() as usage:
+                answer, _ = rag_bot_new.answer_in_session(item["question"], None, level)
+            row["latency_ms"] = round((time.perf_counter() - start) * 1000, 2)
+            row["prompt_tokens"] = usage["prompt_tokens"]
+            row["no_info"] = answer == rag_bot_new.NO_INFO_REPLY
+            if item.get("answerable") is False:
+                row["answerable"] = False
+            rows.append(row)
+    finally:
+        rag_bot_new.settings = base
+
+    labelled = [r for r in rows if "hit" in r]
+    answerable = [r for r in rows if r.get("answerable") is not False]
+    unanswerable = [r for r in rows if r.get("answerable") is False]
+    latencies = [r["latency_ms"] for r in rows]
+    metrics = {
+        "k": k,
+        "recall_at_k": statistics.mean(r["recall"] for r in labelled) if labelled else None,
+        "hit_at_k": statistics.mean(r["hit"] for r in labelled) if labelled else None,
+        "mrr": statistics.mean(r["rr"] for r in labelled) if labelled else None,
+        "chunks": statistics.mean(r["chunks"] for r in rows),
+        "context_tokens": statistics.mean(r["context_tokens"] for r in rows),
+        "prompt_tokens": statistics.mean(r["prompt_tokens"] for r in rows),
+        "latency_p50_ms": statistics.median(latencies),
+        "latency_p95_ms": _percentile(latencies, 95),
+        "no_info_rate": statistics.mean(r["no_info"] for r in answerable) if answerable else None,
+        "unanswerable_no_info": statistics.mean(r["no_info"] for r in unanswerable) if unanswerable else None,
+    }
+    return {"name": name, "overrides": overrides, "metrics": metrics, "questions": rows}
+
+
+def _commit() -> Optional[str]:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def evaluate(configs: list[tuple[str, dict]], golden: list[dict], faq: list[dict], latency: float = 0.0, embedding_latency: float = 0.0) -> dict:
+    """Прогоняет конфигурации на фейковом сервере и собирает отчёт."""
+    import rag_bot_new
+    from benchmarks import fake_store, use_fake_llm
+    from fake_openai import FakeOpenAIServer
+
+    engine = rag_bot_new.RAGEngine
+    saved = {name: engine.__dict__[name] for name in ("get_retriever", "_llm", "_chat_model")}
+    results = []
+    with FakeOpenAIServer(latency=latency, embedding_latency=embedding_latency) as server:
+        use_fake_llm(server.base_url)
+        stores: dict = {}
+        try:
+            for _, overrides in configs:
+                cfg = dataclasses.replace(rag_bot_new.settings.rag, **overrides)
+                for path in (cfg.bachelor_index_dir, cfg.master_index_dir):
+                    if path not in stores:
+                        stores[path] = fake_store(server.base_url, path)
+            for item in [*golden, *faq]:  # проверка тематики кешируется: в замеры попадает только ответ
+                rag_bot_new.is_admission_related_smart(item["question"])
+            for name, overrides in configs:
+                results.append(evaluate_config(name, overrides, golden, faq, stores))
+        finally:
+            for name, value in saved.items():
+                setattr(engine, name, value)
+    return {
+        "created": datetime.now().isoformat(timespec="seconds"),
+        "commit": _commit(),
+        "questions": {"golden": len(golden), "faq": len(faq)},
+        "fake_server": {"latency": latency, "embedding_latency": embedding_latency},
+        "configs": results,
+    }
+
+
+def compare(report: dict, baseline: dict, max_drop: float = 0.02) -> list[str]:
+    """Ухудшения качества относительно baseline (по конфигурациям с одинаковыми именами)."""
+    previous = {c["name"]: c["metrics"] for c in baseline.get("configs", [])}
+    regressions = []
+    for config in report["configs"]:
+        old = previous.get(config["name"])
+        if old is None:
+            continue
+        new = config["metrics"]
+        for metric in QUALITY_METRICS:
+            if old.get(metric) is not None and new.get(metric) is not None and old[metric] - new[metric] > max_drop:
+                regressions.append(f"{config['name']}: {metric} {old[metric]:.3f} → {new[metric]:.3f}")
+        if old.get("no_info_rate") is not None and new.get("no_info_rate") is not None and new["no_info_rate"] - old["no_info_rate"] > max_drop:
+            regressions.append(f"{config['name']}: no_info_rate {old['no_info_rate']:.3f} → {new['no_info_rate']:.3f}")
+    return regressions
+
+
+def print_report(report: dict, baseline: Optional[dict] = None) -> None:
+    from benchmarks import print_table
+
+    previous = {c["name"]: c["metrics"] for c in (baseline or {}).get("configs", [])}
+
+    def cell(name: str, metric: str, fmt: str) -> str:
+        value = next(c["metrics"][metric] for c in report["configs"] if c["name"] == name)
+        if value is None:
+            return "—"
+        text = format(value, fmt)
+        old = previous.get(name, {}).get(metric)
+        return f"{text} ({value - old:+{fmt}})" if old is not None else text
+
+    rows = [[
+        c["name"], c["metrics"]["k"], cell(c["name"], "recall_at_k", ".3f"), cell(c["name"], "hit_at_k", ".3f"),
+        cell(c["name"], "mrr", ".3f"), cell(c["name"], "context_tokens", ".0f"), cell(c["name"], "latency_p50_ms", ".1f"),
+        cell(c["name"], "latency_p95_ms", ".1f"), cell(c["name"], "no_info_rate", ".2f"), cell(c["name"], "unanswerable_no_info", ".2f"),
+    ] for c in report["configs"]]
+    counts = report["questions"]
+    print(f"\nВопросов: {counts['golden']} в золотом наборе, {counts['faq']} из FAQ\n")
+    print_table(["конфигурация", "k", "recall@k", "hit@k", "MRR", "токенов контекста", "p50, мс", "p95, мс", "нет инфо", "нет инфо (вне базы)"], rows)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Оценка качества и задержки поиска и ответов (офлайн, fake_openai)")
+    parser.add_argument("--config", action="append", default=None, help='Конфигурация "имя:поле=значение,..." (можно несколько)')
+    parser.add_argument("--golden", default=GOLDEN_PATH, help="Золотой набор вопросов")
+    parser.add_argument("--faq", default=FAQ_PATH, help="FAQ (вопросы без разметки)")
+    parser.add_argument("--output", "-o", default="eval_report.json", help="JSON-отчёт")
+    parser.add_argument("--baseline", default=None, help="Прошлый отчёт для сравнения")
+    parser.add_argument("--max-drop", type=float, default=0.02, help="Допустимое ухудшение метрик качества")
+    parser.add_argument("--latency", type=float, default=0.0, help="Задержка ответа LLM (сек)")
+    parser.add_argument("--embedding-latency", type=float, default=0.0, help="Задержка эмбеддингов (сек)")
+    args = parser.parse_args()
+
+    configs = [parse_config(spec) for spec in (args.config or ["baseline"])]
+    report = evaluate(configs, load_golden(args.golden), load_faq_questions(args.faq), args.latency, args.embedding_latency)
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f)
+    print_report(report, baseline)
+    print(f"\n✅ Отчёт сохранён в '{args.output}'")
+    if baseline is not None:
+        regressions = compare(report, baseline, args.max_drop)
+        if regressions:
+            print("❌ Качество ухудшилось:\n  " + "\n  ".join(regressions))
+            sys.exit(1)
+        print("✅ Качество не хуже baseline")
+
+
+if __name__ == "__main__":
+    main()
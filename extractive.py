@@ -0,0 +1,88 @@
+"""Экстрактивный ответ из найденных чанков, когда LLM не успела или недоступна.
+
+Из первых чанков поиска берутся предложения, больше всего совпадающие с вопросом
+по основам слов (с весом редкости слова среди предложений-кандидатов), и
+выводятся в исходном порядке под заголовком раздела из metadata['section'].
+Работает локально, без запросов к API.
+"""
+import math
+import re
+from collections import Counter
+from typing import Optional
+
+from dm_session import content_stems
+
+_SENTENCE_RE = re.compile(r"(?<=[.!?;:])\s+|\n+")
+_WORD_RE = re.compile(r"\w+", re.UNICODE)
+MAX_SECTION_CHARS = 80
+
+
+def split_sentences(text: str) -> list[str]:
+    """Предложения чанка; обрезанные границей чанка начало и конец помечаются «…»."""
+    sentences = [s.strip() for s in _SENTENCE_RE.split(text) if len(s.strip()) > 2]
+    if sentences and sentences[0][0].islower():
+        sentences[0] = "…" + sentences[0]
+    if sentences and sentences[-1][-1].isalnum():
+        sentences[-1] += "…"
+    return sentences
+
+
+def sentence_stems(sentence: str) -> set[str]:
+    return {w[:6] for w in _WORD_RE.findall(sentence.lower()) if len(w) >= 4}
+
+
+def section_label(section: Optional[str], limit: int = MAX_SECTION_CHARS) -> str:
+    """Название раздела, обрезанное по слову (в section бывает целый пункт правил)."""
+    section = " ".join((section or "").split())
+    if len(section) <= limit:
+        return section
+    return section[:limit].rsplit(" ", 1)[0] + "…"
+
+
+def _body(doc) -> str:
+    """Текст чанка без заголовочного пути, который setup_rag дописывает в начало."""
+    text, section = doc.page_content, doc.metadata.get("section")
+    if section and text.startswith(section):
+        text = text[len(section):]
+    return text.strip()
+
+
+def best_sentences(question: str, docs: list, max_chunks: int = 3, max_sentences: int = 2) -> list[tuple[str, list[str]]]:
+    """[(раздел, предложения)] для первых max_chunks чанков, в которых есть слова вопроса."""
+    wanted = content_stems(question)
+    chunks = [(doc, split_sentences(_body(doc))) for doc in docs]
+    # вес слова — его редкость среди предложений-кандидатов (idf)
+    frequency = Counter(stem for _, sentences in chunks for s in sentences for stem in sentence_stems(s) & wanted)
+    total = sum(len(sentences) for _, sentences in chunks) or 1
+    weight = {stem: math.log(1 + total / count) for stem, count in frequency.items()}
+
+    def score(sentence: str) -> float:
+        stems = sentence_stems(sentence)
+        return sum(weight.get(stem, 0.0) for stem in stems & wanted) / math.sqrt(len(stems) or 1)
+
+    picked = []
+    for doc, sentences in chunks:
+        scored = sorted(((score(s), i) for i, s in enumerate(sentences)), reverse=True)[:max_sentences]
+        scored = [(value, i) for value, i in scored if value > 0]
+        if not scored:
+            continue
+        picked.append((section_label(doc.metadata.get("section")), [sentences[i] for _, i in sorted(scored, key=lambda x: x[1])]))
+        if len(picked) == max_chunks:
+            break
+    if not picked and chunks and chunks[0][1]:
+        # слов вопроса нет ни в одном предложении — показываем начало лучшего по поиску чанка
+        doc, sentences = chunks[0]
+        picked.append((section_label(doc.metadata.get("section")), sentences[:max_sentences]))
+    return picked
+
+
+def extractive_answer(question: str, docs: list, header: str, max_chunks: int = 3, max_sentences: int = 2) -> Optional[str]:
+    """Ответ из выдержек чанков (Markdown) или None, если выдержек нет."""
+    picked = best_sentences(question, docs, max_chunks, max_sentences)
+    if not picked:
+        return None
+    parts = [header]
+    for section, sentences in picked:
+        quote = " ".join(sentences)
+        parts.append(f"📌 *{section}*\n{quote}" if section else f"📌 {quote}")
+    return "\n\n".join(parts)
@@ -0,0 +1,225 @@
+"""Локальная замена API MAX для тестов и бенчмарков приёма обновлений.
+
+Реализует /me, long polling /updates, /subscriptions и /messages. Обновления
+добавляются через push(): если оформлена подписка, сервер сам отправляет их
+POST-запросом на webhook (как платформа), иначе они ждут в очереди /updates.
+latency — односторонняя задержка сети: ею задерживается и запрос к серверу, и
+его ответ, и доставка на webhook. duplicate_rate — доля повторных доставок.
+
+aiomax обращается к https://platform-api.max.ru напрямую, поэтому боту
+передаётся сессия ApiRedirect, переписывающая адреса на этот сервер:
+
+    with FakeMaxServer(latency=0.02) as server:
+        await bot.start_polling(ApiRedirect(server.base_url))
+"""
+import asyncio
+import random
+import threading
+import time
+from collections import Counter
+from typing import Optional
+
+import aiohttp
+from aiohttp import web
+
+from webhook import API_URL, SECRET_HEADER
+
+BOT_USER = {"user_id": 1, "first_name": "Test", "name": "Test", "username": "test_bot", "is_bot": True, "last_activity_time": 0}
+
+
+def message_update(text: str, user_id: int = 100, seq: int = 0, chat_id: Optional[int] = None) -> dict:
+    """Обновление message_created от пользователя в личном чате."""
+    now = int(time.time() * 1000)
+    return {
+        "update_type": "message_created",
+        "timestamp": now,
+        "message": {
+            "recipient": {"chat_id": chat_id or user_id, "chat_type": "dialog"},
+            "body": {"mid": f"mid.{user_id}.{seq}", "seq": seq, "text": text},
+            "timestamp": now,
+            "sender": {"user_id": user_id, "first_name": "User", "name": "User", "is_bot": False, "last_activity_time": now},
+        },
+    }
+
+
+class ApiRedirect:
+    """Сессия для aiomax, отправляющая запросы к API MAX на base_url."""
+
+    def __init__(self, base_url: str):
+        self.base_url = base_url.rstrip("/")
+        self._session = aiohttp.ClientSession()
+
+    def _url(self, url: str) -> str:
+        return self.base_url + url[len(API_URL):] if url.startswith(API_URL) else url
+
+    async def get(self, url, **kwargs):
+        return await self._session.get(self._url(url), **kwargs)
+
+    async def post(self, url, **kwargs):
+        return await self._session.post(self._url(url), **kwargs)
+
+    async def put(self, url, **kwargs):
+        return await self._session.put(self._url(url), **kwargs)
+
+    async def patch(self, url, **kwargs):
+        return await self._session.patch(self._url(url), **kwargs)
+
+    async def delete(self, url, **kwargs):
+        return await self._session.delete(self._url(url), **kwargs)
+
+    async def close(self) -> None:
+        await self._session.close()
+
+    async def __aenter__(self) -> "ApiRedirect":
+        return self
+
+    async def __aexit__(self, *exc) -> None:
+        await self.close()
+
+
+class FakeMaxServer:
+    """aiohttp-сервер в фоновом потоке со своим event loop (как fake_openai.FakeOpenAIServer)."""
+
+    def __init__(self, latency: float = 0.0, poll_timeout: float = 1.0, duplicate_rate: float = 0.0, seed: int = 0):
+        self.latency = latency
+        self.poll_timeout = poll_timeout
+        self.duplicate_rate = duplicate_rate
+        self._rng = random.Random(seed)
+        self.requests: Counter = Counter()
+        self.updates: list[dict] = []
+        self.sent_messages: list[dict] = []
+        self.subscription: Optional[dict] = None
+        self.port: Optional[int] = None
+        self._new_update: Optional[asyncio.Condition] = None
+        self._client: Optional[aiohttp.ClientSession] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._runner: Optional[web.AppRunner] = None
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def base_url(self) -> str:
+        return f"http://127.0.0.1:{self.port}"
+
+    def _app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_get("/me", self._me)
+        app.router.add_get("/updates", self._updates)
+        app.router.add_post("/subscriptions", self._subscribe)
+        app.router.add_delete("/subscriptions", self._unsubscribe)
+        app.router.add_post("/messages", self._messages)
+        return app
+
+    async def _network(self) -> None:
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+    async def _me(self, request: web.Request) -> web.Response:
+        self.requests["me"] += 1
+        await self._network()
+        return web.json_response(BOT_USER)
+
+    async def _updates(self, request: web.Request) -> web.Response:
+        self.requests["updates"] += 1
+        await self._network()  # запрос идёт до сервера
+        marker = int(request.query.get("marker") or 0)
+        limit = int(request.query.get("limit") or 100)
+        timeout = float(request.query.get("timeout") or self.poll_timeout)
+        async with self._new_update:
+            try:
+                await asyncio.wait_for(self._new_update.wait_for(lambda: len(self.updates) > marker), timeout)
+            except asyncio.TimeoutError:
+                pass
+        batch = self.updates[marker:marker + limit]
+        await self._network()  # ответ идёт до бота
+        return web.json_response({"updates": batch, "marker": marker + len(batch)})
+
+    async def _subscribe(self, request: web.Request) -> web.Response:
+        self.requests["subscribe"] += 1
+        self.subscription = await request.json()
+        return web.json_response({"success": True})
+
+    async def _unsubscribe(self, request: web.Request) -> web.Response:
+        self.requests["unsubscribe"] += 1
+        self.subscription = None
+        return web.json_response({"success": True})
+
+    async def _messages(self, request: web.Request) -> web.Response:
+        self.requests["messages"] += 1
+        body = await request.json()
+        self.sent_messages.append({"chat_id": request.query.get("chat_id"), "user_id": request.query.get("user_id"), **body})
+        await self._network()
+        return web.json_response({"message": None})
+
+    async def _deliver(self, update: dict, attempts: int = 5) -> None:
+        """Доставка на webhook с повторами, пока приёмник не ответит 200."""
+        subscription = self.subscription
+        headers = {SECRET_HEADER: subscription["secret"]} if subscription.get("secret") else {}
+        for attempt in range(attempts):
+            await self._network()
+            try:
+                async with self._client.post(subscription["url"], json=update, headers=headers) as response:
+                    self.requests[f"webhook_{response.status}"] += 1
+                    if response.status == 200:
+                        return
+            except aiohttp.ClientError:
+                self.requests["webhook_error"] += 1
+            await asyncio.sleep(0.05 * (attempt + 1))
+
+    async def _push(self, update: dict) -> None:
+        if self.subscription:
+            copies = 2 if self.duplicate_rate and self._rng.random() < self.duplicate_rate else 1
+            for _ in range(copies):
+                asyncio.create_task(self._deliver(update))
+            return
+        async with self._new_update:
+            self.updates.append(update)
+            self._new_update.notify_all()
+
+    def push(self, update: dict) -> None:
+        """Добавляет обновление (из любого потока)."""
+        asyncio.run_coroutine_threadsafe(self._push(update), self._loop).result(timeout=10)
+
+    def start(self) -> str:
+        """Запускает сервер на свободном порту. Возвращает base_url."""
+        ready = threading.Event()
+
+        async def serve():
+            self._new_update = asyncio.Condition()
+            self._client = aiohttp.ClientSession()
+            self._runner = web.AppRunner(self._app(), shutdown_timeout=0.5)
+            await self._runner.setup()
+            site = web.TCPSite(self._runner, "127.0.0.1", 0)
+            await site.start()
+            self.port = site._server.sockets[0].getsockname()[1]
+            ready.set()
+
+        def run():
+            self._loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(self._loop)
+            self._loop.run_until_complete(serve())
+            self._loop.run_forever()
+            self._loop.run_until_complete(self._runner.cleanup())
+            leftover = asyncio.all_tasks(self._loop)
+            for task in leftover:
+                task.cancel()
+            self._loop.run_until_complete(asyncio.gather(*leftover, return_exceptions=True))
+            self._loop.run_until_complete(self._client.close())
+            self._loop.close()
+
+        self._thread = threading.Thread(target=run, name="fake-max", daemon=True)
+        self._thread.start()
+        ready.wait(timeout=10)
+        return self.base_url
+
+    def stop(self) -> None:
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._loop.stop)
+            self._thread.join(timeout=10)
+            self._loop = None
+
+    def __enter__(self) -> "FakeMaxServer":
+        self.start()
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.stop()
@@ -0,0 +1,258 @@
+"""Локальный OpenAI-совместимый сервер для тестов и бенчмарков.
+
+Реализует /v1/chat/completions, /v1/embeddings и /v1/models. Эмбеддинги
+детерминированные (хэшированный мешок слов), поэтому индекс, собранный через
+этот сервер, даёт воспроизводимый поиск без сети.
+
+Сбои задаются параметрами stall_rate/stall_seconds (зависания) и fail_rate
+(ошибки 500) — для проверки дедлайнов, хеджирования и circuit breaker;
+fault_endpoints ограничивает их чатом или эмбеддингами.
+
+prefix_cache имитирует кеширование префикса OpenAI: префикс от 1024 токенов,
+блоками по 128, уже встречавшийся в прошлых промптах, возвращается в
+usage.prompt_tokens_details.cached_tokens. prefill_latency — добавочная задержка
+на 1000 некешированных токенов промпта (модель времени обработки промпта).
+
+Использование:
+    with FakeOpenAIServer(latency=0.05) as server:
+        chat = ChatOpenAI(base_url=server.base_url, api_key="test")
+"""
+import array
+import asyncio
+import base64
+import hashlib
+import json
+import math
+import random
+import re
+import threading
+import time
+from collections import Counter
+from typing import Callable, Optional
+
+from aiohttp import web
+
+EMBEDDING_DIM = 1536
+
+_TOKEN_RE = re.compile(r"\w+", re.UNICODE)
+
+
+def fake_embedding(text: str, dim: int = EMBEDDING_DIM) -> list[float]:
+    """Детерминированный нормированный вектор: хэшированный мешок основ слов."""
+    vec = [0.0] * dim
+    for token in _TOKEN_RE.findall(text.lower()):
+        stem = token[:6]  # грубый стемминг: у русских словоформ общее начало
+        h = int.from_bytes(hashlib.blake2b(stem.encode("utf-8"), digest_size=8).digest(), "big")
+        vec[h % dim] += 1.0 if (h >> 32) & 1 else -1.0
+    norm = math.sqrt(sum(v * v for v in vec)) or 1.0
+    return [v / norm for v in vec]
+
+
+def default_responder(prompt: str) -> str:
+    """Ответ по умолчанию: «ДА» на проверку тематики (JSON-список для пакетной), иначе начало контекста."""
+    if '"ДА"' in prompt and '"НЕТ"' in prompt:
+        if "Вопросы:" in prompt:
+            count = len(json.loads(prompt.split("Вопросы:", 1)[1]))
+            return json.dumps({"answers": ["ДА"] * count}, ensure_ascii=False)
+        return "ДА"
+    context = prompt.split("Контекст:", 1)[-1].split("Вопрос:", 1)[0].strip()
+    return f"Согласно правилам приёма: {context[:200] or 'нет информации'}"
+
+
+CHARS_PER_TOKEN = 4
+CACHE_MIN_TOKENS = 1024
+CACHE_BLOCK_TOKENS = 128
+
+
+def count_tokens(text: str) -> int:
+    """Грубая оценка числа токенов (≈4 символа на токен)."""
+    return max(1, len(text) // CHARS_PER_TOKEN)
+
+
+class PrefixCache:
+    """Хэши префиксов прошлых промптов на границах блоков, как у кеша OpenAI."""
+
+    def __init__(self):
+        self._seen: set[bytes] = set()
+
+    def lookup(self, prompt: str) -> int:
+        """Сколько токенов начала prompt уже встречалось; запоминает префиксы prompt."""
+        block = CACHE_BLOCK_TOKENS * CHARS_PER_TOKEN
+        digest = hashlib.sha1()
+        cached, hit, position = 0, True, 0
+        for end in range(CACHE_MIN_TOKENS * CHARS_PER_TOKEN, len(prompt) + 1, block):
+            digest.update(prompt[position:end].encode("utf-8"))
+            position = end
+            key = digest.copy().digest()
+            if hit and key in self._seen:
+                cached = end // CHARS_PER_TOKEN
+            else:
+                hit = False
+                self._seen.add(key)
+        return cached
+
+
+class FakeOpenAIServer:
+    """aiohttp-сервер в фоновом потоке со своим event loop."""
+
+    def __init__(
+        self,
+        responder: Callable[[str], str] = default_responder,
+        latency: float = 0.0,
+        embedding_latency: float = 0.0,
+        embedding_dim: int = EMBEDDING_DIM,
+        stall_rate: float = 0.0,
+        stall_seconds: float = 0.0,
+        fail_rate: float = 0.0,
+        fault_endpoints: tuple[str, ...] = ("chat", "embeddings"),
+        prefix_cache: bool = False,
+        prefill_latency: float = 0.0,
+        seed: int = 0,
+    ):
+        self.responder = responder
+        self.latency = latency
+        self.embedding_latency = embedding_latency
+        self.embedding_dim = embedding_dim
+        self.stall_rate = stall_rate
+        self.stall_seconds = stall_seconds
+        self.fail_rate = fail_rate
+        self.fault_endpoints = fault_endpoints
+        self.prefix_cache = PrefixCache() if prefix_cache else None
+        self.prefill_latency = prefill_latency
+        self._rng = random.Random(seed)
+        self.requests: Counter = Counter()
+        self.embedded_inputs = 0
+        self.prompt_tokens = 0
+        self.cached_tokens = 0
+        self.port: Optional[int] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._runner: Optional[web.AppRunner] = None
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def base_url(self) -> str:
+        return f"http://127.0.0.1:{self.port}/v1"
+
+    def _app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post("/v1/chat/completions", self._chat)
+        app.router.add_post("/v1/embeddings", self._embeddings)
+        app.router.add_get("/v1/models", self._models)
+        return app
+
+    async def _inject_faults(self, endpoint: str) -> Optional[web.Response]:
+        """Имитирует сбои: ошибку 500 с вероятностью fail_rate и зависание с вероятностью stall_rate."""
+        if endpoint not in self.fault_endpoints:
+            return None
+        if self.fail_rate and self._rng.random() < self.fail_rate:
+            self.requests["failed"] += 1
+            return web.json_response({"error": {"message": "injected failure", "type": "server_error"}}, status=500)
+        if self.stall_rate and self._rng.random() < self.stall_rate:
+            self.requests["stalled"] += 1
+            await asyncio.sleep(self.stall_seconds)
+        return None
+
+    async def _chat(self, request: web.Request) -> web.Response:
+        self.requests["chat"] += 1
+        body = await request.json()
+        fault = await self._inject_faults("chat")
+        if fault is not None:
+            return fault
+        prompt = "\n".join(str(m.get("content", "")) for m in body.get("messages", []))
+        prompt_tokens = count_tokens(prompt)
+        cached = self.prefix_cache.lookup(prompt) if self.prefix_cache else 0
+        delay = self.latency + self.prefill_latency * (prompt_tokens - cached) / 1000
+        if delay:
+            await asyncio.sleep(delay)
+        content = self.responder(prompt)
+        completion_tokens = count_tokens(content)
+        self.prompt_tokens += prompt_tokens
+        self.cached_tokens += cached
+        return web.json_response({
+            "id": f"chatcmpl-fake-{self.requests['chat']}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": body.get("model", "fake"),
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}],
+            "usage": {
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": completion_tokens,
+                "total_tokens": prompt_tokens + completion_tokens,
+                "prompt_tokens_details": {"cached_tokens": cached},
+            },
+        })
+
+    async def _embeddings(self, request: web.Request) -> web.Response:
+        self.requests["embeddings"] += 1
+        body = await request.json()
+        fault = await self._inject_faults("embeddings")
+        if fault is not None:
+            return fault
+        inputs = body.get("input", [])
+        if isinstance(inputs, str) or (inputs and isinstance(inputs[0], int)):
+            inputs = [inputs]
+        # токенизированный ввод (check_embedding_ctx_length) хэшируем по id токенов
+        texts = [x if isinstance(x, str) else " ".join(map(str, x)) for x in inputs]
+        self.embedded_inputs += len(texts)
+        if self.embedding_latency:
+            await asyncio.sleep(self.embedding_latency)
+        data = []
+        for i, text in enumerate(texts):
+            vec = fake_embedding(text, self.embedding_dim)
+            if body.get("encoding_format") == "base64":
+                vec = base64.b64encode(array.array("f", vec).tobytes()).decode("ascii")
+            data.append({"object": "embedding", "index": i, "embedding": vec})
+        tokens = sum(count_tokens(t) for t in texts)
+        return web.json_response({
+            "object": "list",
+            "data": data,
+            "model": body.get("model", "fake"),
+            "usage": {"prompt_tokens": tokens, "total_tokens": tokens},
+        })
+
+    async def _models(self, request: web.Request) -> web.Response:
+        self.requests["models"] += 1
+        return web.json_response({"object": "list", "data": [{"id": "gpt-4o-mini", "object": "model"}]})
+
+    def start(self) -> str:
+        """Запускает сервер на свободном порту. Возвращает base_url."""
+        ready = threading.Event()
+
+        async def serve():
+            self._runner = web.AppRunner(self._app(), shutdown_timeout=0.5)
+            await self._runner.setup()
+            site = web.TCPSite(self._runner, "127.0.0.1", 0)
+            await site.start()
+            self.port = site._server.sockets[0].getsockname()[1]
+            ready.set()
+
+        def run():
+            self._loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(self._loop)
+            self._loop.run_until_complete(serve())
+            self._loop.run_forever()
+            self._loop.run_until_complete(self._runner.cleanup())
+            # зависшие обработчики (stall_seconds) отменяем, чтобы не было «Task was destroyed»
+            leftover = asyncio.all_tasks(self._loop)
+            for task in leftover:
+                task.cancel()
+            self._loop.run_until_complete(asyncio.gather(*leftover, return_exceptions=True))
+            self._loop.close()
+
+        self._thread = threading.Thread(target=run, name="fake-openai", daemon=True)
+        self._thread.start()
+        ready.wait(timeout=10)
+        return self.base_url
+
+    def stop(self) -> None:
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._loop.stop)
+            self._thread.join(timeout=10)
+            self._loop = None
+
+    def __enter__(self) -> "FakeOpenAIServer":
+        self.start()
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.stop()
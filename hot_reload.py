@@ -0,0 +1,131 @@
+"""Горячая перезагрузка данных (FAISS-индексы, faq.json) без рестарта бота.
+
+Reloadable держит текущее значение и его версию. Фоновый ReloadWatcher
+периодически сравнивает mtime/размер отслеживаемых файлов; при изменении
+новое значение загружается и прогревается в фоновом потоке, а затем
+атомарно подменяет старое. Запросы, уже получившие старое значение,
+дорабатывают на нём — после этого оно освобождается сборщиком мусора.
+Если загрузка упала, остаётся прежняя версия.
+"""
+import logging
+import os
+import threading
+from typing import Callable, Generic, Optional, TypeVar
+
+T = TypeVar("T")
+
+logger = logging.getLogger('RELOAD')
+
+
+def file_signature(paths: list[str]) -> tuple:
+    """(mtime_ns, size) каждого файла; None для отсутствующих."""
+    signature = []
+    for path in paths:
+        try:
+            st = os.stat(path)
+            signature.append((st.st_mtime_ns, st.st_size))
+        except FileNotFoundError:
+            signature.append(None)
+    return tuple(signature)
+
+
+class Reloadable(Generic[T]):
+    """Значение, перезагружаемое при изменении файлов.
+
+    loader() возвращает (значение, версия) и должен сам прогреть значение.
+    """
+
+    def __init__(self, name: str, paths: list[str], loader: Callable[[], tuple[T, str]], watcher: Optional["ReloadWatcher"] = None):
+        self.name = name
+        self.paths = paths
+        self.loader = loader
+        self.version: Optional[str] = None
+        self._value: Optional[T] = None
+        self._signature: Optional[tuple] = None
+        self._lock = threading.Lock()
+        (watcher or default_watcher).register(self)
+
+    @property
+    def loaded(self) -> bool:
+        return self._signature is not None
+
+    def get(self) -> T:
+        """Текущее значение (при первом обращении загружается синхронно)."""
+        if not self.loaded:
+            with self._lock:
+                if not self.loaded:
+                    self._load()
+        return self._value
+
+    def _load(self) -> None:
+        signature = file_signature(self.paths)
+        value, version = self.loader()
+        previous = self.version
+        self._value, self.version, self._signature = value, version, signature
+        if previous is None:
+            logger.info(f"{self.name}: загружена версия {version}")
+        elif previous != version:
+            logger.info(f"{self.name}: версия {previous} → {version}")
+
+    def check(self) -> bool:
+        """Перезагружает значение, если файлы изменились. Возвращает True при смене версии."""
+        if not self.loaded or file_signature(self.paths) == self._signature:
+            return False
+        previous = self.version
+        with self._lock:
+            try:
+                self._load()
+            except Exception as e:
+                self._signature = file_signature(self.paths)  # не повторяем до следующего изменения
+                logger.error(f"{self.name}: не удалось загрузить новую версию, остаётся {previous}: {type(e).__name__}: {e}")
+                return False
+        return self.version != previous
+
+
+class ReloadWatcher:
+    """Фоновый поток, периодически проверяющий зарегистрированные Reloadable."""
+
+    def __init__(self, interval: float = 30.0):
+        self.interval = interval
+        self._items: list[Reloadable] = []
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def register(self, item: Reloadable) -> None:
+        self._items.append(item)
+
+    def unregister(self, item: Reloadable) -> None:
+        if item in self._items:
+            self._items.remove(item)
+
+    def check_all(self) -> int:
+        """Проверяет все загруженные значения. Возвращает число перезагруженных."""
+        return sum(item.check() for item in list(self._items))
+
+    def versions(self) -> dict[str, str]:
+        """Активные версии загруженных значений (для логов и метрик)."""
+        return {item.name: item.version for item in self._items if item.loaded}
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.interval):
+            try:
+                self.check_all()
+            except Exception as e:
+                logger.error(f"Ошибка проверки обновлений: {type(e).__name__}: {e}")
+
+    def start(self, interval: Optional[float] = None) -> None:
+        if interval is not None:
+            self.interval = interval
+        if self._thread is None and self.interval > 0:
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name="reload-watcher", daemon=True)
+            self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+            self._thread = None
+
+
+default_watcher = ReloadWatcher()
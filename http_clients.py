@@ -0,0 +1,137 @@
+"""Общий пул HTTP-соединений для всех вызовов OpenAI API.
+
+ChatOpenAI, OpenAIEmbeddings (бот, setup_rag.py, проверки в tests.py) получают
+одни и те же httpx-клиенты: keep-alive, ограничение пула, таймауты из
+settings.openai и опционально HTTP/2.
+"""
+import asyncio
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+
+import httpx
+
+from settings import settings
+
+logger = logging.getLogger('HTTP')
+
+_lock = threading.Lock()
+_sync_client: Optional[httpx.Client] = None
+_async_client: Optional[httpx.AsyncClient] = None
+
+
+def _http2_enabled() -> bool:
+    if not settings.openai.http2:
+        return False
+    try:
+        import h2  # noqa: F401
+    except ImportError:
+        logger.warning("OPENAI_HTTP2=1, но пакет h2 не установлен (pip install httpx[http2]) — используется HTTP/1.1")
+        return False
+    return True
+
+
+def build_timeout() -> httpx.Timeout:
+    """Таймауты соединения и чтения из settings.openai."""
+    cfg = settings.openai
+    return httpx.Timeout(connect=cfg.connect_timeout, read=cfg.read_timeout, write=cfg.read_timeout, pool=cfg.connect_timeout)
+
+
+def build_limits() -> httpx.Limits:
+    """Ограничения пула соединений из settings.openai."""
+    cfg = settings.openai
+    return httpx.Limits(
+        max_connections=cfg.max_connections,
+        max_keepalive_connections=cfg.max_keepalive_connections,
+        keepalive_expiry=cfg.keepalive_expiry,
+    )
+
+
+def get_sync_client() -> httpx.Client:
+    """Общий синхронный клиент (создаётся при первом обращении)."""
+    global _sync_client
+    if _sync_client is None:
+        with _lock:
+            if _sync_client is None:
+                _sync_client = httpx.Client(timeout=build_timeout(), limits=build_limits(), http2=_http2_enabled())
+    return _sync_client
+
+
+def get_async_client() -> httpx.AsyncClient:
+    """Общий асинхронный клиент (создаётся при первом обращении)."""
+    global _async_client
+    if _async_client is None:
+        with _lock:
+            if _async_client is None:
+                _async_client = httpx.AsyncClient(timeout=build_timeout(), limits=build_limits(), http2=_http2_enabled())
+    return _async_client
+
+
+def openai_client_kwargs() -> dict:
+    """Аргументы для ChatOpenAI / OpenAIEmbeddings: общий пул и таймауты."""
+    return {
+        "http_client": get_sync_client(),
+        "http_async_client": get_async_client(),
+        "timeout": build_timeout(),
+    }
+
+
+def _warmup_request(base_url: Optional[str]) -> tuple[str, dict]:
+    url = f"{(base_url or settings.openai.api_base).rstrip('/')}/models"
+    headers = {"Authorization": f"Bearer {settings.openai.api_key}"} if settings.openai.api_key else {}
+    return url, headers
+
+
+def prewarm(connections: Optional[int] = None, base_url: Optional[str] = None) -> int:
+    """Открывает соединения синхронного пула заранее, чтобы первый запрос не платил за TCP/TLS.
+
+    Returns:
+        Число успешно открытых соединений
+    """
+    n = settings.openai.prewarm_connections if connections is None else connections
+    if n <= 0:
+        return 0
+    url, headers = _warmup_request(base_url)
+    client = get_sync_client()
+
+    def ping(_) -> bool:
+        try:
+            client.get(url, headers=headers)
+            return True
+        except httpx.HTTPError as e:
+            logger.warning(f"Прогрев соединения не удался: {type(e).__name__}: {e}")
+            return False
+
+    with ThreadPoolExecutor(max_workers=n) as pool:
+        opened = sum(pool.map(ping, range(n)))
+    logger.info(f"Прогрето соединений: {opened}/{n} ({url})")
+    return opened
+
+
+async def aprewarm(connections: Optional[int] = None, base_url: Optional[str] = None) -> int:
+    """Асинхронный вариант prewarm() для общего AsyncClient (вызывать внутри рабочего event loop)."""
+    n = settings.openai.prewarm_connections if connections is None else connections
+    if n <= 0:
+        return 0
+    url, headers = _warmup_request(base_url)
+    client = get_async_client()
+    results = await asyncio.gather(*(client.get(url, headers=headers) for _ in range(n)), return_exceptions=True)
+    opened = sum(1 for r in results if not isinstance(r, BaseException))
+    logger.info(f"Прогрето async-соединений: {opened}/{n} ({url})")
+    return opened
+
+
+def close() -> None:
+    """Закрывает общие клиенты (синхронный — сразу, асинхронный — если loop не запущен)."""
+    global _sync_client, _async_client
+    with _lock:
+        if _sync_client is not None:
+            _sync_client.close()
+            _sync_client = None
+        if _async_client is not None:
+            try:
+                asyncio.run(_async_client.aclose())
+            except RuntimeError:
+                pass
+            _async_client = None
@@ -0,0 +1,147 @@
+"""Сжатие векторов FAISS-индекса: float16 и понижение размерности PCA.
+
+Режимы (settings.rag.index_compression, setup_rag.py --compression):
+    none      — IndexFlatL2, float32 (как раньше)
+    fp16      — IndexScalarQuantizer QT_fp16: вдвое меньше памяти
+    pca       — PCA (d → pca_dim) + IndexFlatL2
+    pca-fp16  — PCA + float16
+
+PCA обучается на векторах корпуса, и её проекция хранится внутри индекса (IndexPreTransform),
+поэтому FAISS сам применяет её к векторам запросов при поиске — RAGEngine и
+LangChain работают с индексом как обычно, запросы остаются 1536-мерными.
+"""
+import time
+from typing import Optional
+
+import faiss
+import numpy as np
+
+COMPRESSION_MODES = ("none", "fp16", "pca", "pca-fp16")
+
+
+def index_vectors(index: faiss.Index) -> np.ndarray:
+    """Все векторы индекса (float32)."""
+    return index.reconstruct_n(0, index.ntotal)
+
+
+def train_pca(vectors: np.ndarray, out_dim: int) -> faiss.LinearTransform:
+    """Обучает PCA и возвращает только проекцию (A, b).
+
+    PCAMatrix сериализует ещё и полную d×d матрицу собственных векторов —
+    для 1536-мерных эмбеддингов это лишние ~9 МБ в каждом индексе.
+    """
+    pca = faiss.PCAMatrix(vectors.shape[1], out_dim)
+    pca.train(vectors)
+    projection = faiss.LinearTransform(vectors.shape[1], out_dim, True)
+    faiss.copy_array_to_vector(faiss.vector_to_array(pca.A), projection.A)
+    faiss.copy_array_to_vector(faiss.vector_to_array(pca.b), projection.b)
+    projection.is_trained = True
+    return projection
+
+
+def build_compressed_index(vectors: np.ndarray, mode: str, pca_dim: int = 256) -> faiss.Index:
+    """Строит индекс в режиме mode; порядок векторов (и id в docstore) сохраняется."""
+    if mode not in COMPRESSION_MODES:
+        raise ValueError(f"Неизвестный режим сжатия: {mode} (допустимо: {', '.join(COMPRESSION_MODES)})")
+    vectors = np.ascontiguousarray(vectors, dtype="float32")
+    n, d = vectors.shape
+    out_dim = d
+    pca = None
+    if mode.startswith("pca"):
+        # больше главных компонент, чем векторов, PCA не выделит
+        out_dim = max(1, min(pca_dim, d, n))
+        pca = train_pca(vectors, out_dim)
+    if mode.endswith("fp16"):
+        base = faiss.IndexScalarQuantizer(out_dim, faiss.ScalarQuantizer.QT_fp16, faiss.METRIC_L2)
+    else:
+        base = faiss.IndexFlatL2(out_dim)
+    index = faiss.IndexPreTransform(pca, base) if pca is not None else base
+    index.train(vectors)
+    index.add(vectors)
+    return index
+
+
+def compress_vectorstore(vectorstore, mode: str, pca_dim: int = 256) -> dict:
+    """Заменяет индекс LangChain FAISS на сжатый. Возвращает сведения для манифеста."""
+    if mode == "none":
+        return {"compression": "none", "dim": vectorstore.index.d}
+    index = build_compressed_index(index_vectors(vectorstore.index), mode, pca_dim)
+    vectorstore.index = index
+    info = {"compression": mode, "dim": index.d}
+    if mode.startswith("pca"):
+        info["pca_dim"] = faiss.downcast_index(index.index).d
+    return info
+
+
+def index_memory_bytes(index: faiss.Index) -> int:
+    """Размер сериализованного индекса (≈ память, которую он занимает)."""
+    return int(faiss.serialize_index(index).nbytes)
+
+
+def search_ids(index: faiss.Index, queries: np.ndarray, k: int, repeats: int = 3) -> tuple[np.ndarray, float]:
+    """id ближайших соседей и время поиска на запрос (мс, лучшее из repeats прогонов)."""
+    queries = np.ascontiguousarray(queries, dtype="float32")
+    best = float("inf")
+    for _ in range(repeats):
+        start = time.perf_counter()
+        _, ids = index.search(queries, k)
+        best = min(best, time.perf_counter() - start)
+    return ids, best * 1000 / len(queries)
+
+
+def recall_at_k(reference: np.ndarray, candidate: np.ndarray) -> float:
+    """Доля ближайших соседей точного индекса, найденных сжатым (среднее по запросам)."""
+    k = reference.shape[1]
+    hits = sum(len(set(r) & set(c)) for r, c in zip(reference.tolist(), candidate.tolist()))
+    return hits / (k * len(reference))
+
+
+def synthetic_corpus(n: int, dim: int = 1536, clusters: int = 64, latent_dim: int = 256, seed: int = 0) -> np.ndarray:
+    """Синтетические «эмбеддинги»: кластеры в подпространстве низкой размерности + шум, нормированные.
+
+    Реальные эмбеддинги ada-002 тоже сосредоточены в подпространстве малой эффективной размерности.
+    """
+    rng = np.random.default_rng(seed)
+    basis = rng.standard_normal((latent_dim, dim)).astype("float32")
+    centers = rng.standard_normal((clusters, latent_dim)).astype("float32") * 3
+    latent = centers[rng.integers(0, clusters, n)] + rng.standard_normal((n, latent_dim)).astype("float32")
+    vectors = latent @ basis + rng.standard_normal((n, dim)).astype("float32") * 0.5
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+def perturbed_queries(vectors: np.ndarray, n: int, noise: float = 0.02, seed: int = 1) -> np.ndarray:
+    """Запросы — зашумлённые векторы корпуса (когда нет реальных вопросов)."""
+    rng = np.random.default_rng(seed)
+    picked = vectors[rng.integers(0, len(vectors), n)]
+    queries = picked + rng.standard_normal(picked.shape).astype("float32") * noise
+    return queries / np.linalg.norm(queries, axis=1, keepdims=True)
+
+
+def compare_modes(
+    vectors: np.ndarray,
+    queries: np.ndarray,
+    k: int = 7,
+    pca_dim: int = 256,
+    modes: Optional[tuple[str, ...]] = None,
+) -> list[dict]:
+    """Память, скорость и recall@k каждого режима относительно точного float32-индекса."""
+    reference = build_compressed_index(vectors, "none")
+    ref_ids, ref_ms = search_ids(reference, queries, k)
+    ref_bytes = index_memory_bytes(reference)
+    rows = []
+    for mode in modes or COMPRESSION_MODES:
+        if mode == "none":
+            index, ids, ms = reference, ref_ids, ref_ms
+        else:
+            index = build_compressed_index(vectors, mode, pca_dim)
+            ids, ms = search_ids(index, queries, k)
+        size = index_memory_bytes(index)
+        rows.append({
+            "mode": mode,
+            "bytes": size,
+            "saved": 1 - size / ref_bytes,
+            "ms_per_query": ms,
+            "speedup": ref_ms / ms if ms else float("inf"),
+            "recall": recall_at_k(ref_ids, ids),
+        })
+    return rows
@@ -0,0 +1,172 @@
+"""Реестр FAISS-индексов: (организация, год, уровень) → папка индекса.
+
+Реестр задаётся файлом settings.rag.registry_path (по умолчанию indexes.json):
+
+    {
+      "defaults": {"tenant": "mipt", "year": 2025},
+      "indexes": [
+        {"tenant": "mipt", "year": 2025, "level": "master", "path": "faiss_index_master"},
+        ...
+      ]
+    }
+
+Без файла реестр строится из папок settings.rag (mipt/2025: default, bachelor, master).
+Индексы загружаются лениво; при превышении бюджета памяти выгружаются давно не
+использованные. Память индекса оценивается по размеру его файлов (плоский FAISS-индекс
+и docstore в памяти занимают примерно столько же).
+"""
+import asyncio
+import json
+import logging
+import os
+import threading
+from collections import OrderedDict
+from typing import Callable, NamedTuple, Optional
+
+from hot_reload import Reloadable, ReloadWatcher, default_watcher
+from index_store import INDEX_FILES, resolve_index, watch_paths
+
+logger = logging.getLogger('REGISTRY')
+
+DEFAULT_LEVEL = "default"
+
+
+class IndexKey(NamedTuple):
+    tenant: str
+    year: int
+    level: str
+
+    def __str__(self) -> str:
+        return f"{self.tenant}/{self.year}/{self.level}"
+
+
+def index_memory(index_dir: str) -> int:
+    """Оценка памяти активной версии индекса (байт) по размеру её файлов."""
+    path, _ = resolve_index(index_dir)
+    return sum(os.path.getsize(os.path.join(path, name)) for name in INDEX_FILES)
+
+
+def load_registry_config(path: Optional[str], rag_settings) -> tuple[dict[IndexKey, str], IndexKey]:
+    """Читает реестр из JSON. Возвращает (ключ → папка, ключ по умолчанию без уровня)."""
+    if path and os.path.exists(path):
+        with open(path, encoding="utf-8") as f:
+            config = json.load(f)
+        defaults = config.get("defaults", {})
+        entries = {
+            IndexKey(str(e["tenant"]).lower(), int(e["year"]), str(e.get("level", DEFAULT_LEVEL)).lower()): e["path"]
+            for e in config.get("indexes", [])
+        }
+        if not entries:
+            raise ValueError(f"В реестре {path} нет индексов")
+        first = next(iter(entries))
+        default = IndexKey(
+            str(defaults.get("tenant", first.tenant)).lower(), int(defaults.get("year", first.year)), DEFAULT_LEVEL
+        )
+        return entries, default
+
+    default = IndexKey("mipt", 2025, DEFAULT_LEVEL)
+    entries = {
+        default: rag_settings.default_index_dir,
+        default._replace(level="bachelor"): rag_settings.bachelor_index_dir,
+        default._replace(level="master"): rag_settings.master_index_dir,
+    }
+    return entries, default
+
+
+class IndexRegistry:
+    """Ленивая загрузка индексов по ключу с LRU-вытеснением по бюджету памяти.
+
+    loader(index_dir) возвращает (retriever, версия). Одновременные первые
+    обращения к одному индексу загружают его один раз.
+    """
+
+    def __init__(
+        self,
+        entries: dict[IndexKey, str],
+        loader: Callable[[str], tuple[object, str]],
+        default: Optional[IndexKey] = None,
+        memory_budget: int = 1 << 30,
+        watcher: Optional[ReloadWatcher] = None,
+    ):
+        self.entries = entries
+        self.loader = loader
+        self.default = default or next(iter(entries))._replace(level=DEFAULT_LEVEL)
+        self.memory_budget = memory_budget
+        self.watcher = watcher or default_watcher
+        self._loaded: OrderedDict[IndexKey, Reloadable] = OrderedDict()
+        self._memory: dict[IndexKey, int] = {}
+        self._lock = threading.Lock()
+
+    def resolve(self, level: Optional[str] = None, tenant: Optional[str] = None, year: Optional[int] = None) -> IndexKey:
+        """Ключ индекса; неизвестный уровень — индекс уровня по умолчанию той же организации и года."""
+        key = IndexKey(
+            (tenant or self.default.tenant).strip().lower(),
+            int(year or self.default.year),
+            (level or DEFAULT_LEVEL).strip().lower(),
+        )
+        if key in self.entries:
+            return key
+        fallback = key._replace(level=DEFAULT_LEVEL)
+        if fallback in self.entries:
+            return fallback
+        raise KeyError(f"Индекс не зарегистрирован: {key}")
+
+    def _load(self, key: IndexKey) -> tuple[object, str]:
+        index_dir = self.entries[key]
+        retriever, version = self.loader(index_dir)
+        memory = index_memory(index_dir)
+        with self._lock:
+            if key in self._loaded:  # индекс могли вытеснить, пока он загружался
+                self._memory[key] = memory
+        return retriever, version
+
+    def get(self, level: Optional[str] = None, tenant: Optional[str] = None, year: Optional[int] = None):
+        """Retriever активной версии индекса; вызывающий держит его до конца запроса."""
+        key = self.resolve(level, tenant, year)
+        with self._lock:
+            index = self._loaded.get(key)
+            if index is None:
+                index = Reloadable(f"index:{key}", watch_paths(self.entries[key]), lambda: self._load(key), self.watcher)
+                self._loaded[key] = index
+            self._loaded.move_to_end(key)
+        try:
+            retriever = index.get()
+        except Exception:
+            with self._lock:
+                if self._loaded.get(key) is index:
+                    del self._loaded[key]
+                    self.watcher.unregister(index)
+            raise
+        self._evict(keep=key)
+        return retriever
+
+    async def aget(self, level: Optional[str] = None, tenant: Optional[str] = None, year: Optional[int] = None):
+        """Асинхронный get(): загрузка идёт в потоке, не блокируя event loop."""
+        return await asyncio.to_thread(self.get, level, tenant, year)
+
+    def _evict(self, keep: IndexKey) -> None:
+        with self._lock:
+            while self.memory_used() > self.memory_budget:
+                victim = next((k for k in self._loaded if k != keep and k in self._memory), None)
+                if victim is None:
+                    if self.memory_used() > self.memory_budget:
+                        logger.warning(f"Индекс {keep} один превышает бюджет памяти ({self.memory_used() >> 20} МБ)")
+                    return
+                index = self._loaded.pop(victim)
+                self.watcher.unregister(index)
+                freed = self._memory.pop(victim)
+                # запросы, уже получившие retriever, дорабатывают на нём
+                logger.info(f"Выгружен индекс {victim} ({freed >> 20} МБ), занято {self.memory_used() >> 20} МБ")
+
+    def memory_used(self) -> int:
+        return sum(self._memory.values())
+
+    def loaded(self) -> list[IndexKey]:
+        """Загруженные индексы от давно не использованного к недавнему."""
+        with self._lock:
+            return [k for k, index in self._loaded.items() if index.loaded]
+
+    def versions(self) -> dict[str, str]:
+        """Активные версии загруженных индексов."""
+        with self._lock:
+            return {str(k): index.version for k, index in self._loaded.items() if index.loaded}
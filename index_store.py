@@ -0,0 +1,133 @@
+"""Версионированное хранение FAISS-индексов.
+
+Раскладка папки индекса:
+
+    faiss_index_master/
+    ├── manifest.json              # активная версия: путь, хэш содержимого, время сборки
+    ├── 20251019-120000-1a2b3c4d/  # index.faiss + index.pkl
+    └── 20251018-090000-9f8e7d6c/  # предыдущая версия (для отката)
+
+setup_rag.py собирает новую версию во временную папку и атомарно подменяет
+manifest.json — бот, следящий за манифестом, подхватывает её без рестарта.
+Старая раскладка (index.faiss прямо в папке) поддерживается как версия «legacy».
+"""
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+from datetime import datetime
+from typing import Callable, Optional
+
+MANIFEST_NAME = "manifest.json"
+INDEX_FILES = ("index.faiss", "index.pkl")
+
+
+def content_hash(path: str) -> str:
+    """SHA-256 файлов индекса в папке path."""
+    h = hashlib.sha256()
+    for name in INDEX_FILES:
+        with open(os.path.join(path, name), "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                h.update(chunk)
+    return h.hexdigest()
+
+
+def read_manifest(index_dir: str) -> Optional[dict]:
+    """Манифест активной версии: из manifest.json или синтезированный для старой раскладки."""
+    manifest_path = os.path.join(index_dir, MANIFEST_NAME)
+    if os.path.exists(manifest_path):
+        with open(manifest_path, encoding="utf-8") as f:
+            return json.load(f)
+    if all(os.path.exists(os.path.join(index_dir, name)) for name in INDEX_FILES):
+        digest = content_hash(index_dir)
+        built_at = datetime.fromtimestamp(os.path.getmtime(os.path.join(index_dir, INDEX_FILES[0])))
+        return {"version": f"legacy-{digest[:8]}", "path": ".", "content_hash": digest, "built_at": built_at.isoformat(timespec="seconds")}
+    return None
+
+
+def index_exists(index_dir: str) -> bool:
+    """Есть ли в папке индекс (в любой раскладке)."""
+    return os.path.exists(os.path.join(index_dir, MANIFEST_NAME)) or os.path.exists(os.path.join(index_dir, INDEX_FILES[0]))
+
+
+def resolve_index(index_dir: str) -> tuple[str, dict]:
+    """Путь к файлам активной версии и её манифест."""
+    manifest = read_manifest(index_dir)
+    if manifest is None:
+        raise FileNotFoundError(f"FAISS index not found: {index_dir}")
+    return os.path.normpath(os.path.join(index_dir, manifest["path"])), manifest
+
+
+def watch_paths(index_dir: str) -> list[str]:
+    """Файлы, изменение которых означает новую версию индекса."""
+    return [os.path.join(index_dir, MANIFEST_NAME), *(os.path.join(index_dir, name) for name in INDEX_FILES)]
+
+
+class SourceHasher:
+    """Потоковый хэш исходных данных индекса (файлы FAISS недетерминированы из-за uuid в docstore)."""
+
+    def __init__(self, model: str):
+        self._h = hashlib.sha256(model.encode("utf-8"))
+
+    def update(self, text: str, metadata: dict) -> None:
+        self._h.update(json.dumps([text, metadata], ensure_ascii=False, sort_keys=True).encode("utf-8"))
+
+    def hexdigest(self) -> str:
+        return self._h.hexdigest()
+
+
+def source_hash(texts: list[str], metadatas: list[dict], model: str) -> str:
+    """Хэш исходных данных индекса целиком (см. SourceHasher)."""
+    hasher = SourceHasher(model)
+    for text, metadata in zip(texts, metadatas or [{}] * len(texts)):
+        hasher.update(text, metadata)
+    return hasher.hexdigest()
+
+
+def publish_version(
+    save: Callable[[str], None],
+    index_dir: str,
+    keep: int = 2,
+    digest: Optional[str] = None,
+    extra: Optional[dict] = None,
+) -> dict:
+    """Сохраняет новую версию индекса через save(path) и атомарно делает её активной.
+
+    digest — хэш содержимого (по умолчанию считается по файлам индекса). Если он
+    совпадает с активной версией, она остаётся прежней. Хранится keep последних
+    версий, более старые удаляются.
+    """
+    os.makedirs(index_dir, exist_ok=True)
+    tmp_dir = tempfile.mkdtemp(prefix=".build-", dir=index_dir)
+    try:
+        save(tmp_dir)
+        digest = digest or content_hash(tmp_dir)
+        current = read_manifest(index_dir)
+        if current and current.get("content_hash") == digest:
+            return current
+        built_at = datetime.now()
+        version = f"{built_at:%Y%m%d-%H%M%S}-{digest[:8]}"
+        os.replace(tmp_dir, os.path.join(index_dir, version))
+    finally:
+        if os.path.exists(tmp_dir):
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    manifest = {"version": version, "path": version, "content_hash": digest, "built_at": built_at.isoformat(timespec="seconds"), **(extra or {})}
+    tmp_manifest = os.path.join(index_dir, f"{MANIFEST_NAME}.tmp")
+    with open(tmp_manifest, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=2)
+    os.replace(tmp_manifest, os.path.join(index_dir, MANIFEST_NAME))
+    _prune_versions(index_dir, keep=max(1, keep), active=version)
+    return manifest
+
+
+def _prune_versions(index_dir: str, keep: int, active: str) -> None:
+    versions = sorted(
+        name for name in os.listdir(index_dir)
+        if not name.startswith(".") and os.path.isdir(os.path.join(index_dir, name))
+        and os.path.exists(os.path.join(index_dir, name, INDEX_FILES[0]))
+    )
+    for name in versions[:-keep]:
+        if name != active:
+            shutil.rmtree(os.path.join(index_dir, name), ignore_errors=True)
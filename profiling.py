@@ -0,0 +1,368 @@
+"""Профилирование работающего бота по запросу.
+
+Три инструмента, результаты пишутся в settings.profiling.output_dir:
+
+- SamplingProfiler — сэмплирует стеки всех потоков N секунд или до N ответов
+  и пишет их в формате «свёрнутых стеков» (flamegraph.pl, speedscope, inferno):
+  sample-<время>.folded
+- SlowRequestProfiler — cProfile каждого answer_question; дамп сохраняется только
+  для запросов дольше порога: slow-answer_question-<время>-<мс>.prof
+  (snakeviz, flameprof, pstats)
+- LoopLagMonitor — сторожевой поток замечает, что event loop не просыпается дольше
+  порога, и пишет в лог обработчик, который его держит (стек потока event loop);
+  стеки блокировок копятся в loop-lag.folded
+
+Включение: PROFILING=1 (медленные запросы + монитор event loop), PROFILE_SAMPLE_SECONDS=N
+(сэмплирование с запуска) или команда /profile от пользователя из ADMIN_USER_IDS.
+"""
+import asyncio
+import cProfile
+import functools
+import logging
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from datetime import datetime
+from typing import Callable, Optional
+
+from settings import settings
+
+logger = logging.getLogger('PROFILE')
+
+PROJECT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# листовые кадры простаивающих потоков (ожидание блокировки, очереди, select)
+_IDLE_LEAVES = {("threading.py", "wait"), ("threading.py", "_wait_for_tstate_lock"), ("queue.py", "get"), ("selectors.py", "select")}
+
+
+def _frame_label(frame) -> str:
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+def folded_stack(frame, root: str = "") -> str:
+    """Стек от корня к листу через «;» — строка формата свёрнутых стеков."""
+    labels = []
+    while frame is not None:
+        labels.append(_frame_label(frame))
+        frame = frame.f_back
+    if root:
+        labels.append(root)
+    return ";".join(reversed(labels))
+
+
+def is_idle(frame) -> bool:
+    return (os.path.basename(frame.f_code.co_filename), frame.f_code.co_name) in _IDLE_LEAVES
+
+
+def project_frame(frame) -> Optional[str]:
+    """Самый глубокий кадр кода проекта (не библиотек): «файл:строка функция»."""
+    while frame is not None:
+        path = os.path.abspath(frame.f_code.co_filename)
+        if path.startswith(PROJECT_DIR) and "site-packages" not in path and path != os.path.abspath(__file__):
+            return f"{os.path.basename(path)}:{frame.f_lineno} {frame.f_code.co_name}"
+        frame = frame.f_back
+    return None
+
+
+def write_folded(path: str, stacks: Counter) -> None:
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with open(path, "w", encoding="utf-8") as f:
+        for stack, count in stacks.most_common():
+            f.write(f"{stack} {count}\n")
+
+
+def _timestamp() -> str:
+    return datetime.now().strftime("%Y%m%d-%H%M%S")
+
+
+class SamplingProfiler:
+    """Сэмплирующий профайлер: раз в interval снимает стеки всех потоков (sys._current_frames)."""
+
+    def __init__(self, output_dir: str, interval: float = 0.005):
+        self.output_dir = output_dir
+        self.interval = interval
+        self.stacks: Counter = Counter()
+        self.samples = 0
+        self.path: Optional[str] = None
+        self._requests_left: Optional[int] = None
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self, seconds: Optional[float] = None, requests: Optional[int] = None, max_seconds: float = 600.0) -> str:
+        """Запускает сэмплирование на seconds секунд или до requests ответов (не дольше max_seconds)."""
+        with self._lock:
+            if self.running:
+                raise RuntimeError(f"Профилирование уже идёт: {self.path}")
+            self.stacks, self.samples = Counter(), 0
+            self._requests_left = requests
+            self.path = os.path.join(self.output_dir, f"sample-{_timestamp()}.folded")
+            self._stop.clear()
+            duration = min(seconds or max_seconds, max_seconds)
+            self._thread = threading.Thread(target=self._run, args=(duration,), name="sampling-profiler", daemon=True)
+            self._thread.start()
+        logger.info(f"Сэмплирование запущено: {f'{requests} ответов' if requests else f'{duration:.0f} с'} → {self.path}")
+        return self.path
+
+    def note_request(self) -> None:
+        """Вызывается по завершении ответа; останавливает сэмплирование после N ответов."""
+        with self._lock:
+            if self._requests_left is None:
+                return
+            self._requests_left -= 1
+            if self._requests_left <= 0:
+                self._stop.set()
+
+    def stop(self) -> Optional[str]:
+        """Останавливает сэмплирование и ждёт записи файла. Возвращает путь к нему."""
+        self._stop.set()
+        thread = self._thread
+        if thread is not None:
+            thread.join(timeout=10)
+        return self.path
+
+    def _run(self, duration: float) -> None:
+        own = threading.get_ident()
+        deadline = time.monotonic() + duration
+        while not self._stop.wait(self.interval) and time.monotonic() < deadline:
+            names = {t.ident: t.name for t in threading.enumerate()}
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own or is_idle(frame):
+                    continue
+                self.stacks[folded_stack(frame, names.get(thread_id, str(thread_id)))] += 1
+            self.samples += 1
+        with self._lock:
+            self._requests_left = None
+        write_folded(self.path, self.stacks)
+        logger.info(f"Сэмплирование завершено: {self.samples} снимков, {len(self.stacks)} стеков → {self.path}")
+
+    def top(self, n: int = 5) -> list[tuple[str, int]]:
+        """Функции, чаще всего оказывавшиеся на вершине стека (собственное время)."""
+        leaves: Counter = Counter()
+        for stack, count in self.stacks.items():
+            leaves[stack.rsplit(";", 1)[-1]] += count
+        return leaves.most_common(n)
+
+
+class SlowRequestProfiler:
+    """cProfile запросов; дампы сохраняются только для запросов дольше threshold секунд."""
+
+    def __init__(self, output_dir: str, threshold: Optional[float] = None, max_dumps: int = 50):
+        self.output_dir = output_dir
+        self.threshold = threshold
+        self.max_dumps = max_dumps
+        self.dumps = 0
+        self.on_request: Optional[Callable[[], None]] = None
+
+    def profile(self, name: str) -> Callable:
+        """Декоратор: профилирует вызовы функции, пока задан threshold."""
+        def decorator(func):
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                try:
+                    if self.threshold is None:
+                        return func(*args, **kwargs)
+                    return self._profiled(name, func, args, kwargs)
+                finally:
+                    if self.on_request is not None:
+                        self.on_request()
+            return wrapper
+        return decorator
+
+    def _profiled(self, name: str, func, args, kwargs):
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:  # в этом потоке уже работает другой профайлер
+            return func(*args, **kwargs)
+        start = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            profile.disable()
+            elapsed = time.perf_counter() - start
+            threshold = self.threshold
+            if threshold is not None and elapsed >= threshold:
+                self._dump(name, profile, elapsed)
+
+    def _dump(self, name: str, profile: cProfile.Profile, elapsed: float) -> None:
+        os.makedirs(self.output_dir, exist_ok=True)
+        path = os.path.join(self.output_dir, f"slow-{name}-{_timestamp()}-{elapsed * 1000:.0f}ms.prof")
+        profile.dump_stats(path)
+        self.dumps += 1
+        logger.warning(f"Медленный запрос {name}: {elapsed * 1000:.0f} мс → {path}")
+        dumps = sorted(
+            (os.path.join(self.output_dir, f) for f in os.listdir(self.output_dir) if f.startswith("slow-") and f.endswith(".prof")),
+            key=os.path.getmtime,
+        )
+        for old in dumps[:-self.max_dumps]:
+            os.remove(old)
+
+
+class LoopLagMonitor:
+    """Замечает блокировки event loop и пишет в лог обработчик, который его держит.
+
+    Корутина-пульс в event loop отмечает время каждые interval секунд; сторожевой
+    поток, увидев, что пульса нет дольше threshold, снимает стек потока event loop.
+    """
+
+    def __init__(self, output_dir: str, threshold: float = 0.1, interval: float = 0.02):
+        self.output_dir = output_dir
+        self.threshold = threshold
+        self.interval = interval
+        self.blockers: Counter = Counter()
+        self.stacks: Counter = Counter()
+        self.stalls = 0
+        self._tick = time.perf_counter()
+        self._loop_thread: Optional[int] = None
+        self._blocker: Optional[str] = None
+        self._task: Optional[asyncio.Task] = None
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    def start(self) -> None:
+        """Запускает мониторинг; вызывается из работающего event loop."""
+        if self.running:
+            return
+        self._loop_thread = threading.get_ident()
+        self._tick = time.perf_counter()
+        self._task = asyncio.get_running_loop().create_task(self._heartbeat())
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._watch, name="loop-lag-watchdog", daemon=True)
+        self._thread.start()
+        logger.info(f"Мониторинг event loop: порог {self.threshold * 1000:.0f} мс")
+
+    def stop(self) -> None:
+        self._stop.set()
+        if self._task is not None:
+            try:
+                self._task.get_loop().call_soon_threadsafe(self._task.cancel)
+            except RuntimeError:  # event loop уже закрыт
+                pass
+            self._task = None
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+            self._thread = None
+        if self.stacks:
+            write_folded(os.path.join(self.output_dir, "loop-lag.folded"), self.stacks)
+
+    async def _heartbeat(self) -> None:
+        while True:
+            expected = time.perf_counter() + self.interval
+            await asyncio.sleep(self.interval)
+            now = time.perf_counter()
+            lag = now - expected
+            self._tick = now
+            if lag >= self.threshold:
+                blocker, self._blocker = self._blocker, None
+                self.stalls += 1
+                logger.warning(f"Event loop заблокирован на {lag * 1000:.0f} мс: {blocker or 'обработчик не пойман'}")
+
+    def _watch(self) -> None:
+        reported_tick = None
+        while not self._stop.wait(self.interval / 2):
+            tick = self._tick
+            if tick == reported_tick or time.perf_counter() - tick < self.threshold:
+                continue
+            frame = sys._current_frames().get(self._loop_thread)
+            if frame is None:
+                continue
+            reported_tick = tick
+            blocker = project_frame(frame) or _frame_label(frame)
+            self._blocker = blocker
+            self.blockers[blocker] += 1
+            self.stacks[folded_stack(frame, "event-loop")] += 1
+
+
+sampler = SamplingProfiler(settings.profiling.output_dir, settings.profiling.sample_interval)
+slow_requests = SlowRequestProfiler(settings.profiling.output_dir, max_dumps=settings.profiling.max_dumps)
+slow_requests.on_request = sampler.note_request
+loop_monitor = LoopLagMonitor(settings.profiling.output_dir, settings.profiling.loop_lag_threshold)
+
+
+def start_from_settings() -> None:
+    """Включает профилирование по переменным окружения; вызывается из работающего event loop."""
+    cfg = settings.profiling
+    if cfg.enabled:
+        slow_requests.threshold = cfg.slow_request_seconds
+        loop_monitor.start()
+        logger.info(f"Профилирование включено: дампы запросов дольше {cfg.slow_request_seconds} с → {cfg.output_dir}")
+    if cfg.sample_seconds > 0:
+        sampler.start(seconds=cfg.sample_seconds)
+
+
+def shutdown() -> None:
+    if sampler.running:
+        sampler.stop()
+    loop_monitor.stop()
+
+
+PROFILE_HELP = """/profile <сек> — сэмплировать N секунд
+/profile requests <N> — сэмплировать до N ответов
+/profile slow <сек>|off — дампы cProfile запросов дольше порога
+/profile loop on|off — мониторинг блокировок event loop
+/profile stop — остановить сэмплирование
+/profile status — текущее состояние"""
+
+
+def handle_command(args: list[str]) -> str:
+    """Выполняет команду /profile и возвращает текст ответа."""
+    try:
+        if not args or args[0] == "help":
+            return PROFILE_HELP
+        command = args[0].lower()
+        if command == "status":
+            return status()
+        if command == "stop":
+            path = sampler.stop() if sampler.running else None
+            return f"Сэмплирование остановлено: {path}" if path else "Сэмплирование не запущено"
+        if command == "requests":
+            path = sampler.start(requests=int(args[1]))
+            return f"Сэмплирую до {args[1]} ответов → {path}"
+        if command == "slow":
+            if args[1].lower() in ("off", "0"):
+                slow_requests.threshold = None
+                return "Дампы медленных запросов выключены"
+            slow_requests.threshold = float(args[1])
+            return f"Дампы запросов дольше {slow_requests.threshold} с → {slow_requests.output_dir}"
+        if command == "loop":
+            if args[1].lower() == "on":
+                loop_monitor.start()
+                return f"Мониторинг event loop включён (порог {loop_monitor.threshold * 1000:.0f} мс)"
+            loop_monitor.stop()
+            return "Мониторинг event loop выключен"
+        seconds = float(command)
+        path = sampler.start(seconds=seconds)
+        return f"Сэмплирую {seconds:.0f} с → {path}"
+    except (IndexError, ValueError):
+        return PROFILE_HELP
+    except RuntimeError as e:
+        return str(e)
+
+
+def status() -> str:
+    lines = [
+        f"Сэмплирование: {'идёт → ' + sampler.path if sampler.running else 'нет'} ({sampler.samples} снимков)",
+        f"Медленные запросы: {f'порог {slow_requests.threshold} с, дампов {slow_requests.dumps}' if slow_requests.threshold is not None else 'выключено'}",
+        f"Event loop: {'мониторинг, блокировок ' + str(loop_monitor.stalls) if loop_monitor.running else 'нет мониторинга'}",
+    ]
+    lines += [f"  {count}× {blocker}" for blocker, count in loop_monitor.blockers.most_common(3)]
+    if sampler.stacks:
+        lines.append("Чаще всего на вершине стека:")
+        lines += [f"  {count}× {leaf}" for leaf, count in sampler.top()]
+    return "\n".join(lines)
+
+
+def is_admin(user_id: int) -> bool:
+    return user_id in settings.profiling.admin_ids
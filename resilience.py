@@ -0,0 +1,318 @@
+"""Устойчивость вызовов LLM: дедлайны, хеджирование, переключение на резерв, circuit breaker.
+
+ResilientChatModel оборачивает одну или несколько чат-моделей (основную и
+резервную из settings.openai) и предоставляет тот же метод invoke(prompt):
+
+- у каждого вызова есть общий дедлайн (settings.openai.call_timeout);
+- если ответ не пришёл за p95 недавних задержек, отправляется второй
+  (хеджированный) запрос — на резервную модель, если она есть;
+- при ошибке запрос повторяется на следующей модели;
+- circuit breaker перестаёт слать трафик в модель после серии ошибок.
+
+Токены вызовов (и сколько из них пришло из кеша префикса) копятся в counters, а
+для вызовов внутри `with track_usage() as usage:` — ещё и в usage. Учитываются и
+проигравшие хеджированные запросы: они тоже оплачиваются.
+"""
+import contextvars
+import logging
+import threading
+import time
+from collections import Counter, deque
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from typing import Callable, Iterator, Optional
+
+logger = logging.getLogger('LLM')
+
+_usage: contextvars.ContextVar[Optional[Counter]] = contextvars.ContextVar("llm_usage", default=None)
+
+
+@contextmanager
+def track_usage() -> Iterator[Counter]:
+    """Счётчик токенов (см. usage_of) и числа вызовов LLM в этом контексте."""
+    usage: Counter = Counter()
+    token = _usage.set(usage)
+    try:
+        yield usage
+    finally:
+        _usage.reset(token)
+
+
+def usage_of(result) -> Counter:
+    """Токены ответа модели из usage_metadata: prompt_tokens, cached_prompt_tokens (из кеша префикса), completion_tokens."""
+    metadata = getattr(result, "usage_metadata", None) or {}
+    return Counter({
+        "prompt_tokens": metadata.get("input_tokens", 0),
+        "cached_prompt_tokens": (metadata.get("input_token_details") or {}).get("cache_read", 0),
+        "completion_tokens": metadata.get("output_tokens", 0),
+    })
+
+
+def record_usage(tokens: Counter) -> None:
+    """Добавляет токены вызова в счётчик track_usage, если он открыт."""
+    usage = _usage.get()
+    if usage is None:
+        return
+    usage.update(tokens)
+    usage["calls"] += 1
+
+
+class LLMTimeoutError(TimeoutError):
+    """Ни одна модель не ответила до дедлайна."""
+
+
+class CircuitOpenError(RuntimeError):
+    """Все модели отключены circuit breaker'ом."""
+
+
+class CircuitBreaker:
+    """Классический breaker: closed → open после N ошибок подряд → half-open через reset_timeout."""
+
+    CLOSED, OPEN, HALF_OPEN = "closed", "open", "half_open"
+
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 30.0, clock: Callable[[], float] = time.monotonic):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._opened_at = 0.0
+        self._trial_in_flight = False
+        self.state = self.CLOSED
+
+    def allow(self) -> bool:
+        """Можно ли отправить запрос. В half-open пропускает один пробный запрос."""
+        with self._lock:
+            if self.state == self.OPEN and self._clock() - self._opened_at >= self.reset_timeout:
+                self.state = self.HALF_OPEN
+                self._trial_in_flight = False
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.HALF_OPEN and not self._trial_in_flight:
+                self._trial_in_flight = True
+                return True
+            return False
+
+    def record_success(self) -> None:
+        with self._lock:
+            self._failures = 0
+            self._trial_in_flight = False
+            self.state = self.CLOSED
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self._failures += 1
+            self._trial_in_flight = False
+            if self.state == self.HALF_OPEN or self._failures >= self.failure_threshold:
+                if self.state != self.OPEN:
+                    logger.warning(f"Circuit breaker открыт после {self._failures} ошибок")
+                self.state = self.OPEN
+                self._opened_at = self._clock()
+
+
+class LatencyWindow:
+    """Скользящее окно последних задержек для оценки перцентилей."""
+
+    def __init__(self, size: int = 200):
+        self._values: deque[float] = deque(maxlen=size)
+        self._lock = threading.Lock()
+
+    def add(self, value: float) -> None:
+        with self._lock:
+            self._values.append(value)
+
+    def __len__(self) -> int:
+        return len(self._values)
+
+    def quantile(self, q: float) -> Optional[float]:
+        with self._lock:
+            if not self._values:
+                return None
+            ordered = sorted(self._values)
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+@dataclass
+class Endpoint:
+    """Модель с собственным breaker'ом и статистикой задержек."""
+    name: str
+    model: object
+    breaker: CircuitBreaker
+    latencies: LatencyWindow = field(default_factory=LatencyWindow)
+
+
+class ResilientChatModel:
+    """Обёртка над чат-моделями с дедлайном, хеджированием, failover и circuit breaker."""
+
+    def __init__(
+        self,
+        endpoints: list[tuple[str, object]],
+        call_timeout: float = 20.0,
+        hedge: bool = False,
+        hedge_quantile: float = 0.95,
+        hedge_min_delay: float = 0.5,
+        hedge_initial_delay: float = 2.0,
+        hedge_min_samples: int = 10,
+        failure_threshold: int = 5,
+        reset_timeout: float = 30.0,
+        max_workers: int = 16,
+    ):
+        if not endpoints:
+            raise ValueError("Нужна хотя бы одна модель")
+        self.endpoints = [Endpoint(name, model, CircuitBreaker(failure_threshold, reset_timeout)) for name, model in endpoints]
+        self.call_timeout = call_timeout
+        self.hedge = hedge
+        self.hedge_quantile = hedge_quantile
+        self.hedge_min_delay = hedge_min_delay
+        self.hedge_initial_delay = hedge_initial_delay
+        self.hedge_min_samples = hedge_min_samples
+        self.counters: Counter = Counter()
+        self._lock = threading.Lock()  # счётчики токенов пишутся из рабочих потоков
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="llm")
+
+    @classmethod
+    def from_settings(cls, primary: object, secondary: Optional[object] = None) -> "ResilientChatModel":
+        """Создаёт обёртку с параметрами из settings.openai."""
+        from settings import settings
+        cfg = settings.openai
+        endpoints = [("primary", primary)]
+        if secondary is not None:
+            endpoints.append(("secondary", secondary))
+        return cls(
+            endpoints,
+            call_timeout=cfg.call_timeout,
+            hedge=cfg.hedge_enabled,
+            hedge_quantile=cfg.hedge_quantile,
+            hedge_min_delay=cfg.hedge_min_delay,
+            failure_threshold=cfg.breaker_failure_threshold,
+            reset_timeout=cfg.breaker_reset_timeout,
+            max_workers=cfg.max_connections,
+        )
+
+    def hedge_delay(self, endpoint: Endpoint) -> float:
+        """Задержка перед хеджированным запросом: p95 недавних ответов, но не меньше минимума."""
+        if len(endpoint.latencies) < self.hedge_min_samples:
+            return self.hedge_initial_delay
+        return max(self.hedge_min_delay, endpoint.latencies.quantile(self.hedge_quantile))
+
+    def _call(self, endpoint: Endpoint, prompt, kwargs: dict):
+        start = time.monotonic()
+        result = endpoint.model.invoke(prompt, **kwargs)
+        endpoint.latencies.add(time.monotonic() - start)
+        tokens = usage_of(result)
+        with self._lock:
+            self.counters.update(tokens)
+        record_usage(tokens)
+        return result
+
+    def _count(self, name: str) -> None:
+        with self._lock:
+            self.counters[name] += 1
+
+    def invoke(self, prompt, timeout: Optional[float] = None, **kwargs):
+        """Вызывает модель с дедлайном. Возвращает ответ первой успешно ответившей модели."""
+        self._count("calls")
+        started = time.monotonic()
+        deadline = started + (self.call_timeout if timeout is None else timeout)
+        # breaker спрашивается только перед отправкой: allow() в half-open занимает пробный запрос,
+        # и модель, которой так и не отправили запрос, не должна держать его занятым
+        remaining = iter(self.endpoints)
+
+        def next_endpoint() -> Optional[Endpoint]:
+            return next((e for e in remaining if e.breaker.allow()), None)
+
+        first = next_endpoint()
+        if first is None:
+            self._count("circuit_rejected")
+            raise CircuitOpenError("Все модели временно отключены circuit breaker'ом")
+
+        pending: dict[Future, tuple[Endpoint, bool]] = {}
+        hedged = False
+        last_error: Optional[BaseException] = None
+
+        def launch(endpoint: Endpoint, is_hedge: bool = False) -> None:
+            # копия контекста — чтобы track_usage вызывающего видел токены из рабочего потока
+            call = contextvars.copy_context().run
+            pending[self._executor.submit(call, self._call, endpoint, prompt, kwargs)] = (endpoint, is_hedge)
+
+        launch(first)
+        hedge_at = started + self.hedge_delay(first)
+
+        while pending:
+            now = time.monotonic()
+            if now >= deadline:
+                break
+            wait_for = deadline - now
+            if self.hedge and not hedged:
+                wait_for = max(0.0, min(wait_for, hedge_at - now))
+            done, _ = wait(pending, timeout=wait_for, return_when=FIRST_COMPLETED)
+
+            if not done:
+                if self.hedge and not hedged and time.monotonic() >= hedge_at:
+                    hedged = True
+                    target = next_endpoint() or (first if first.breaker.allow() else None)
+                    if target is not None:
+                        self._count("hedges")
+                        launch(target, is_hedge=True)
+                continue
+
+            for future in done:
+                endpoint, is_hedge = pending.pop(future)
+                try:
+                    result = future.result()
+                except Exception as e:
+                    endpoint.breaker.record_failure()
+                    self._count(f"failures_{endpoint.name}")
+                    last_error = e
+                    logger.warning(f"Ошибка модели {endpoint.name}: {type(e).__name__}: {e}")
+                    continue
+                endpoint.breaker.record_success()
+                with self._lock:
+                    self.counters["successes"] += 1
+                    self.counters[f"successes_{endpoint.name}"] += 1
+                    if is_hedge:
+                        self.counters["hedge_wins"] += 1
+                return result
+
+            if not pending:
+                target = next_endpoint()
+                if target is not None:
+                    self._count("failovers")
+                    launch(target)
+
+        if pending:
+            for endpoint, _ in pending.values():
+                endpoint.breaker.record_failure()
+            self._count("timeouts")
+            raise LLMTimeoutError(f"LLM не ответила за {deadline - started:.1f} с")
+        self._count("errors")
+        raise last_error
+
+    def metrics(self) -> dict:
+        """Счётчики, состояние breaker'ов и перцентили задержек по моделям."""
+        endpoints = {}
+        for e in self.endpoints:
+            endpoints[e.name] = {
+                "circuit": e.breaker.state,
+                "p50": e.latencies.quantile(0.5),
+                "p95": e.latencies.quantile(0.95),
+                "hedge_delay": self.hedge_delay(e),
+            }
+        with self._lock:
+            counters = dict(self.counters)
+        return {"counters": counters, "endpoints": endpoints}
+
+
+def render_prometheus(metrics: dict, prefix: str = "llm") -> str:
+    """Метрики ResilientChatModel в текстовом формате Prometheus."""
+    lines = []
+    for name, value in sorted(metrics["counters"].items()):
+        lines.append(f"{prefix}_{name}_total {value}")
+    states = {CircuitBreaker.CLOSED: 0, CircuitBreaker.HALF_OPEN: 1, CircuitBreaker.OPEN: 2}
+    for endpoint, data in metrics["endpoints"].items():
+        lines.append(f'{prefix}_circuit_state{{endpoint="{endpoint}"}} {states[data["circuit"]]}')
+        for q in ("p50", "p95"):
+            if data[q] is not None:
+                lines.append(f'{prefix}_latency_seconds{{endpoint="{endpoint}",quantile="{q[1:]}"}} {data[q]:.4f}')
+    return "\n".join(lines) + "\n"
@@ -6,11 +6,16 @@ from dotenv import load_dotenv
 load_dotenv("keys.env")
 
 
+def _env_flag(name: str, default: bool = False) -> bool:
+    return os.getenv(name, "1" if default else "0").strip().lower() in ("1", "true", "yes", "on")
+
+
 @dataclass(frozen=True)
 class BotSettings:
     """Настройки бота."""
     token: str = field(default_factory=lambda: os.getenv("MAX_VK_BOT_TOKEN", ""))
     username: str = field(default_factory=lambda: os.getenv("MAX_VK_BOT_USERNAME", ""))
+    import_budget: float = 1.0
 
 
 @dataclass(frozen=True)
@@ -21,6 +26,22 @@ class OpenAISettings:
     model: str = "gpt-4o-mini"
     embedding_model: str = "text-embedding-ada-002"
     temperature: float = 0.0
+    connect_timeout: float = 5.0
+    read_timeout: float = 30.0
+    max_connections: int = 20
+    max_keepalive_connections: int = 10
+    keepalive_expiry: float = 60.0
+    http2: bool = field(default_factory=lambda: _env_flag("OPENAI_HTTP2"))
+    prewarm_connections: int = 2
+    call_timeout: float = 20.0
+    hedge_enabled: bool = field(default_factory=lambda: _env_flag("LLM_HEDGE"))
+    hedge_quantile: float = 0.95
+    hedge_min_delay: float = 0.5
+    fallback_model: str = field(default_factory=lambda: os.getenv("OPENAI_FALLBACK_MODEL", ""))
+    fallback_api_base: str = field(default_factory=lambda: os.getenv("OPENAI_FALLBACK_API_BASE", ""))
+    fallback_api_key: str = field(default_factory=lambda: os.getenv("OPENAI_FALLBACK_API_KEY", ""))
+    breaker_failure_threshold: int = 5
+    breaker_reset_timeout: float = 30.0
 
 
 @dataclass(frozen=True)
@@ -30,8 +51,124 @@ class RAGSettings:
     bachelor_index_dir: str = "faiss_index_bachelor"
     master_index_dir: str = "faiss_index_master"
     retriever_k: int = 7
+    adaptive_retrieval: bool = field(default_factory=lambda: _env_flag("ADAPTIVE_RETRIEVAL"))
+    retriever_min_k: int = 2
+    retriever_max_k: int = 7
+    retriever_max_distance: float = 0.45
+    retriever_score_gap: float = 0.1
+    cross_level_search: bool = field(default_factory=lambda: _env_flag("CROSS_LEVEL_SEARCH"))
+    cross_levels: tuple[str, ...] = ("bachelor", "master")
+    answer_budget: float = field(default_factory=lambda: float(os.getenv("ANSWER_BUDGET_SECONDS", "0")))
+    fallback_chunks: int = 3
+    fallback_sentences: int = 2
     max_question_length: int = 500
     min_question_length: int = 3
+    topic_batching: bool = field(default_factory=lambda: _env_flag("TOPIC_BATCHING"))
+    topic_batch_window: float = 0.005
+    topic_batch_max_size: int = 16
+    embedding_batching: bool = field(default_factory=lambda: _env_flag("EMBEDDING_BATCHING"))
+    embedding_batch_window: float = 0.005
+    embedding_batch_max_size: int = 32
+    reload_interval: float = 30.0
+    index_keep_versions: int = 2
+    registry_path: str = "indexes.json"
+    index_compression: str = "none"
+    pca_dim: int = 256
+    ingest_batch_size: int = 256
+    ingest_jobs: int = 0
+    dedup_threshold: float = field(default_factory=lambda: float(os.getenv("DEDUP_THRESHOLD", "0")))
+    index_memory_budget_mb: int = 1024
+
+
+@dataclass(frozen=True)
+class GroupSettings:
+    """Настройки очередей группового бота."""
+    max_queue_per_chat: int = 5
+    max_in_flight_per_chat: int = 1
+    debounce_seconds: float = 10.0
+    collapse_similarity: float = 0.8
+
+
+@dataclass(frozen=True)
+class DMSettings:
+    """Настройки бота в ЛС: контекст диалога и поздние ответы LLM."""
+    follow_up: bool = True
+    session_ttl: float = 900.0
+    session_memory_budget_kb: int = 4096
+    late_answer_edit: bool = True
+
+
+@dataclass(frozen=True)
+class WebhookSettings:
+    """Настройки приёма обновлений через webhook (см. webhook.py)."""
+    enabled: bool = field(default_factory=lambda: _env_flag("WEBHOOK"))
+    url: str = field(default_factory=lambda: os.getenv("WEBHOOK_URL", ""))
+    secret: str = field(default_factory=lambda: os.getenv("WEBHOOK_SECRET", ""))
+    host: str = field(default_factory=lambda: os.getenv("WEBHOOK_HOST", "0.0.0.0"))
+    port: int = field(default_factory=lambda: int(os.getenv("WEBHOOK_PORT", "8080")))
+    path: str = "/webhook"
+    queue_size: int = 1000
+    dedup_size: int = 10000
+
+
+@dataclass(frozen=True)
+class LoggingSettings:
+    """Настройки логирования."""
+    queued: bool = field(default_factory=lambda: _env_flag("LOG_QUEUE"))
+    json_format: bool = field(default_factory=lambda: _env_flag("LOG_JSON"))
+    user_sample_rate: float = field(default_factory=lambda: float(os.getenv("LOG_USER_SAMPLE_RATE", "1.0")))
+    queue_size: int = 10000
+
+
+def _env_ids(name: str) -> tuple[int, ...]:
+    return tuple(int(x) for x in os.getenv(name, "").replace(",", " ").split() if x.strip().isdigit())
+
+
+@dataclass(frozen=True)
+class ProfilingSettings:
+    """Настройки профилирования работающего бота (см. profiling.py)."""
+    enabled: bool = field(default_factory=lambda: _env_flag("PROFILING"))
+    sample_seconds: float = field(default_factory=lambda: float(os.getenv("PROFILE_SAMPLE_SECONDS", "0")))
+    admin_ids: tuple[int, ...] = field(default_factory=lambda: _env_ids("ADMIN_USER_IDS"))
+    output_dir: str = "data/profiles"
+    sample_interval: float = 0.005
+    slow_request_seconds: float = 5.0
+    loop_lag_threshold: float = 0.1
+    max_dumps: int = 50
+
+
+def _env_questions(name: str, default: tuple[str, ...]) -> tuple[str, ...]:
+    raw = os.getenv(name, "")
+    return tuple(q.strip() for q in raw.split("|") if q.strip()) or default
+
+
+@dataclass(frozen=True)
+class WarmupSettings:
+    """Прогрев перед приёмом обновлений и локальная проверка готовности (см. warmup.py)."""
+    enabled: bool = field(default_factory=lambda: _env_flag("WARMUP", default=True))
+    questions: tuple[str, ...] = field(default_factory=lambda: _env_questions("WARMUP_QUESTIONS", (
+        "Какие документы нужны для поступления?",
+        "Когда заканчивается прием документов?",
+        "Какие вступительные испытания?",
+    )))
+    levels: tuple[str, ...] = ("bachelor", "master")
+    min_rounds: int = 2
+    max_rounds: int = 4
+    steady_tolerance: float = 0.2
+    stage_timeout: float = 30.0
+    timeout: float = 120.0
+    health_host: str = "127.0.0.1"
+    health_port: int = field(default_factory=lambda: int(os.getenv("HEALTH_PORT", "8081")))
+
+
+@dataclass(frozen=True)
+class StatsSettings:
+    """Настройки статистики пользователей."""
+    state_dir: str = "data/stats"
+    persist_interval: float = 60.0
+    hll_precision: int = 12
+    hours_window: int = 48
+    days_window: int = 30
 
 
 @dataclass(frozen=True)
@@ -40,6 +177,13 @@ class Settings:
     bot: BotSettings = field(default_factory=BotSettings)
     openai: OpenAISettings = field(default_factory=OpenAISettings)
     rag: RAGSettings = field(default_factory=RAGSettings)
+    group: GroupSettings = field(default_factory=GroupSettings)
+    dm: DMSettings = field(default_factory=DMSettings)
+    webhook: WebhookSettings = field(default_factory=WebhookSettings)
+    stats: StatsSettings = field(default_factory=StatsSettings)
+    logging: LoggingSettings = field(default_factory=LoggingSettings)
+    profiling: ProfilingSettings = field(default_factory=ProfilingSettings)
+    warmup: WarmupSettings = field(default_factory=WarmupSettings)
     
     def validate(self) -> list[str]:
         """Проверяет обязательные настройки. Возвращает список ошибок."""
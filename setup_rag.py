@@ -10,15 +10,40 @@
 
 Можно переопределить через аргументы командной строки:
   --bachelor PATH --master PATH --bachelor-out DIR --master-out DIR
+
+Сжатие векторов (см. index_compression.py):
+  --compression none|fp16|pca|pca-fp16 --pca-dim N
+
+Отсев почти одинаковых чанков (см. dedup.py; по умолчанию выключен, env DEDUP_THRESHOLD):
+  --dedup-threshold 0.85
+
+Папки и glob-шаблоны с PDF, Markdown и HTML (см. doc_ingest.py):
+  --bachelor-dir PATH [PATH ...] --master-dir PATH [PATH ...] --jobs N
 """
 
 import argparse
 import json
 import os
+import time
+from itertools import islice
 from pathlib import Path
-from langchain_community.embeddings import OpenAIEmbeddings
+from typing import Iterable, Iterator, Optional, TextIO
+
+import faiss
+from langchain_community.docstore.in_memory import InMemoryDocstore
 from langchain_community.vectorstores.faiss import FAISS
-from config import OPENAI_API_KEY, OPENAI_API_BASE
+from langchain_core.embeddings import Embeddings
+from langchain_openai import OpenAIEmbeddings
+
+from dedup import NearDuplicateFilter
+from doc_ingest import CACHE_DIR, IngestCache, discover_files, extract_files, iter_markdown_entries
+from http_clients import openai_client_kwargs, prewarm
+from index_compression import COMPRESSION_MODES, compress_vectorstore
+from index_store import SourceHasher, publish_version
+from settings import settings
+
+OPENAI_API_KEY = settings.openai.api_key
+OPENAI_API_BASE = settings.openai.api_base
 
 
 DEFAULT_BACHELOR_JSON = Path("data/rules2025.json")
@@ -27,16 +52,73 @@ DEFAULT_BACHELOR_OUT = Path("faiss_index_bachelor")
 DEFAULT_MASTER_OUT = Path("faiss_index_master")
 DEFAULT_BACHELOR_MD = Path("data/raw/bachelort_rules.md")
 
+# сколько символов может остаться от оборванного числа после его разобранного начала («e+» из «1e+5»)
+_SCALAR_TAIL = 2
 
-def load_json_entries(path: Path, default_source: str) -> list[dict]:
-    """Загружает массив объектов из JSON. Каждый объект должен содержать поле 'text'.
+
+def iter_json_array(f: TextIO, read_size: int = 1 << 20) -> Iterator:
+    """Потоково разбирает JSON-массив верхнего уровня: в памяти одновременно один элемент и буфер read_size."""
+    decoder = json.JSONDecoder()
+    buf, pos, eof = "", 0, False
+
+    def more() -> bool:
+        nonlocal buf, pos, eof
+        data = "" if eof else f.read(read_size)
+        if not data:
+            eof = True
+            return False
+        buf, pos = buf[pos:] + data, 0
+        return True
+
+    def peek() -> str:
+        """Следующий значимый символ (пробелы пропускаются) или "" в конце файла."""
+        nonlocal pos
+        while True:
+            while pos < len(buf) and buf[pos] in " \t\r\n\ufeff":
+                pos += 1
+            if pos < len(buf) or not more():
+                return buf[pos] if pos < len(buf) else ""
+
+    def decode():
+        nonlocal pos
+        while True:
+            try:
+                value, end = decoder.raw_decode(buf, pos)
+            except json.JSONDecodeError:
+                if more():
+                    continue
+                raise
+            # число на границе буфера могло оборваться («1.» из «1.5e3») — дочитываем и разбираем заново
+            if not isinstance(value, (str, list, dict)) and len(buf) - end <= _SCALAR_TAIL and more():
+                continue
+            pos = end
+            return value
+
+    char = peek()
+    if char != "[":
+        raise ValueError(f"Ожидался массив JSON, получено: {char!r}" if char else "Пустой JSON")
+    pos += 1
+    if peek() == "]":
+        return
+    while True:
+        if not peek():
+            raise ValueError("Неожиданный конец JSON: массив не закрыт")
+        yield decode()
+        char = peek()
+        if char == "]":
+            return
+        if char != ",":
+            raise ValueError(f"Ожидалась «,» или «]» после элемента массива, получено: {char!r}" if char else "Неожиданный конец JSON: массив не закрыт")
+        pos += 1
+        if peek() in (",", "]"):
+            raise ValueError("Пропущен элемент массива JSON между запятыми")
+
+
+def iter_json_entries(path: Path, default_source: str) -> Iterator[dict]:
+    """Потоково читает массив объектов из JSON. Каждый объект должен содержать поле 'text'.
     Добавляет поле 'source' для трассировки происхождения."""
     with open(path, encoding="utf-8") as f:
-        data = json.load(f)
-        if not isinstance(data, list):
-            raise ValueError(f"Ожидался массив JSON в {path}, получено: {type(data)}")
-        entries = []
-        for entry in data:
+        for entry in iter_json_array(f):
             if not isinstance(entry, dict) or "text" not in entry:
                 # допускаем простые строки и преобразуем их в объекты
                 if isinstance(entry, str):
@@ -45,115 +127,254 @@ def load_json_entries(path: Path, default_source: str) -> list[dict]:
                     raise ValueError(f"Запись не является объектом с ключом 'text': {entry}")
             e = entry.copy()
             e.setdefault("source", default_source)
-            entries.append(e)
-        return entries
-
-
-def build_and_save_index(entries: list[dict], out_dir: Path):
-    def _split_text(text: str, chunk_size: int = 500, chunk_overlap: int = 50) -> list[str]:
-        text = text or ""
-        if chunk_size <= 0:
-            return [text]
-        chunks = []
-        start = 0
-        n = len(text)
-        while start < n:
-            end = min(start + chunk_size, n)
-            chunks.append(text[start:end])
-            if end == n:
-                break
-            start = end - chunk_overlap if end - chunk_overlap > start else end
-        return chunks
-    texts: list[str] = []
-    metadatas: list[dict] = []
+            yield e
+
+
+def load_json_entries(path: Path, default_source: str) -> list[dict]:
+    """Загружает все записи JSON списком (см. iter_json_entries)."""
+    return list(iter_json_entries(path, default_source))
+
+
+def split_text(text: str, chunk_size: int = 500, chunk_overlap: int = 50) -> list[str]:
+    """Режет текст на чанки фиксированной длины с перекрытием."""
+    text = text or ""
+    if chunk_size <= 0:
+        return [text]
+    chunks = []
+    start = 0
+    n = len(text)
+    while start < n:
+        end = min(start + chunk_size, n)
+        chunks.append(text[start:end])
+        if end == n:
+            break
+        start = end - chunk_overlap if end - chunk_overlap > start else end
+    return chunks
+
 
+def iter_chunks(entries: Iterable[dict]) -> Iterator[tuple[str, dict]]:
+    """Разбивает записи на чанки: (текст, метаданные)."""
     for entry in entries:
-        parts = _split_text(entry.get("text", ""))
-        for part in parts:
-            texts.append(part)
+        for part in split_text(entry.get("text", "")):
             meta = {"source": entry.get("source", "unknown")}
             if "metadata" in entry and isinstance(entry["metadata"], dict):
                 meta.update(entry["metadata"])
             # Если у записи есть раздел/секция — добавим
             if "section" in entry:
                 meta["section"] = entry["section"]
-            metadatas.append(meta)
+            yield part, meta
 
-    if not texts:
+
+def iter_batches(items: Iterable, size: int) -> Iterator[list]:
+    iterator = iter(items)
+    while batch := list(islice(iterator, size)):
+        yield batch
+
+
+def build_vectorstore(
+    chunks: Iterable[tuple[str, dict]],
+    embeddings: Embeddings,
+    batch_size: int = settings.rag.ingest_batch_size,
+    hasher: Optional[SourceHasher] = None,
+    deduper: Optional[NearDuplicateFilter] = None,
+) -> FAISS:
+    """Эмбеддит чанки пачками по batch_size и сразу добавляет их в индекс.
+
+    В памяти кроме самого индекса (векторы + docstore) держится одна пачка.
+    С deduper почти одинаковые чанки не эмбеддятся: их метаданные сливаются в уже оставленный.
+    """
+    vectorstore = None
+    for batch in iter_batches(chunks, batch_size):
+        if hasher is not None:
+            for text, meta in batch:
+                hasher.update(text, meta)
+        if deduper is not None:
+            batch = [(text, meta) for text, meta in batch if deduper.check(text, meta) is None]
+            if not batch:
+                continue
+        texts = [text for text, _ in batch]
+        metadatas = [meta for _, meta in batch]
+        vectors = embeddings.embed_documents(texts)
+        if vectorstore is None:
+            vectorstore = FAISS(embeddings, faiss.IndexFlatL2(len(vectors[0])), InMemoryDocstore(), {})
+        ids = vectorstore.add_embeddings(list(zip(texts, vectors)), metadatas=metadatas)
+        if deduper is not None:
+            _attach_docstore(deduper, vectorstore, ids)
+    if vectorstore is None:
         raise ValueError("После разбиения не осталось текста для индексации.")
+    return vectorstore
+
 
-    embeddings = OpenAIEmbeddings(
-        model="text-embedding-ada-002",
+def _attach_docstore(deduper: NearDuplicateFilter, vectorstore: FAISS, ids: list[str]) -> None:
+    """Дальнейшие дубликаты этих чанков сливаются в метаданные документов docstore."""
+    deduper.attach(deduper.kept - len(ids), [vectorstore.docstore.search(i).metadata for i in ids], ids)
+
+
+def make_deduper(threshold: float) -> Optional[NearDuplicateFilter]:
+    return NearDuplicateFilter(threshold) if threshold > 0 else None
+
+
+def _dedup_manifest(deduper: Optional[NearDuplicateFilter]) -> dict:
+    """Статистика отсева и список слияний для манифеста (пусто, если отсев выключен)."""
+    return {**deduper.stats(), "merged": deduper.merged()} if deduper else {}
+
+
+def make_embeddings() -> OpenAIEmbeddings:
+    return OpenAIEmbeddings(
+        model=settings.openai.embedding_model,
         openai_api_key=OPENAI_API_KEY,
         openai_api_base=OPENAI_API_BASE,
+        **openai_client_kwargs(),
     )
 
-    vectorstore = FAISS.from_texts(texts, embeddings, metadatas=metadatas)
-    out_dir.mkdir(parents=True, exist_ok=True)
-    vectorstore.save_local(str(out_dir))
 
+def _publish_vectorstore(
+    vectorstore: FAISS,
+    hasher: SourceHasher,
+    out_dir: Path,
+    compression: str,
+    pca_dim: int,
+    extra: Optional[dict] = None,
+) -> dict:
+    chunks = vectorstore.index.ntotal
+    compression_info = compress_vectorstore(vectorstore, compression, pca_dim)
+    # новая версия кладётся рядом со старой и включается атомарной заменой manifest.json —
+    # запущенные боты подхватят её без рестарта
+    return publish_version(
+        vectorstore.save_local, str(out_dir),
+        keep=settings.rag.index_keep_versions,
+        digest=hasher.hexdigest(),
+        extra={"chunks": chunks, **(extra or {}), **compression_info},
+    )
 
-def _parse_markdown_to_entries(md_text: str, default_source: str) -> list[dict]:
-    """Парсит Markdown в список записей вида {text, source, section}.
 
-    Заголовки #, ##, ### формируют иерархию; в метаданные кладём 'section' как путь "H1 > H2 > H3".
-    Текст каждой секции будет дополнен заголовочным путём в начале, чтобы сохранить контекст при разбиении.
+def build_and_save_index(
+    entries: Iterable[dict],
+    out_dir: Path,
+    compression: str = settings.rag.index_compression,
+    pca_dim: int = settings.rag.pca_dim,
+    embeddings: Optional[Embeddings] = None,
+    dedup_threshold: float = settings.rag.dedup_threshold,
+) -> dict:
+    """Строит индекс из потока записей и публикует его новой версией в out_dir. Возвращает манифест.
+
+    Почти одинаковые чанки отсеиваются (dedup_threshold, см. dedup.py); число слитых — в манифесте.
+    """
+    hasher = SourceHasher(f"{settings.openai.embedding_model}|{compression}|{pca_dim}|dedup{dedup_threshold}")
+    deduper = make_deduper(dedup_threshold)
+    vectorstore = build_vectorstore(iter_chunks(entries), embeddings or make_embeddings(), hasher=hasher, deduper=deduper)
+    return _publish_vectorstore(vectorstore, hasher, out_dir, compression, pca_dim, extra=_dedup_manifest(deduper))
+
+
+def build_index_from_files(
+    patterns: Iterable[str],
+    out_dir: Path,
+    default_source: str,
+    jobs: Optional[int] = None,
+    compression: str = settings.rag.index_compression,
+    pca_dim: int = settings.rag.pca_dim,
+    embeddings: Optional[Embeddings] = None,
+    dedup_threshold: float = settings.rag.dedup_threshold,
+) -> dict:
+    """Строит индекс из папок/glob-шаблонов с PDF, Markdown и HTML.
+
+    Файлы разбираются в jobs процессах (по умолчанию rag.ingest_jobs или число CPU), пока
+    основной процесс эмбеддит уже разобранные. Файлы, не изменившиеся с прошлой сборки,
+    берутся из кеша out_dir/.ingest-cache без разбора и эмбеддингов.
+    Возвращает манифест; статистика разбора — в ключе "ingest".
     """
-    lines = md_text.splitlines()
-    heading_stack: list[tuple[int, str]] = []  # (level, title)
-    current_buf: list[str] = []
-    entries: list[dict] = []
-
-    def heading_path() -> str:
-        return " > ".join(title for _, title in heading_stack)
-
-    def flush_section():
-        if current_buf:
-            section_text = "\n".join(current_buf).strip()
-            if section_text:
-                path = heading_path()
-                prefix = (path + "\n\n") if path else ""
-                entries.append({
-                    "text": prefix + section_text,
-                    "source": default_source,
-                    "section": path if path else None,
-                })
-
-    for raw in lines:
-        line = raw.rstrip()
-        # Определяем заголовок: начиная с #
-        if line.lstrip().startswith("#"):
-            # Считаем уровень
-            stripped = line.lstrip()
-            i = 0
-            while i < len(stripped) and stripped[i] == '#':
-                i += 1
-            level = i  # 1..6
-            title = stripped[i:].strip(" #\t")
-            # Сбрасываем предыдущую секцию
-            flush_section()
-            current_buf = []
-            # Обновляем стек заголовков
-            while heading_stack and heading_stack[-1][0] >= level:
-                heading_stack.pop()
-            heading_stack.append((level, title))
-        else:
-            current_buf.append(line)
-
-    flush_section()
-
-    # Уберём None из метаданных section
-    for e in entries:
-        if e.get("section") is None:
-            e.pop("section", None)
-    return entries
-
-
-def build_index_from_markdown(md_path: Path, out_dir: Path, default_source: str):
-    """Строит FAISS-индекс из Markdown-файла."""
-    text = md_path.read_text(encoding="utf-8")
-    entries = _parse_markdown_to_entries(text, default_source=default_source)
-    build_and_save_index(entries, out_dir)
+    patterns = list(patterns)
+    files = discover_files(patterns)
+    if not files:
+        raise FileNotFoundError(f"Не найдено PDF/Markdown/HTML файлов: {', '.join(map(str, patterns))}")
+    jobs = jobs or settings.rag.ingest_jobs or os.cpu_count() or 1
+    embeddings = embeddings or make_embeddings()
+    model = settings.openai.embedding_model
+    cache = IngestCache(Path(out_dir) / CACHE_DIR, model)
+    keys = {path: cache.key(path) for path in files}
+    todo = [path for path in files if not cache.has(keys[path])]
+
+    stats = {"files": len(files), "reused": len(files) - len(todo), "extracted_pages": 0, "failed": []}
+    started = time.perf_counter()
+    for extracted in extract_files(todo, default_source, jobs):
+        if extracted.error:
+            stats["failed"].append(extracted.path)
+            print(f"⚠️ Не удалось разобрать {extracted.path}: {extracted.error}")
+            continue
+        chunks = list(iter_chunks(extracted.entries))
+        vectors = [
+            vector
+            for batch in iter_batches(chunks, settings.rag.ingest_batch_size)
+            for vector in embeddings.embed_documents([text for text, _ in batch])
+        ]
+        cache.save(keys[Path(extracted.path)], chunks, vectors, extracted.pages)
+        stats["extracted_pages"] += extracted.pages
+    stats["seconds"] = time.perf_counter() - started
+
+    # индекс собирается из кеша в порядке файлов — результат не зависит от jobs
+    hasher = SourceHasher(f"{model}|{compression}|{pca_dim}|dedup{dedup_threshold}")
+    deduper = make_deduper(dedup_threshold)
+    vectorstore = None
+    pages = 0
+    for path in files:
+        if not cache.has(keys[path]):
+            continue
+        chunks, vectors, file_pages = cache.load(keys[path])
+        pages += file_pages
+        if not chunks:
+            continue
+        for text, meta in chunks:
+            hasher.update(text, meta)
+        if deduper is not None:
+            # векторы дубликатов уже в кеше, но в индекс они не попадают
+            keep = [i for i, (text, meta) in enumerate(chunks) if deduper.check(text, meta) is None]
+            chunks, vectors = [chunks[i] for i in keep], vectors[keep]
+            if not chunks:
+                continue
+        if vectorstore is None:
+            vectorstore = FAISS(embeddings, faiss.IndexFlatL2(vectors.shape[1]), InMemoryDocstore(), {})
+        ids = vectorstore.add_embeddings(zip([text for text, _ in chunks], vectors), metadatas=[meta for _, meta in chunks])
+        if deduper is not None:
+            _attach_docstore(deduper, vectorstore, ids)
+    if vectorstore is None:
+        raise ValueError("После разбора файлов не осталось текста для индексации.")
+    cache.prune(set(keys.values()))
+    manifest = _publish_vectorstore(
+        vectorstore, hasher, out_dir, compression, pca_dim,
+        extra={"files": len(files), "pages": pages, **_dedup_manifest(deduper)},
+    )
+    return {**manifest, "ingest": stats}
+
+
+def _parse_markdown_to_entries(md_text: str, default_source: str) -> list[dict]:
+    """Парсит Markdown-текст в список записей (см. iter_markdown_entries)."""
+    return list(iter_markdown_entries(md_text.splitlines(), default_source))
+
+
+def build_index_from_markdown(md_path: Path, out_dir: Path, default_source: str, **compression) -> dict:
+    """Строит FAISS-индекс из Markdown-файла, читая его построчно."""
+    with open(md_path, encoding="utf-8") as f:
+        return build_and_save_index(iter_markdown_entries(f, default_source=default_source), out_dir, **compression)
+
+
+def _dedup_summary(manifest: dict) -> str:
+    if not manifest.get("chunks_in"):
+        return "Отсев дубликатов выключен."
+    dropped = manifest["duplicates_dropped"]
+    lines = [f"Почти одинаковых чанков слито: {dropped} из {manifest['chunks_in']} (−{dropped / manifest['chunks_in']:.1%} индекса)."]
+    for merge in manifest.get("merged", []):
+        where = merge["metadata"].get("section") or merge["metadata"].get("source") or "—"
+        lines.append(f"  → {merge['into']} ← [{where}] {merge['text']}")
+    return "\n".join(lines)
+
+
+def _files_summary(manifest: dict) -> str:
+    stats = manifest["ingest"]
+    rate = stats["extracted_pages"] / stats["seconds"] if stats["seconds"] else 0.0
+    return (
+        f"Файлов: {stats['files']} (из кеша {stats['reused']}, с ошибками {len(stats['failed'])}), "
+        f"разобрано страниц: {stats['extracted_pages']} за {stats['seconds']:.1f} с ({rate:.1f} стр/с)"
+    )
 
 
 def main():
@@ -164,31 +385,47 @@ def main():
     parser.add_argument("--master-out", type=Path, default=DEFAULT_MASTER_OUT, help="Папка для индекса магистратуры")
     parser.add_argument("--bachelor-md", type=Path, default=DEFAULT_BACHELOR_MD, help="Markdown-файл для бакалавриата (альтернатива JSON)")
     parser.add_argument("--master-md", type=Path, default=None, help="Markdown-файл для магистратуры (альтернатива JSON)")
+    parser.add_argument("--bachelor-dir", nargs="+", default=None, help="Папки/glob-шаблоны с PDF, Markdown, HTML для бакалавриата")
+    parser.add_argument("--master-dir", nargs="+", default=None, help="Папки/glob-шаблоны с PDF, Markdown, HTML для магистратуры")
+    parser.add_argument("--jobs", type=int, default=settings.rag.ingest_jobs or os.cpu_count(), help="Процессов для разбора файлов")
+    parser.add_argument("--compression", choices=COMPRESSION_MODES, default=settings.rag.index_compression, help="Сжатие векторов")
+    parser.add_argument("--pca-dim", type=int, default=settings.rag.pca_dim, help="Размерность после PCA (для pca, pca-fp16)")
+    parser.add_argument("--dedup-threshold", type=float, default=settings.rag.dedup_threshold, help="Порог похожести для отсева дубликатов, например 0.85 (по умолчанию 0 — не отсеивать)")
     args = parser.parse_args()
+    compression = {"compression": args.compression, "pca_dim": args.pca_dim, "dedup_threshold": args.dedup_threshold}
 
     # Настроим ключ для эмбеддингов
     os.environ["OPENAI_API_KEY"] = OPENAI_API_KEY
     os.environ["OPENAI_API_BASE"] = OPENAI_API_BASE
+    prewarm()
 
     # Бакалавриат
-    if args.bachelor_md is not None and args.bachelor_md.exists():
-        build_index_from_markdown(args.bachelor_md, args.bachelor_out, default_source="bachelor")
-        print(f"✅ Индекс бакалавриата из Markdown сохранён в '{args.bachelor_out}'. Источник: {args.bachelor_md}")
+    if args.bachelor_dir:
+        manifest = build_index_from_files(args.bachelor_dir, args.bachelor_out, "bachelor", jobs=args.jobs, **compression)
+        print(f"✅ Индекс бакалавриата сохранён в '{args.bachelor_out}' (версия {manifest['version']}). {_files_summary(manifest)}")
+    elif args.bachelor_md is not None and args.bachelor_md.exists():
+        manifest = build_index_from_markdown(args.bachelor_md, args.bachelor_out, default_source="bachelor", **compression)
+        print(f"✅ Индекс бакалавриата из Markdown сохранён в '{args.bachelor_out}' (версия {manifest['version']}). Источник: {args.bachelor_md}")
     else:
         if args.bachelor_md is not None and not args.bachelor_md.exists():
             print(f"⚠️ Markdown для бакалавриата не найден по пути: {args.bachelor_md}. Использую JSON: {args.bachelor}")
-        bachelor_entries = load_json_entries(args.bachelor, default_source="bachelor")
-        build_and_save_index(bachelor_entries, args.bachelor_out)
-        print(f"✅ Индекс бакалавриата сохранён в '{args.bachelor_out}'. Источник: {args.bachelor}")
+        bachelor_entries = iter_json_entries(args.bachelor, default_source="bachelor")
+        manifest = build_and_save_index(bachelor_entries, args.bachelor_out, **compression)
+        print(f"✅ Индекс бакалавриата сохранён в '{args.bachelor_out}' (версия {manifest['version']}). Источник: {args.bachelor}")
+    print(_dedup_summary(manifest))
 
     # Магистратура
-    if args.master_md is not None:
-        build_index_from_markdown(args.master_md, args.master_out, default_source="master")
-        print(f"✅ Индекс магистратуры из Markdown сохранён в '{args.master_out}'. Источник: {args.master_md}")
+    if args.master_dir:
+        manifest = build_index_from_files(args.master_dir, args.master_out, "master", jobs=args.jobs, **compression)
+        print(f"✅ Индекс магистратуры сохранён в '{args.master_out}' (версия {manifest['version']}). {_files_summary(manifest)}")
+    elif args.master_md is not None:
+        manifest = build_index_from_markdown(args.master_md, args.master_out, default_source="master", **compression)
+        print(f"✅ Индекс магистратуры из Markdown сохранён в '{args.master_out}' (версия {manifest['version']}). Источник: {args.master_md}")
     else:
-        master_entries = load_json_entries(args.master, default_source="master")
-        build_and_save_index(master_entries, args.master_out)
-        print(f"✅ Индекс магистратуры сохранён в '{args.master_out}'. Источник: {args.master}")
+        master_entries = iter_json_entries(args.master, default_source="master")
+        manifest = build_and_save_index(master_entries, args.master_out, **compression)
+        print(f"✅ Индекс магистратуры сохранён в '{args.master_out}' (версия {manifest['version']}). Источник: {args.master}")
+    print(_dedup_summary(manifest))
 
 
 if __name__ == "__main__":
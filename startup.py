@@ -0,0 +1,295 @@
+"""Быстрый старт бота: проверки конфигурации, фоновая загрузка тяжёлых модулей, замер времени.
+
+Бот импортирует только aiomax и лёгкие модули проекта. rag_bot_new (langchain,
+faiss, numpy) загружается в фоновом потоке, пока бот подключается к API, или
+лениво при первом вопросе. При STARTUP_PROFILE=1 время импорта каждого модуля
+и время до начала polling пишутся в лог.
+"""
+import builtins
+import importlib
+import importlib.util
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from pathlib import Path
+from typing import Optional
+
+PROCESS_START = time.perf_counter()
+
+HEAVY_MODULES = [
+    "numpy",
+    "faiss",
+    "langchain_openai",
+    "langchain_community.vectorstores.faiss",
+    "rag_bot_new",
+]
+
+logger = logging.getLogger('MAIN')
+
+
+# =============================================================================
+# Замер времени старта
+# =============================================================================
+
+class StartupProfiler:
+    """Собирает время импорта модулей и этапов запуска (секунды от PROCESS_START)."""
+    
+    def __init__(self):
+        self.imports: dict[str, float] = {}
+        self.marks: dict[str, float] = {}
+        self._local = threading.local()
+        self._original_import = None
+        self._lock = threading.Lock()
+    
+    def mark(self, name: str) -> float:
+        """Отмечает этап запуска."""
+        elapsed = time.perf_counter() - PROCESS_START
+        self.marks[name] = elapsed
+        return elapsed
+    
+    def timed_import(self, module: str) -> float:
+        """Импортирует модуль и возвращает время импорта (0, если уже загружен)."""
+        start = time.perf_counter()
+        depth = getattr(self._local, "depth", 0)
+        self._local.depth = depth + 1  # вложенные импорты уже входят в это время
+        try:
+            importlib.import_module(module)
+        finally:
+            self._local.depth = depth
+        elapsed = time.perf_counter() - start
+        with self._lock:
+            self.imports.setdefault(module, elapsed)
+        return elapsed
+    
+    def install_import_hook(self) -> None:
+        """Перехватывает __import__ и записывает время первых импортов верхнего уровня (включая зависимости)."""
+        if self._original_import is not None:
+            return
+        original = self._original_import = builtins.__import__
+        
+        def timed(name, globals=None, locals=None, fromlist=(), level=0):
+            depth = getattr(self._local, "depth", 0)
+            if depth or level or name in sys.modules:
+                self._local.depth = depth + 1
+                try:
+                    return original(name, globals, locals, fromlist, level)
+                finally:
+                    self._local.depth = depth
+            self._local.depth = 1
+            start = time.perf_counter()
+            try:
+                return original(name, globals, locals, fromlist, level)
+            finally:
+                self._local.depth = 0
+                with self._lock:
+                    self.imports.setdefault(name, time.perf_counter() - start)
+        
+        builtins.__import__ = timed
+    
+    def uninstall_import_hook(self) -> None:
+        if self._original_import is not None:
+            builtins.__import__ = self._original_import
+            self._original_import = None
+    
+    def report(self, top: int = 15) -> str:
+        """Текстовый отчёт: этапы и самые долгие импорты."""
+        lines = ["Этапы запуска:"]
+        for name, elapsed in sorted(self.marks.items(), key=lambda x: x[1]):
+            lines.append(f"  {elapsed * 1000:8.1f} мс  {name}")
+        if self.imports:
+            lines.append("Импорт модулей (включая зависимости):")
+            for name, elapsed in sorted(self.imports.items(), key=lambda x: -x[1])[:top]:
+                lines.append(f"  {elapsed * 1000:8.1f} мс  {name}")
+        return "\n".join(lines)
+
+
+profiler = StartupProfiler()
+
+if os.getenv("STARTUP_PROFILE", "0").strip().lower() in ("1", "true", "yes", "on"):
+    profiler.install_import_hook()
+
+
+def preload_in_background(modules: Optional[list[str]] = None, prewarm_http: bool = True) -> threading.Thread:
+    """Импортирует тяжёлые модули и прогревает HTTP-пул в фоне, пока бот подключается."""
+    
+    def run():
+        for module in modules or HEAVY_MODULES:
+            try:
+                profiler.timed_import(module)
+            except ImportError as e:
+                logger.error(f"[СТАРТ] Не удалось импортировать {module}: {e}")
+        profiler.mark("heavy_modules_loaded")
+        if prewarm_http:
+            from http_clients import prewarm
+            prewarm()
+            profiler.mark("http_prewarmed")
+    
+    thread = threading.Thread(target=run, name="startup-preload", daemon=True)
+    thread.start()
+    return thread
+
+
+def log_startup_report(detailed: Optional[bool] = None) -> None:
+    """Пишет в лог время до начала polling; при STARTUP_PROFILE=1 — полный отчёт."""
+    elapsed = profiler.mark("first_poll")
+    logger.info(f"[СТАРТ] До начала polling: {elapsed * 1000:.0f} мс")
+    if detailed is None:
+        detailed = profiler._original_import is not None
+    if detailed:
+        logger.info(profiler.report())
+
+
+# =============================================================================
+# Проверки конфигурации (без pytest)
+# =============================================================================
+
+class StartupChecker:
+    """Быстрая проверка перед запуском бота (без pytest)."""
+    
+    def __init__(self):
+        self.errors: list[str] = []
+        self.warnings: list[str] = []
+    
+    def check_modules(self) -> bool:
+        """Проверяет установку модулей (через find_spec — без их импорта)."""
+        modules = ["aiomax", "langchain_openai", "faiss", "dotenv"]
+        for module in modules:
+            if importlib.util.find_spec(module) is None:
+                self.errors.append(f"Модуль '{module}' не установлен")
+        return not any("Модуль" in e for e in self.errors)
+    
+    def check_env(self) -> bool:
+        """Проверяет переменные окружения."""
+        from settings import settings
+        
+        if not settings.bot.token:
+            self.errors.append("MAX_VK_BOT_TOKEN не установлен")
+        if not settings.openai.api_key:
+            self.errors.append("OPENAI_API_KEY не установлен")
+        if not settings.bot.username:
+            self.warnings.append("MAX_VK_BOT_USERNAME не установлен")
+        
+        return not self.errors
+    
+    def check_indexes(self) -> bool:
+        """Проверяет FAISS индексы."""
+        from index_store import index_exists
+        from settings import settings
+        
+        indexes = [
+            settings.rag.default_index_dir,
+            settings.rag.bachelor_index_dir,
+            settings.rag.master_index_dir,
+        ]
+        
+        found = any(index_exists(idx) for idx in indexes)
+        
+        if not found:
+            self.errors.append("Не найдено ни одного FAISS-индекса")
+        
+        return found
+    
+    def check_faq(self) -> bool:
+        """Проверяет FAQ файл."""
+        faq_path = Path("data/faq.json")
+        if not faq_path.exists():
+            self.warnings.append("FAQ файл не найден")
+            return True
+        
+        try:
+            with open(faq_path, encoding="utf-8") as f:
+                json.load(f)
+            return True
+        except json.JSONDecodeError as e:
+            self.errors.append(f"Ошибка парсинга FAQ: {e}")
+            return False
+    
+    def check_openai(self) -> bool:
+        """Проверяет OpenAI API."""
+        from settings import settings
+        from langchain_openai import ChatOpenAI
+        from http_clients import openai_client_kwargs
+        
+        try:
+            chat = ChatOpenAI(
+                model_name=settings.openai.model,
+                openai_api_key=settings.openai.api_key,
+                openai_api_base=settings.openai.api_base,
+                temperature=0,
+                max_tokens=10,
+                **openai_client_kwargs(),
+            )
+            result = chat.invoke("OK")
+            return bool(result.content)
+        except Exception as e:
+            self.errors.append(f"OpenAI API недоступен: {e}")
+            return False
+    
+    def run(self, check_api: bool = False) -> bool:
+        """Запускает все проверки."""
+        print("🔍 Проверка конфигурации...\n")
+        
+        checks = [
+            ("Модули", self.check_modules),
+            ("Переменные окружения", self.check_env),
+            ("FAISS индексы", self.check_indexes),
+            ("FAQ файл", self.check_faq),
+        ]
+        
+        if check_api:
+            checks.append(("OpenAI API", self.check_openai))
+        
+        all_passed = True
+        for name, check_func in checks:
+            try:
+                result = check_func()
+                status = "✅" if result else "❌"
+                print(f"  {status} {name}")
+                if not result:
+                    all_passed = False
+            except Exception as e:
+                print(f"  ❌ {name}: {e}")
+                all_passed = False
+        
+        print()
+        
+        if self.warnings:
+            print("⚠️  Предупреждения:")
+            for w in self.warnings:
+                print(f"    • {w}")
+            print()
+        
+        if self.errors:
+            print("❌ Ошибки:")
+            for e in self.errors:
+                print(f"    • {e}")
+            print()
+        
+        if all_passed:
+            print("✅ Все проверки пройдены!\n")
+        
+        return all_passed
+
+
+def run_startup_tests(check_api: bool = False, exit_on_fail: bool = True) -> bool:
+    """
+    Запускает быструю проверку перед стартом бота.
+    
+    Args:
+        check_api: Проверять ли подключение к API (медленно)
+        exit_on_fail: Завершить процесс при ошибке
+        
+    Returns:
+        True если все проверки пройдены
+    """
+    checker = StartupChecker()
+    passed = checker.run(check_api=check_api)
+    
+    if not passed and exit_on_fail:
+        print("❌ Бот не может быть запущен. Исправьте ошибки выше.")
+        sys.exit(1)
+    
+    return passed
@@ -0,0 +1,280 @@
+"""Прогрев бота перед приёмом обновлений и локальная проверка готовности.
+
+Сразу после запуска первые пользователи платят за всё холодное: загрузку
+индексов в RAGEngine, пустой кеш is_admission_related_smart, новые TLS-соединения.
+Поэтому polling (или webhook) начинается только после прогрева, который идёт
+в фоне параллельно с run_startup_tests:
+
+1. modules — ждёт фоновую загрузку тяжёлых модулей и прогрев HTTP-пула (startup.py);
+2. indexes — загружает индексы уровней settings.warmup.levels;
+3. questions — прогоняет settings.warmup.questions через весь пайплайн
+   (answer_in_session) кругами, пока p50 круга не перестанет падать больше чем
+   на steady_tolerance (не меньше min_rounds и не больше max_rounds кругов).
+
+У каждого этапа свой таймаут (stage_timeout), у всего прогрева — общий (timeout).
+Если прогрев не уложился или этап упал, бот всё равно запускается, а в состоянии
+готовности остаётся пометка degraded. Время этапов и p50 кругов пишутся в лог
+(`[ПРОГРЕВ]`, `[ГОТОВ]`) и отдаются JSON-ом на http://127.0.0.1:8081/health
+(200 — готов, 503 — ещё прогревается; порт — HEALTH_PORT, 0 — выключить).
+
+Выключение: WARMUP=0. Свои вопросы: WARMUP_QUESTIONS="вопрос 1|вопрос 2".
+"""
+import json
+import logging
+import statistics
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Optional
+
+from settings import settings
+from startup import PROCESS_START, profiler
+
+logger = logging.getLogger('MAIN')
+
+
+def is_steady(p50s: list[float], tolerance: float, min_rounds: int = 2) -> bool:
+    """Задержка установилась: последний круг быстрее предыдущего не больше чем на tolerance."""
+    if len(p50s) < max(2, min_rounds):
+        return False
+    return p50s[-1] >= p50s[-2] * (1 - tolerance)
+
+
+class Readiness:
+    """Состояние готовности и время этапов прогрева (мс) — для лога и /health."""
+
+    def __init__(self):
+        self.state = "starting"
+        self.stages: dict[str, dict] = {}
+        self.rounds: list[dict] = []
+        self.ready_at: Optional[float] = None
+        self._event = threading.Event()
+        self._lock = threading.Lock()
+
+    def stage(self, name: str, ms: float, status: str = "ok", **extra) -> None:
+        with self._lock:
+            self.stages[name] = {"ms": round(ms, 1), "status": status, **extra}
+
+    def add_round(self, latencies: list[float], errors: int) -> float:
+        """Запоминает круг вопросов (задержки в мс) и возвращает его p50."""
+        p50 = statistics.median(latencies) if latencies else 0.0
+        with self._lock:
+            self.rounds.append({"p50_ms": round(p50, 1), "max_ms": round(max(latencies, default=0.0), 1), "errors": errors})
+        return p50
+
+    def finish(self, state: str) -> None:
+        with self._lock:
+            self.state = state
+            self.ready_at = time.perf_counter() - PROCESS_START
+        self._event.set()
+
+    @property
+    def ready(self) -> bool:
+        return self._event.is_set()
+
+    def wait(self, timeout: Optional[float] = None) -> bool:
+        return self._event.wait(timeout)
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {
+                "status": self.state,
+                "ready": self.ready,
+                "ready_after_ms": round(self.ready_at * 1000) if self.ready_at is not None else None,
+                "uptime_s": round(time.perf_counter() - PROCESS_START, 1),
+                "stages": dict(self.stages),
+                "rounds": list(self.rounds),
+                "startup_ms": {name: round(at * 1000, 1) for name, at in profiler.marks.items()},
+            }
+
+
+readiness = Readiness()
+
+
+def run_stage(name: str, fn: Callable[[], object], timeout: float, state: Readiness) -> bool:
+    """Выполняет этап в отдельном потоке не дольше timeout. True — этап завершился без ошибки."""
+    outcome: dict = {}
+
+    def target():
+        try:
+            outcome["result"] = fn()
+        except Exception as e:
+            outcome["error"] = f"{type(e).__name__}: {e}"
+
+    start = time.perf_counter()
+    thread = threading.Thread(target=target, name=f"warmup-{name}", daemon=True)
+    thread.start()
+    thread.join(timeout)
+    ms = (time.perf_counter() - start) * 1000
+    if thread.is_alive():
+        # зависший этап дорабатывает в фоне, прогрев идёт дальше
+        state.stage(name, ms, "timeout")
+        logger.warning(f"[ПРОГРЕВ] {name}: не уложился в {timeout:.0f} с")
+        return False
+    if "error" in outcome:
+        state.stage(name, ms, "error", error=outcome["error"])
+        logger.warning(f"[ПРОГРЕВ] {name}: {outcome['error']}")
+        return False
+    state.stage(name, ms)
+    logger.info(f"[ПРОГРЕВ] {name}: {ms:.0f} мс")
+    return True
+
+
+def load_indexes(levels: tuple[str, ...]) -> None:
+    from rag_bot_new import RAGEngine
+
+    for level in levels:
+        RAGEngine.get_retriever(level)
+    if settings.rag.cross_level_search:
+        RAGEngine.get_cross_level_retriever()
+
+
+@contextmanager
+def excluded_from_stats():
+    """Вопросы внутри блока не попадают в retrieval_stats и answer_stats (счётчики восстанавливаются)."""
+    import rag_bot_new
+
+    saved = [(counter, Counter(counter)) for counter in (rag_bot_new.retrieval_stats, rag_bot_new.answer_stats)]
+    try:
+        yield
+    finally:
+        for counter, before in saved:
+            counter.clear()
+            counter.update(before)
+
+
+def ask_round(questions: tuple[str, ...], levels: tuple[str, ...]) -> tuple[list[float], int]:
+    """Один круг вопросов через answer_in_session: задержки в мс и число ошибок.
+
+    Ошибка — исключение или status=error (LLM упала или не успела, база знаний не
+    загрузилась). Статистика ответов бота остаётся только от пользователей.
+    """
+    from rag_bot_new import answer_in_session, answer_status
+
+    latencies, errors = [], 0
+    with excluded_from_stats():
+        for level in levels:
+            for question in questions:
+                start = time.perf_counter()
+                try:
+                    answer, record = answer_in_session(question, None, level)
+                    errors += answer_status(answer, record) == "error"
+                except Exception as e:
+                    errors += 1
+                    logger.warning(f"[ПРОГРЕВ] Вопрос «{question[:40]}» ({level}): {type(e).__name__}: {e}")
+                latencies.append((time.perf_counter() - start) * 1000)
+    return latencies, errors
+
+
+def warm_up(cfg=None, preload: Optional[threading.Thread] = None, state: Optional[Readiness] = None) -> Readiness:
+    """Прогревает бота (этапы — в описании модуля) и отмечает готовность в state."""
+    cfg = cfg or settings.warmup
+    state = state or readiness
+    state.state = "warming"
+    deadline = time.monotonic() + cfg.timeout
+
+    def budget() -> float:
+        return max(0.0, min(cfg.stage_timeout, deadline - time.monotonic()))
+
+    healthy = True
+    if preload is not None:
+        healthy &= run_stage("modules", lambda: preload.join(), budget(), state)
+    healthy &= run_stage("indexes", lambda: load_indexes(cfg.levels), budget(), state)
+
+    p50s: list[float] = []
+    while len(p50s) < cfg.max_rounds and cfg.questions:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            logger.warning(f"[ПРОГРЕВ] Общий таймаут {cfg.timeout:.0f} с: задержка не успела установиться")
+            healthy = False
+            break
+        result: dict = {}
+        number = len(p50s) + 1
+
+        def one_round():
+            result["latencies"], result["errors"] = ask_round(cfg.questions, cfg.levels)
+
+        if not run_stage(f"round_{number}", one_round, remaining, state):
+            healthy = False
+            break
+        p50s.append(state.add_round(result["latencies"], result["errors"]))
+        logger.info(f"[ПРОГРЕВ] Круг {number}: p50 {p50s[-1]:.0f} мс, ошибок {result['errors']}")
+        if result["errors"] == len(result["latencies"]):
+            healthy = False  # пайплайн не отвечает — ждать установившейся задержки бессмысленно
+            break
+        if is_steady(p50s, cfg.steady_tolerance, cfg.min_rounds):
+            break
+
+    state.finish("ready" if healthy else "degraded")
+    rounds = ", ".join(f"{p:.0f}" for p in p50s) or "—"
+    logger.info(f"[ГОТОВ] {state.state} через {state.ready_at * 1000:.0f} мс от запуска; p50 кругов, мс: {rounds}")
+    return state
+
+
+def start_warmup(preload: Optional[threading.Thread] = None, cfg=None, state: Optional[Readiness] = None) -> Optional[threading.Thread]:
+    """Запускает warm_up в фоне (параллельно с проверками); выключенный прогрев сразу даёт готовность."""
+    cfg = cfg or settings.warmup
+    state = state or readiness
+    if not cfg.enabled:
+        state.finish("ready")
+        return None
+    thread = threading.Thread(target=warm_up, args=(cfg, preload, state), name="warmup", daemon=True)
+    thread.start()
+    return thread
+
+
+def wait_until_ready(cfg=None, state: Optional[Readiness] = None) -> dict:
+    """Блокирует запуск polling до конца прогрева (не дольше общего таймаута) и возвращает снимок состояния."""
+    cfg = cfg or settings.warmup
+    state = state or readiness
+    if not state.wait(cfg.timeout + cfg.stage_timeout):
+        logger.warning("[ГОТОВ] Прогрев не завершился вовремя, бот запускается без него")
+        state.finish("degraded")
+    return state.snapshot()
+
+
+# =============================================================================
+# Локальная проверка готовности
+# =============================================================================
+
+class _HealthHandler(BaseHTTPRequestHandler):
+    state: Readiness = readiness
+
+    def do_GET(self):
+        if self.path.split("?")[0] not in ("/health", "/ready"):
+            self.send_error(404)
+            return
+        snapshot = self.state.snapshot()
+        body = json.dumps(snapshot, ensure_ascii=False).encode("utf-8")
+        self.send_response(200 if snapshot["ready"] else 503)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass  # запросы проверки готовности в лог не пишем
+
+
+def start_health_server(host: Optional[str] = None, port: Optional[int] = None, state: Optional[Readiness] = None) -> Optional[ThreadingHTTPServer]:
+    """HTTP-сервер /health в фоновом потоке. None, если в настройках порт 0 или порт занят.
+
+    Явный port=0 — свободный порт от системы (для тестов).
+    """
+    host = settings.warmup.health_host if host is None else host
+    if port is None:
+        port = settings.warmup.health_port
+        if not port:
+            return None
+    handler = type("HealthHandler", (_HealthHandler,), {"state": state or readiness})
+    try:
+        server = ThreadingHTTPServer((host, port), handler)
+    except OSError as e:
+        logger.warning(f"[ГОТОВ] Проверка готовности не запущена на {host}:{port}: {e}")
+        return None
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="health", daemon=True).start()
+    logger.info(f"[ГОТОВ] Проверка готовности: http://{host}:{server.server_address[1]}/health")
+    return server
@@ -0,0 +1,197 @@
+"""Приём обновлений MAX через webhook вместо long polling.
+
+Платформа присылает обновления POST-запросами на settings.webhook.url. Приёмник
+сразу отвечает 200 и кладёт обновление в ограниченную очередь, а отдельная
+задача передаёт его в bot.handle_update — те же обработчики aiomax, что и при
+polling. Повторные доставки (платформа повторяет запрос, если не дождалась
+ответа) отсеиваются по id сообщения или callback. Если очередь заполнена,
+приёмник отвечает 503, и платформа доставит обновление позже.
+
+Включение: WEBHOOK=1 и WEBHOOK_URL=https://<хост>/webhook в keys.env.
+"""
+import asyncio
+import hashlib
+import json
+import logging
+from collections import Counter, OrderedDict
+from typing import Optional
+
+import aiohttp
+from aiohttp import web
+
+API_URL = "https://platform-api.max.ru"
+SECRET_HEADER = "X-Max-Bot-Api-Secret"
+
+logger = logging.getLogger('WEBHOOK')
+
+
+def update_key(update: dict) -> str:
+    """Ключ для поиска повторных доставок: id сообщения/callback или хэш тела."""
+    update_type = update.get("update_type", "")
+    callback = update.get("callback") or {}
+    if callback.get("callback_id"):
+        return f"{update_type}:{callback['callback_id']}"
+    body = (update.get("message") or {}).get("body") or {}
+    if body.get("mid"):
+        return f"{update_type}:{body['mid']}"
+    raw = json.dumps(update, ensure_ascii=False, sort_keys=True).encode("utf-8")
+    return f"{update_type}:{hashlib.sha1(raw).hexdigest()}"
+
+
+class UpdateDeduper:
+    """Последние size ключей обновлений (LRU)."""
+
+    def __init__(self, size: int = 10000):
+        self.size = size
+        self._keys: OrderedDict[str, None] = OrderedDict()
+
+    def seen(self, key: str) -> bool:
+        """Встречался ли ключ; новый ключ запоминается."""
+        if key in self._keys:
+            self._keys.move_to_end(key)
+            return True
+        self._keys[key] = None
+        if len(self._keys) > self.size:
+            self._keys.popitem(last=False)
+        return False
+
+    def forget(self, key: str) -> None:
+        self._keys.pop(key, None)
+
+    def __len__(self) -> int:
+        return len(self._keys)
+
+
+class WebhookReceiver:
+    """aiohttp-приёмник обновлений с очередью и диспетчером в обработчики бота."""
+
+    def __init__(self, bot, path: str = "/webhook", secret: str = "", max_queue: int = 1000, dedup_size: int = 10000):
+        self.bot = bot
+        self.path = path
+        self.secret = secret
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=max_queue)
+        self.deduper = UpdateDeduper(dedup_size)
+        self.stats: Counter = Counter()
+        self.port: Optional[int] = None
+        self._runner: Optional[web.AppRunner] = None
+        self._dispatcher: Optional[asyncio.Task] = None
+
+    def app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post(self.path, self._receive)
+        return app
+
+    async def _receive(self, request: web.Request) -> web.Response:
+        if self.secret and request.headers.get(SECRET_HEADER) != self.secret:
+            self.stats["unauthorized"] += 1
+            return web.Response(status=401)
+        try:
+            body = await request.json()
+        except (json.JSONDecodeError, UnicodeDecodeError):
+            self.stats["bad_request"] += 1
+            return web.Response(status=400)
+        updates = body.get("updates", []) if isinstance(body, dict) and "updates" in body else [body]
+        for update in updates:
+            if not isinstance(update, dict) or "update_type" not in update:
+                self.stats["bad_request"] += 1
+                continue
+            self.stats["received"] += 1
+            key = update_key(update)
+            if self.deduper.seen(key):
+                self.stats["duplicates"] += 1
+                continue
+            try:
+                self.queue.put_nowait(update)
+            except asyncio.QueueFull:
+                # не запоминаем: платформа повторит доставку, и её нужно будет обработать
+                self.deduper.forget(key)
+                self.stats["rejected"] += 1
+                return web.Response(status=503)
+        return web.json_response({"success": True})
+
+    async def _dispatch(self) -> None:
+        while True:
+            update = await self.queue.get()
+            try:
+                # handle_update только разбирает обновление и создаёт задачи обработчиков
+                await self.bot.handle_update(update)
+                self.stats["dispatched"] += 1
+            except Exception as e:
+                self.stats["errors"] += 1
+                logger.exception(f"Ошибка обработки обновления {update.get('update_type')}: {type(e).__name__}: {e}")
+            finally:
+                self.queue.task_done()
+
+    async def start(self, host: str = "0.0.0.0", port: int = 8080) -> int:
+        """Запускает HTTP-сервер и диспетчер. Возвращает порт (при port=0 — выбранный системой)."""
+        self._dispatcher = asyncio.create_task(self._dispatch())
+        self._runner = web.AppRunner(self.app(), shutdown_timeout=1.0)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, host, port)
+        await site.start()
+        self.port = site._server.sockets[0].getsockname()[1]
+        logger.info(f"Webhook слушает {host}:{self.port}{self.path}")
+        return self.port
+
+    async def stop(self, drain_timeout: float = 5.0) -> None:
+        """Останавливает приём, дожидается разбора очереди (не дольше drain_timeout) и диспетчер."""
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+        if self._dispatcher is not None:
+            try:
+                await asyncio.wait_for(self.queue.join(), drain_timeout)
+            except asyncio.TimeoutError:
+                logger.warning(f"Не разобрано обновлений при остановке: {self.queue.qsize()}")
+            self._dispatcher.cancel()
+            await asyncio.gather(self._dispatcher, return_exceptions=True)
+            self._dispatcher = None
+
+
+async def subscribe(bot, url: str, secret: str = "") -> None:
+    """Подписывает бота на доставку обновлений на url."""
+    payload = {"url": url}
+    if secret:
+        payload["secret"] = secret
+    await bot.post(f"{API_URL}/subscriptions", json=payload)
+
+
+async def unsubscribe(bot, url: str) -> None:
+    await bot.delete(f"{API_URL}/subscriptions", params={"url": url})
+
+
+async def serve_webhook(bot, cfg, session=None) -> None:
+    """Аналог Bot.start_polling для webhook: работает, пока задачу не отменят.
+
+    cfg — settings.webhook. Подписка оформляется, только если задан cfg.url
+    (без него приёмник ждёт обновления от уже настроенной подписки или от fake_max).
+    """
+    receiver = WebhookReceiver(bot, cfg.path, cfg.secret, cfg.queue_size, cfg.dedup_size)
+    async with (session or aiohttp.ClientSession()) as session:
+        bot.session = session
+        await bot.get_me()
+        await receiver.start(cfg.host, cfg.port)
+        if cfg.url:
+            await subscribe(bot, cfg.url, cfg.secret)
+        logger.info(f"Запущен webhook бота @{bot.username} ({bot.id}) - {bot.name}")
+        for handler in bot.handlers["on_ready"]:
+            asyncio.create_task(handler())
+        try:
+            await asyncio.Event().wait()
+        finally:
+            if cfg.url:
+                try:
+                    await unsubscribe(bot, cfg.url)
+                except Exception as e:
+                    logger.warning(f"Не удалось снять подписку: {type(e).__name__}: {e}")
+            await receiver.stop()
+            logger.info(f"Webhook остановлен: {dict(receiver.stats)}")
+    bot.session = None
+
+
+def run_webhook(bot, cfg) -> None:
+    """Аналог bot.run() для webhook."""
+    try:
+        asyncio.run(serve_webhook(bot, cfg))
+    except KeyboardInterrupt:
+        pass